@@ -0,0 +1,379 @@
+import argparse
+import fnmatch
+import json
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+import numpy as np
+from model import Road, Vehicle
+from simulation import SimulationController
+from vectorized import VectorizedSimulationController
+from ensemble import EnsembleSimulationController
+
+# Benchmarks for the simulation hot paths.
+#   python benchmark.py --output results.json
+#   python benchmark.py --save-baseline baseline.json
+#   python benchmark.py --baseline baseline.json --threshold 0.25
+# With --baseline the exit code is 1 when any benchmark regressed by more
+# than --threshold (a fraction) against the stored value.
+
+# Road length per vehicle (m), so density is the same at every size
+SPACING = 20.0
+UPDATE_SIZES = (10, 100, 1000, 10000, 100000)
+# The object engine needs minutes per step beyond this
+OBJECT_MAX_VEHICLES = 10000
+NEIGHBOR_SIZES = (10, 100, 1000, 10000, 100000)
+ZONE_COUNTS = (1, 10, 100, 1000)
+RENDER_SIZES = (40, 150, 1000, 10000, 50000)
+LANE_SIZES = (1000, 10000)
+LANE_COUNTS = (1, 2, 4, 6)
+INTEGRATOR_SIZES = (1000, 10000)
+# Integrators with the time steps they are run at (s)
+INTEGRATOR_STEPS = (('euler', 1 / 60), ('ballistic', 0.5), ('ballistic', 1.0), ('adaptive', 1.0))
+FLEET_SIZES = (1000, 10000)
+# Mixed fleet for the vehicle memory and churn benchmarks
+FLEET = {'car': 0.8, 'truck': 0.15, 'bus': 0.05}
+# Vehicles despawned and spawned again per churn cycle
+CHURN = 50
+# Replica counts for the ensemble benchmarks, ENSEMBLE_VEHICLES each
+ENSEMBLE_SIZES = (8, 32)
+ENSEMBLE_VEHICLES = 150
+INIT_SIZES = (1000, 10000, 100000)
+QUICK_LIMIT = 1000
+
+
+def measure(fn, min_time):
+    # Seconds per call of fn: the best of 5 batches each lasting about
+    # min_time / 5
+    calls = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(calls):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time / 10 or calls >= 1 << 20:
+            break
+        calls *= 2
+    batch = max(1, int(calls * (min_time / 5) / max(elapsed, 1e-9)))
+    best = float('inf')
+    for _ in range(5):
+        start = time.perf_counter()
+        for _ in range(batch):
+            fn()
+        best = min(best, (time.perf_counter() - start) / batch)
+    return best
+
+
+def populate(sim, count, seed=0):
+    # Put count vehicles on sim at once, skipping the one-per-step spawn ramp
+    rng = random.Random(seed)
+    vehicles = [Vehicle(i, rng.uniform(0, sim.road.length), rng.randint(0, sim.road.num_lanes - 1),
+                        sim.base_desired_speed + rng.uniform(-2, 2)) for i in range(count)]
+    sim.next_vehicle_id = count
+    sim.set_target_vehicle_count(count)
+    if isinstance(sim, VectorizedSimulationController):
+        sim.load_vehicles(sorted(vehicles, key=lambda v: v.position))
+    else:
+        sim.vehicles = vehicles
+        sim.lane_index.rebuild(vehicles)
+        sim.vehicles = sim.lane_index.ordered()
+    return sim
+
+
+def bench_update(results, sizes, min_time):
+    for engine, cls in (('object', SimulationController), ('vectorized', VectorizedSimulationController)):
+        for n in sizes:
+            if engine == 'object' and n > OBJECT_MAX_VEHICLES:
+                continue
+            sim = populate(cls(road_length=n * SPACING, seed=0), n)
+            sim.update(0.05) # settle after placement
+            seconds = measure(lambda: sim.update(0.05), min_time)
+            results[f'update.{engine}.n={n}'] = {'value': 1.0 / seconds, 'unit': 'steps/s',
+                                                  'higher_is_better': True}
+
+
+def bench_lanes(results, sizes, min_time):
+    # Same vehicles and density per lane-metre spread over more lanes: the
+    # step cost should stay flat as lanes are added
+    for engine, cls in (('object', SimulationController), ('vectorized', VectorizedSimulationController)):
+        for n in sizes:
+            for lanes in LANE_COUNTS:
+                sim = populate(cls(road_length=n * SPACING * 2 / lanes, seed=0, num_lanes=lanes), n)
+                sim.update(0.05)
+                seconds = measure(lambda: sim.update(0.05), min_time)
+                results[f'update.{engine}.lanes={lanes}.n={n}'] = {
+                    'value': 1.0 / seconds, 'unit': 'steps/s', 'higher_is_better': True}
+
+
+def bench_integrators(results, sizes, min_time):
+    # Simulated seconds per wall-clock second: the ballistic integrators
+    # stay collision-free with much longer steps than Euler
+    for engine, cls in (('object', SimulationController), ('vectorized', VectorizedSimulationController)):
+        for n in sizes:
+            if engine == 'object' and n > OBJECT_MAX_VEHICLES:
+                continue
+            for integrator, dt in INTEGRATOR_STEPS:
+                sim = populate(cls(road_length=n * SPACING, seed=0, integrator=integrator), n)
+                sim.update(dt)
+                seconds = measure(lambda: sim.update(dt), min_time)
+                results[f'integrator.{engine}.{integrator}.dt={dt:.3g}.n={n}'] = {
+                    'value': dt / seconds, 'unit': 'sim s/s', 'higher_is_better': True}
+
+
+def bench_fleet(results, sizes, min_time):
+    # Memory per vehicle of a mixed fleet, and the cost of a step while the
+    # target count swings by CHURN vehicles (despawned vehicles are reused)
+    for n in sizes:
+        sim = SimulationController(road_length=n * SPACING, seed=0)
+        sim.set_fleet(FLEET)
+        tracemalloc.start()
+        for _ in range(n):
+            sim._spawn_vehicle()
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[f'fleet.memory.n={n}'] = {'value': size / n, 'unit': 'bytes/vehicle',
+                                          'higher_is_better': False}
+        sim.set_target_vehicle_count(n)
+        sim.update(0.05)
+        steps = [0]
+
+        def churn():
+            steps[0] += 1
+            sim.set_target_vehicle_count(n - CHURN if steps[0] // CHURN % 2 else n)
+            sim.update(0.05)
+
+        results[f'fleet.churn.n={n}'] = {'value': 1.0 / measure(churn, min_time), 'unit': 'steps/s',
+                                         'higher_is_better': True}
+
+
+def bench_ensemble(results, sizes, min_time):
+    # Replica steps per second: K replicas in one EnsembleSimulationController
+    # against the same K runs stepped one after the other
+    n = ENSEMBLE_VEHICLES
+    for k in sizes:
+        ensemble = EnsembleSimulationController(k, road_length=n * SPACING, seeds=range(k))
+        singles = {
+            'object': [SimulationController(road_length=n * SPACING, seed=r) for r in range(k)],
+            'vectorized': [VectorizedSimulationController(road_length=n * SPACING, seed=r) for r in range(k)],
+        }
+        for sim in [ensemble] + singles['object'] + singles['vectorized']:
+            sim.set_target_vehicle_count(n)
+            for _ in range(n):
+                sim.update(0.05) # spawn ramp
+        results[f'ensemble.batched.k={k}'] = {
+            'value': k / measure(lambda: ensemble.update(0.05), min_time), 'unit': 'replica steps/s',
+            'higher_is_better': True}
+        for engine, sims in singles.items():
+            def sequential():
+                for sim in sims:
+                    sim.update(0.05)
+
+            results[f'ensemble.sequential.{engine}.k={k}'] = {
+                'value': k / measure(sequential, min_time), 'unit': 'replica steps/s',
+                'higher_is_better': True}
+
+
+def bench_init(results, sizes, min_time):
+    # Vehicles placed per second by populate, the equilibrium start that
+    # replaces the one-per-step spawn ramp
+    for engine, cls in (('object', SimulationController), ('vectorized', VectorizedSimulationController)):
+        for n in sizes:
+            if engine == 'object' and n > OBJECT_MAX_VEHICLES:
+                continue
+            sim = cls(road_length=n * SPACING, seed=0)
+            results[f'init.{engine}.n={n}'] = {
+                'value': n / measure(lambda: sim.populate(n), min_time), 'unit': 'vehicles/s',
+                'higher_is_better': True}
+
+
+def bench_neighbors(results, sizes, min_time):
+    for n in sizes:
+        sim = populate(SimulationController(road_length=n * SPACING, seed=0), n)
+        # Each probe with an adjacent lane that exists: to the left, or to
+        # the right from the outermost lane
+        lanes = sim.road.num_lanes
+        probes = [(v, v.lane + 1 if v.lane + 1 < lanes else max(v.lane - 1, 0))
+                  for v in sim.vehicles[::max(1, n // 100)]]
+
+        def leaders():
+            for v, other in probes:
+                sim._find_leader(v, v.lane)
+                sim._find_leader(v, other)
+
+        def followers():
+            for v, other in probes:
+                sim._find_follower(v, other)
+
+        for name, fn, calls in (('find_leader', leaders, 2 * len(probes)),
+                                ('find_follower', followers, len(probes))):
+            results[f'{name}.n={n}'] = {'value': measure(fn, min_time) / calls * 1e9,
+                                        'unit': 'ns/call', 'higher_is_better': False}
+
+
+def bench_speed_limits(results, counts, min_time):
+    rng = random.Random(0)
+    for count in counts:
+        road = Road(count * 200.0)
+        for i in range(count):
+            start = i * 200.0 + rng.uniform(0, 50)
+            road.add_speed_limit_zone(start, start + rng.uniform(50, 300), rng.uniform(8, 30))
+        positions = [rng.uniform(0, road.length) for _ in range(1000)]
+        road.get_speed_limit_at(0.0) # compile outside the timing
+
+        def lookup():
+            for p in positions:
+                road.get_speed_limit_at(p)
+
+        results[f'get_speed_limit_at.zones={count}'] = {
+            'value': measure(lookup, min_time) / len(positions) * 1e9,
+            'unit': 'ns/call', 'higher_is_better': False}
+
+        # One scheduled limit change followed by a lookup: patched in place,
+        # against clearing and adding every zone again as the UI used to
+        zones = [(z['start'], z['end'], z['limit']) for z in road.speed_limit_zones]
+        changes = [(rng.randrange(count), rng.uniform(8, 30)) for _ in range(64)]
+
+        def patch():
+            for index, limit in changes:
+                road.set_zone_limit(index, limit)
+                road.get_speed_limit_at(positions[index])
+
+        def rebuild():
+            for index, limit in changes:
+                road.clear_zones()
+                for k, (start, end, zone_limit) in enumerate(zones):
+                    road.add_speed_limit_zone(start, end, limit if k == index else zone_limit)
+                road.get_speed_limit_at(positions[index])
+
+        for name, fn in (('set_zone_limit', patch), ('rebuild_zones', rebuild)):
+            results[f'{name}.zones={count}'] = {'value': measure(fn, min_time) / len(changes) * 1e6,
+                                                'unit': 'us/change', 'higher_is_better': False}
+
+
+def bench_render(results, sizes, min_time):
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+    os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+    try:
+        import pygame
+        from main import App
+    except ImportError:
+        print("pygame not available, skipping render benchmarks", file=sys.stderr)
+        return
+    app = App(use_worker=False)
+    for n in sizes:
+        populate(app.sim, n)
+        app.sim.update(1 / 60)
+        vehicles = app.sim.vehicles
+
+        def positions():
+            for v in vehicles:
+                app.get_pos_on_oval(v.position, v.lane)
+
+        results[f'get_pos_on_oval.n={n}'] = {'value': measure(positions, min_time) / n * 1e9,
+                                             'unit': 'ns/call', 'higher_is_better': False}
+        positions_array = np.fromiter((v.position for v in vehicles), np.float64, n)
+        lanes_array = np.fromiter((v.lane for v in vehicles), np.int64, n)
+        results[f'oval_lookup.n={n}'] = {
+            'value': measure(lambda: app.track.lookup(positions_array, lanes_array), min_time) / n * 1e9,
+            'unit': 'ns/call', 'higher_is_better': False}
+        results[f'draw_frame.n={n}'] = {'value': measure(app.draw_frame, min_time) * 1e3,
+                                        'unit': 'ms/frame', 'higher_is_better': False}
+        # The vehicle layer alone from arrays, as drawn from worker state
+        xs, ys = app.track.lookup(positions_array, lanes_array)
+        velocities = np.fromiter((v.velocity for v in vehicles), np.float64, n)
+        colors = np.array([v.color for v in vehicles], dtype=np.uint8)
+        results[f'draw_vehicles.n={n}'] = {
+            'value': measure(lambda: app.renderer.draw(app.screen, xs, ys, colors, velocities,
+                                                       app.reference_speed), min_time) * 1e3,
+            'unit': 'ms/frame', 'higher_is_better': False}
+    pygame.quit()
+
+
+SUITES = {
+    'update': (bench_update, UPDATE_SIZES),
+    'lanes': (bench_lanes, LANE_SIZES),
+    'integrators': (bench_integrators, INTEGRATOR_SIZES),
+    'fleet': (bench_fleet, FLEET_SIZES),
+    'ensemble': (bench_ensemble, ENSEMBLE_SIZES),
+    'init': (bench_init, INIT_SIZES),
+    'neighbors': (bench_neighbors, NEIGHBOR_SIZES),
+    'speed_limits': (bench_speed_limits, ZONE_COUNTS),
+    'render': (bench_render, RENDER_SIZES),
+}
+
+
+def compare(results, baseline, threshold):
+    # List of (name, change) for benchmarks worse than baseline by more than
+    # threshold; change is the relative slowdown
+    regressions = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None or base['value'] <= 0:
+            continue
+        if result['higher_is_better']:
+            change = (base['value'] - result['value']) / base['value']
+        else:
+            change = (result['value'] - base['value']) / base['value']
+        if change > threshold:
+            regressions.append((name, change))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the simulation hot paths.")
+    parser.add_argument('--suite', action='append', choices=sorted(SUITES),
+                        help="run only these suites (repeatable)")
+    parser.add_argument('--filter', help="only record benchmarks whose name matches this glob")
+    parser.add_argument('--quick', action='store_true', help=f"sizes up to {QUICK_LIMIT} only")
+    parser.add_argument('--min-time', type=float, default=1.0, help="seconds spent per benchmark")
+    parser.add_argument('--output', help="write the results as JSON")
+    parser.add_argument('--save-baseline', help="write the results as the new baseline")
+    parser.add_argument('--baseline', help="compare against this baseline and fail on regressions")
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help="allowed relative slowdown before failing (default 0.25)")
+    args = parser.parse_args(argv)
+
+    results = {}
+    for name in args.suite or sorted(SUITES):
+        fn, sizes = SUITES[name]
+        if args.quick:
+            sizes = tuple(n for n in sizes if n <= QUICK_LIMIT)
+        fn(results, sizes, args.min_time)
+    if args.filter:
+        results = {k: v for k, v in results.items() if fnmatch.fnmatch(k, args.filter)}
+
+    for name, result in sorted(results.items()):
+        print(f"{name:40s} {result['value']:14.2f} {result['unit']}")
+
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'results': results,
+    }
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        for name, change in regressions:
+            print(f"REGRESSION {name}: {change:+.1%} vs baseline", file=sys.stderr)
+        if regressions:
+            return 1
+        print(f"no regressions beyond {args.threshold:.0%} against {args.baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
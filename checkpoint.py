@@ -0,0 +1,192 @@
+import struct
+import numpy as np
+from model import Vehicle, vehicle_type, INTEGRATORS, VEHICLE_TYPES
+from simulation import SimulationController
+from vectorized import VectorizedSimulationController, STATUS_COLORS, type_indices
+
+# Binary checkpoints of the full simulation state.
+#
+# Layout (little endian):
+#   MAGIC, HEADER
+#   zones    n_zones records of ZONE_DTYPE
+#   fleet    n_fleet records of FLEET_DTYPE, the model.fleet_mix table
+#   rng      625 uint32 words of the Mersenne Twister state
+#   vehicles n_vehicles records of VEHICLE_DTYPE, in self.vehicles order
+# Every section is a flat array, so loading is a few np.frombuffer calls
+# instead of unpickling one object per vehicle.
+
+MAGIC = b'SIMTRAF\x00'
+VERSION = 3
+
+ENGINE_CODES = {SimulationController: 0, VectorizedSimulationController: 1}
+ENGINE_TYPES = {code: cls for cls, code in ENGINE_CODES.items()}
+INTEGRATOR_CODES = {name: code for code, name in enumerate(INTEGRATORS)}
+INTEGRATOR_NAMES = {code: name for name, code in INTEGRATOR_CODES.items()}
+
+# version, engine, num_lanes, road_length, current_time, next_vehicle_id,
+# target_vehicle_count, base_desired_speed, n_zones, n_vehicles,
+# has_gauss_next, gauss_next, integrator, has_lane_scheduler,
+# lane scheduler interval, threshold and step, n_fleet (0 for cars only)
+HEADER = struct.Struct('<HBIddqqdIIBdBBddqI')
+
+ZONE_DTYPE = np.dtype([('start', '<f8'), ('end', '<f8'), ('limit', '<f8')])
+# Vehicle type name (a key of model.VEHICLE_TYPES) and cumulative share
+FLEET_DTYPE = np.dtype([('type', 'S16'), ('share', '<f8')])
+
+VEHICLE_DTYPE = np.dtype([
+    ('id', '<i8'),
+    ('position', '<f8'),
+    ('velocity', '<f8'),
+    ('acceleration', '<f8'),
+    ('lane', '<i4'),
+    ('desired_speed', '<f8'),
+    ('cooldown', '<f8'),
+    ('length', '<f8'),
+    ('width', '<f8'),
+    ('max_acceleration', '<f8'),
+    ('comfortable_deceleration', '<f8'),
+    ('min_gap', '<f8'),
+    ('time_headway', '<f8'),
+    ('color', 'u1', (3,)),
+])
+
+# Vectorized array name for each vehicle record field
+ARRAY_FIELDS = {
+    'id': 'ids',
+    'position': 'positions',
+    'velocity': 'velocities',
+    'acceleration': 'accelerations',
+    'lane': 'lanes',
+    'desired_speed': 'desired_speeds',
+    'cooldown': 'cooldowns',
+    'length': 'lengths',
+    'width': 'widths',
+    'max_acceleration': 'max_accelerations',
+    'comfortable_deceleration': 'comfortable_decelerations',
+    'min_gap': 'min_gaps',
+    'time_headway': 'time_headways',
+}
+
+RNG_WORDS = 625
+
+
+class CheckpointError(ValueError):
+    pass
+
+
+def _vehicle_records(sim):
+    if isinstance(sim, VectorizedSimulationController):
+        records = np.empty(sim.vehicle_count, dtype=VEHICLE_DTYPE)
+        for field, name in ARRAY_FIELDS.items():
+            records[field] = getattr(sim, name)
+        records['color'] = STATUS_COLORS[sim.status]
+        return records
+    rows = [(v.id, v.position, v.velocity, v.acceleration, v.lane, v.desired_speed,
+             v.cooldown, v.length, v.width, v.max_acceleration, v.comfortable_deceleration,
+             v.min_gap, v.time_headway, v.color) for v in sim.vehicles]
+    return np.array(rows, dtype=VEHICLE_DTYPE)
+
+
+def dumps(sim):
+    road = sim.road
+    zones = np.array([(z['start'], z['end'], z['limit']) for z in road.speed_limit_zones], dtype=ZONE_DTYPE)
+    version, words, gauss_next = sim.rng.getstate()
+    fleet = np.array([(t.name.encode(), acc) for acc, t in sim.fleet or ()], dtype=FLEET_DTYPE)
+    vehicles = _vehicle_records(sim)
+    scheduler = sim.lane_scheduler
+    header = HEADER.pack(
+        VERSION, ENGINE_CODES[type(sim)], road.num_lanes, road.length,
+        sim.current_time, sim.next_vehicle_id, sim.target_vehicle_count,
+        sim.base_desired_speed, len(zones), len(vehicles),
+        gauss_next is not None, gauss_next or 0.0, INTEGRATOR_CODES[sim.integrator],
+        scheduler is not None, scheduler.interval if scheduler else 0.0,
+        scheduler.threshold if scheduler else 0.0, scheduler.step if scheduler else 0, len(fleet))
+    return b''.join((MAGIC, header, zones.tobytes(), fleet.tobytes(),
+                     np.array(words, dtype='<u4').tobytes(), vehicles.tobytes()))
+
+
+def loads(data, engine=None):
+    # engine: controller class to restore into, default the one saved
+    if data[:len(MAGIC)] != MAGIC:
+        raise CheckpointError("not a simulation checkpoint")
+    offset = len(MAGIC)
+    # The version comes first in every header layout
+    version = struct.unpack_from('<H', data, offset)[0]
+    if version != VERSION:
+        raise CheckpointError(f"unsupported checkpoint version {version}")
+    (version, engine_code, num_lanes, road_length, current_time, next_vehicle_id,
+     target_vehicle_count, base_desired_speed, n_zones, n_vehicles,
+     has_gauss_next, gauss_next, integrator, has_lane_scheduler,
+     scheduler_interval, scheduler_threshold, scheduler_step, n_fleet) = HEADER.unpack_from(data, offset)
+    offset += HEADER.size
+
+    zones = np.frombuffer(data, dtype=ZONE_DTYPE, count=n_zones, offset=offset)
+    offset += zones.nbytes
+    fleet = np.frombuffer(data, dtype=FLEET_DTYPE, count=n_fleet, offset=offset)
+    offset += fleet.nbytes
+    words = np.frombuffer(data, dtype='<u4', count=RNG_WORDS, offset=offset)
+    offset += words.nbytes
+    vehicles = np.frombuffer(data, dtype=VEHICLE_DTYPE, count=n_vehicles, offset=offset)
+
+    cls = engine or ENGINE_TYPES[engine_code]
+    sim = cls(road_length=road_length, num_lanes=num_lanes, integrator=INTEGRATOR_NAMES[integrator])
+    if has_lane_scheduler:
+        scheduler = sim.enable_lane_change_scheduling(scheduler_interval)
+        scheduler.threshold = scheduler_threshold
+        scheduler.step = scheduler_step
+    for start, end, limit in zones.tolist():
+        sim.road.add_speed_limit_zone(start, end, limit)
+    sim.current_time = current_time
+    sim.next_vehicle_id = next_vehicle_id
+    sim.target_vehicle_count = target_vehicle_count
+    sim.base_desired_speed = base_desired_speed
+    if n_fleet:
+        # The saved table itself, not fleet_mix of shares recovered from it,
+        # so the cumulative shares are bit for bit the same
+        sim.fleet = [(acc, VEHICLE_TYPES[name.decode()]) for name, acc in fleet.tolist()]
+    sim.rng.setstate((3, tuple(words.tolist()), gauss_next if has_gauss_next else None))
+
+    if isinstance(sim, VectorizedSimulationController):
+        for field, name in ARRAY_FIELDS.items():
+            setattr(sim, name, vehicles[field].astype(getattr(sim, name).dtype))
+        status = np.zeros(n_vehicles, dtype=np.int8)
+        for code, color in enumerate(STATUS_COLORS):
+            status[(vehicles['color'] == color).all(axis=1)] = code
+        sim.status = status
+        sim.type_index = type_indices(*(vehicles[field] for field in (
+            'length', 'width', 'max_acceleration', 'comfortable_deceleration', 'min_gap', 'time_headway')))
+    else:
+        sim.vehicles = [_restore_vehicle(row) for row in vehicles.tolist()]
+        sim.lane_index.rebuild(sim.vehicles)
+    return sim
+
+
+def _restore_vehicle(row):
+    (id, position, velocity, acceleration, lane, desired_speed, cooldown, length, width,
+     max_acceleration, comfortable_deceleration, min_gap, time_headway, color) = row
+    v = Vehicle(id, position, lane, desired_speed,
+                vehicle_type(length, width, max_acceleration, comfortable_deceleration, min_gap, time_headway))
+    v.velocity = velocity
+    v.acceleration = acceleration
+    v.cooldown = cooldown
+    v.color = tuple(color)
+    return v
+
+
+def save(sim, path):
+    with open(path, 'wb') as f:
+        f.write(dumps(sim))
+
+
+def load(path, engine=None):
+    with open(path, 'rb') as f:
+        return loads(f.read(), engine)
+
+
+def fork(sim, seed=None):
+    # Independent copy of sim; with a seed the copy draws its own random
+    # numbers from then on, so forks of one warm state diverge.
+    branch = loads(dumps(sim))
+    if seed is not None:
+        branch.rng.seed(seed)
+    return branch
@@ -0,0 +1,216 @@
+import argparse
+import json
+import multiprocessing as mp
+import queue
+import sys
+import time
+from network import NetworkSimulation, corridor
+
+# Domain decomposition of a RoadNetwork across worker processes.
+#
+#   python decomposition.py --sections 24 --workers 4 --duration 600
+#
+# Each worker owns a contiguous group of segments and runs NetworkSimulation
+# on them. Per step it exchanges, with the workers owning neighboring
+# segments only, two small messages each way:
+#   1. boundary data: its vehicles within REACH of a joint with them
+#   2. migrants: its vehicles that crossed into their segments
+# Workers run in lockstep through these exchanges; the parent only hands out
+# work and collects statistics. Results match a single-process run with the
+# same seed.
+
+RESULT_TIMEOUT = 1.0 # seconds between liveness checks while waiting
+
+
+def partition(network, parts):
+    # Owner of each segment: contiguous runs of segments (in the order they
+    # were added) with about the same lane-meters each
+    costs = [s.length * s.num_lanes for s in network.segments]
+    target = sum(costs) / parts
+    owners = []
+    part = 0
+    acc = 0.0
+    for cost in costs:
+        if acc >= target * (part + 1) and part < parts - 1:
+            part += 1
+        owners.append(part)
+        acc += cost
+    return owners
+
+
+def _consumer(network, owners, key):
+    # Worker that needs a piece of boundary data
+    kind, c = key
+    connection = network.connections[c]
+    return owners[connection.source] if kind == 'ahead' else owners[connection.target]
+
+
+def _exchange(outgoing, links):
+    # Send one message to every neighbor, then wait for one from each.
+    # Queues buffer, so nobody blocks on a send.
+    for part, (send, _) in links.items():
+        send.put(outgoing.get(part))
+    return [recv.get() for _, recv in links.values()]
+
+
+def run_worker(network, owners, part, seed, base_desired_speed, links, control, results):
+    owned = [i for i, owner in enumerate(owners) if owner == part]
+    sim = NetworkSimulation(network, seed, owned, base_desired_speed)
+    while True:
+        command = control.get()
+        if command[0] == 'stop':
+            break
+        if command[0] == 'vehicles':
+            results.put((part, [(v.id, v.position, v.velocity, v.lane)
+                                for v in sorted(sim.vehicles(), key=lambda v: v.id)]))
+            continue
+        _, steps, dt = command
+        for _ in range(steps):
+            sim.begin_step(dt)
+            data = sim.boundary()
+            outgoing = {}
+            for key, value in data.items():
+                consumer = _consumer(network, owners, key)
+                if consumer != part:
+                    outgoing.setdefault(consumer, {})[key] = value
+            for received in _exchange(outgoing, links):
+                if received:
+                    data.update(received)
+
+            migrants = sim.step(dt, data)
+            local = []
+            outgoing = {}
+            for m in migrants:
+                owner = owners[m[0]]
+                if owner == part:
+                    local.append(m)
+                else:
+                    outgoing.setdefault(owner, []).append(m)
+            for received in _exchange(outgoing, links):
+                if received:
+                    local.extend(received)
+            sim.arrive(local)
+        results.put((part, sim.stats()))
+
+
+class ParallelNetworkSimulation:
+    def __init__(self, network, workers, seed=None, base_desired_speed=30, owners=None):
+        self.network = network
+        self.owners = owners if owners is not None else partition(network, workers)
+        self.workers = max(self.owners) + 1
+        self.current_time = 0
+        ctx = mp.get_context('spawn')
+
+        # One queue per direction between partitions sharing a connection.
+        # Kept on self: the children attach to them after start() returns.
+        self.links = links = [dict() for _ in range(self.workers)]
+        for c in network.connections:
+            a, b = self.owners[c.source], self.owners[c.target]
+            if a != b and b not in links[a]:
+                ab, ba = ctx.Queue(), ctx.Queue()
+                links[a][b] = (ab, ba)
+                links[b][a] = (ba, ab)
+
+        self.results = ctx.Queue()
+        self.controls = [ctx.Queue() for _ in range(self.workers)]
+        self.processes = [
+            ctx.Process(target=run_worker, name=f'network-worker-{part}', daemon=True,
+                        args=(network, self.owners, part, seed, base_desired_speed,
+                              links[part], self.controls[part], self.results))
+            for part in range(self.workers)]
+        for process in self.processes:
+            process.start()
+
+    def _gather(self):
+        replies = {}
+        while len(replies) < self.workers:
+            try:
+                part, reply = self.results.get(timeout=RESULT_TIMEOUT)
+            except queue.Empty:
+                if not all(p.is_alive() for p in self.processes):
+                    self.close()
+                    raise RuntimeError("a network worker process died")
+                continue
+            replies[part] = reply
+        return [replies[part] for part in range(self.workers)]
+
+    def run(self, steps, dt):
+        # Advance every partition by steps * dt; returns the combined stats
+        for control in self.controls:
+            control.put(('run', steps, dt))
+        stats = self._gather()
+        self.current_time = stats[0]['time']
+        merged = {'time': self.current_time}
+        for key in ('vehicles', 'speed_sum', 'spawned', 'exited', 'pending'):
+            merged[key] = sum(s[key] for s in stats)
+        return merged
+
+    def vehicles(self):
+        # (id, position, velocity, lane) of every vehicle, sorted by id
+        for control in self.controls:
+            control.put(('vehicles',))
+        return sorted(row for rows in self._gather() for row in rows)
+
+    def close(self):
+        for control, process in zip(self.controls, self.processes):
+            if process.is_alive():
+                control.put(('stop',))
+        for process in self.processes:
+            process.join(5.0)
+            if process.is_alive():
+                process.terminate()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate a motorway corridor, optionally split across processes.")
+    parser.add_argument('--sections', type=int, default=12, help="on/off-ramp pairs along the corridor")
+    parser.add_argument('--lanes', type=int, default=3)
+    parser.add_argument('--inflow', type=float, default=3600.0, help="mainline demand (veh/h)")
+    parser.add_argument('--ramp-inflow', type=float, default=600.0, help="demand per on-ramp (veh/h)")
+    parser.add_argument('--speed', type=float, default=120, help="base desired speed (km/h)")
+    parser.add_argument('--workers', type=int, default=1, help="processes (1 runs in this process)")
+    parser.add_argument('--duration', type=float, default=600.0, help="simulated seconds")
+    parser.add_argument('--dt', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="write the metrics as JSON to this file")
+    args = parser.parse_args(argv)
+
+    network = corridor(args.sections, args.lanes, inflow=args.inflow, ramp_inflow=args.ramp_inflow)
+    steps = int(round(args.duration / args.dt))
+    wall_start = time.perf_counter()
+    if args.workers > 1:
+        sim = ParallelNetworkSimulation(network, args.workers, args.seed, args.speed / 3.6)
+        try:
+            stats = sim.run(steps, args.dt)
+        finally:
+            sim.close()
+    else:
+        sim = NetworkSimulation(network, args.seed, base_desired_speed=args.speed / 3.6)
+        for _ in range(steps):
+            sim.update(args.dt)
+        stats = sim.stats()
+    wall = time.perf_counter() - wall_start
+
+    metrics = {
+        'simulated_time': stats['time'],
+        'segments': len(network.segments),
+        'workers': args.workers,
+        'vehicles': stats['vehicles'],
+        'spawned': stats['spawned'],
+        'exited': stats['exited'],
+        'waiting_at_sources': stats['pending'],
+        'mean_speed_kmh': stats['speed_sum'] / stats['vehicles'] * 3.6 if stats['vehicles'] else 0.0,
+        'throughput_veh_h': stats['exited'] / stats['time'] * 3600 if stats['time'] else 0.0,
+        'wall_time': wall,
+        'speedup': stats['time'] / wall if wall > 0 else float('inf'),
+    }
+    for key, value in metrics.items():
+        print(f"{key}: {value:.4f}" if isinstance(value, float) else f"{key}: {value}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(metrics, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
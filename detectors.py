@@ -0,0 +1,218 @@
+import numpy as np
+
+# Virtual loop detectors and a time-space speed heatmap, updated as the
+# simulation runs instead of from recorded trajectories afterwards.
+#
+# The controller calls TrafficMonitor.begin_step once the vehicles of a step
+# are in place, and observe at the end of the update. begin_step keeps where
+# each vehicle row starts the step and nothing else, so the memory follows
+# the vehicle count, not every id ever seen. A vehicle crossed a detector
+# when the detector lies in the stretch it travelled. Crossings only add to
+# per-detector accumulators; every `interval` seconds these are turned into
+# one row of flow, occupancy, space-mean speed and density and appended to a
+# fixed-size ring buffer.
+# The heatmap bins the road every `bin_length` metres and adds up, per bin,
+# the distance travelled and the time spent by the vehicles in it (Edie's
+# definitions): speed is distance over time and density time over area.
+
+DEFAULT_INTERVAL = 60.0 # seconds aggregated into each row
+DEFAULT_BIN_LENGTH = 100.0 # metres per heatmap bin
+DEFAULT_CAPACITY = 1440 # rows kept: a day of minutes
+
+# Columns of each detector row
+DETECTOR_COLUMNS = ('time', 'flow_veh_h', 'occupancy', 'speed_kmh', 'density_veh_km')
+
+
+class RingBuffer:
+    # The last `capacity` rows of a fixed width, oldest overwritten first
+    def __init__(self, capacity, width):
+        self.data = np.full((capacity, width), np.nan)
+        self.capacity = capacity
+        self.head = 0 # next row to write
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, row):
+        self.data[self.head] = row
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def values(self):
+        # Rows in chronological order (a copy)
+        if self.count < self.capacity:
+            return self.data[:self.count].copy()
+        return np.concatenate((self.data[self.head:], self.data[:self.head]))
+
+
+def _positions(sim):
+    # A copy of the current positions, in row order, for either engine
+    if hasattr(sim, 'vehicles'):
+        return np.fromiter((v.position for v in sim.vehicles), np.float64, len(sim.vehicles))
+    return sim.positions.copy()
+
+
+def _vehicle_columns(sim):
+    # (positions, lanes, lengths) for either engine
+    if hasattr(sim, 'vehicles'):
+        vehicles = sim.vehicles
+        return (np.fromiter((v.position for v in vehicles), np.float64, len(vehicles)),
+                np.fromiter((v.lane for v in vehicles), np.int64, len(vehicles)),
+                np.fromiter((v.length for v in vehicles), np.float64, len(vehicles)))
+    return sim.positions, sim.lanes, sim.lengths
+
+
+class TrafficMonitor:
+    def __init__(self, road_length, num_lanes, detectors=(), interval=DEFAULT_INTERVAL,
+                 bin_length=DEFAULT_BIN_LENGTH, capacity=DEFAULT_CAPACITY, start_time=0.0):
+        # detectors: positions along the road, or (position, lane) pairs for
+        # a detector on a single lane. Flow and density of a detector on
+        # every lane add up all lanes; occupancy is the mean per lane.
+        self.road_length = road_length
+        self.interval = interval
+        self.bin_length = bin_length
+        self.interval_end = start_time + interval
+
+        positions = []
+        lanes = []
+        for detector in detectors:
+            position, lane = detector if isinstance(detector, tuple) else (detector, None)
+            if not 0 <= position < road_length:
+                raise ValueError(f"detector position {position} outside the road")
+            positions.append(float(position))
+            if lane is not None and not 0 <= lane < num_lanes:
+                raise ValueError(f"detector lane {lane} does not exist")
+            lanes.append(-1 if lane is None else int(lane)) # -1: every lane
+        self.detector_positions = np.array(positions, dtype=np.float64)
+        self.detector_lanes = np.array(lanes, dtype=np.int64)
+        # Sorted positions, twice around the ring, for the crossing search
+        self._lanes_covered = np.where(self.detector_lanes < 0, num_lanes, 1)
+        self._order = np.argsort(self.detector_positions, kind='stable')
+        ordered = self.detector_positions[self._order]
+        self._search = np.concatenate((ordered, ordered + road_length))
+
+        k = len(positions)
+        self._count = np.zeros(k)
+        self._inverse_speed = np.zeros(k) # sum of 1/v, for the harmonic mean
+        self._occupied = np.zeros(k) # seconds a vehicle was over the detector
+        self.detector_rows = RingBuffer(capacity, k * len(DETECTOR_COLUMNS))
+
+        self.num_bins = max(1, int(np.ceil(road_length / bin_length)))
+        # The last bin ends with the road
+        self.bin_widths = np.minimum(bin_length, road_length - np.arange(self.num_bins) * bin_length)
+        self._distance = np.zeros(self.num_bins)
+        self._time = np.zeros(self.num_bins)
+        self.heatmap_times = RingBuffer(capacity, 1)
+        self.heatmap_speeds = RingBuffer(capacity, self.num_bins)
+        self.heatmap_densities = RingBuffer(capacity, self.num_bins)
+
+        # Row positions at the start of the step being observed
+        self._before = None
+
+    def begin_step(self, sim):
+        # Called by the controller before any vehicle moves; the rows keep
+        # their order until observe
+        self._before = _positions(sim)
+
+    def observe(self, sim, dt):
+        # Called by the controller at the end of each update
+        before, self._before = self._before, None
+        self.observe_step(sim.current_time, dt, before, *_vehicle_columns(sim))
+
+    def observe_step(self, time, dt, before, positions, lanes, lengths):
+        # before: the positions at the start of the step, row by row, or None
+        # when they were not taken (a step observed without begin_step)
+        if before is not None and len(positions):
+            travelled = positions - before
+            travelled = np.where(travelled < 0, travelled + self.road_length, travelled)
+            if len(self._order):
+                self._detect(before, travelled, lanes, lengths, dt)
+            self._bin(before, travelled, dt)
+        while time >= self.interval_end - 1e-9:
+            self._flush()
+            self.interval_end += self.interval
+
+    def _detect(self, before, travelled, lanes, lengths, dt):
+        # Detectors in (before, before + travelled]: usually none, one at most
+        # per vehicle unless detectors are closer than a step's travel
+        k = len(self._order)
+        first = np.searchsorted(self._search, before, side='right')
+        last = np.searchsorted(self._search, before + travelled, side='right')
+        crossings = last - first
+        total = int(crossings.sum())
+        if total == 0:
+            return
+        vehicle = np.repeat(np.arange(len(before)), crossings)
+        # Running index of each crossing within its vehicle
+        starts = np.cumsum(crossings) - crossings
+        within = np.arange(total) - np.repeat(starts, crossings)
+        detector = self._order[(np.repeat(first, crossings) + within) % k]
+        lane = self.detector_lanes[detector]
+        hit = (lane < 0) | (lane == lanes[vehicle])
+        detector, vehicle = detector[hit], vehicle[hit]
+        speed = travelled[vehicle] / dt
+        np.add.at(self._count, detector, 1.0)
+        np.add.at(self._inverse_speed, detector, 1.0 / speed)
+        np.add.at(self._occupied, detector, lengths[vehicle] / speed)
+
+    def _bin(self, before, travelled, dt):
+        bins = np.minimum((before // self.bin_length).astype(np.int64), self.num_bins - 1)
+        self._distance += np.bincount(bins, weights=travelled, minlength=self.num_bins)
+        self._time += np.bincount(bins, minlength=self.num_bins) * dt
+
+    def _flush(self):
+        count = self._count
+        with np.errstate(divide='ignore', invalid='ignore'):
+            flow = count * 3600.0 / self.interval
+            occupancy = np.minimum(self._occupied / (self.interval * self._lanes_covered), 1.0)
+            speed = np.where(count > 0, count / self._inverse_speed, np.nan) * 3.6
+            density = flow / speed
+            rows = np.column_stack((np.full(len(count), self.interval_end), flow, occupancy, speed, density))
+            self.detector_rows.append(rows.ravel())
+            self.heatmap_times.append((self.interval_end,))
+            self.heatmap_speeds.append(np.where(self._time > 0, self._distance / self._time, np.nan) * 3.6)
+            self.heatmap_densities.append(self._time / (self.interval * self.bin_widths) * 1000.0)
+        count[:] = 0
+        self._inverse_speed[:] = 0
+        self._occupied[:] = 0
+        self._distance[:] = 0
+        self._time[:] = 0
+
+    def detector_series(self, index):
+        # {column: array} over the rows kept for detector `index`
+        width = len(DETECTOR_COLUMNS)
+        values = self.detector_rows.values()[:, index * width:(index + 1) * width]
+        return {name: values[:, i] for i, name in enumerate(DETECTOR_COLUMNS)}
+
+    def heatmap(self):
+        # (times, speeds, densities): interval end times, and km/h and
+        # veh/km per bin, one row per interval
+        return (self.heatmap_times.values()[:, 0], self.heatmap_speeds.values(),
+                self.heatmap_densities.values())
+
+    def summary(self, since=0.0):
+        # Per detector means over the intervals ending after `since`
+        result = []
+        for i in range(len(self.detector_positions)):
+            series = self.detector_series(i)
+            keep = series['time'] > since
+            lane = int(self.detector_lanes[i])
+            entry = {'position': float(self.detector_positions[i]), 'lane': None if lane < 0 else lane,
+                     'intervals': int(keep.sum())}
+            for name in DETECTOR_COLUMNS[1:]:
+                values = series[name][keep]
+                values = values[~np.isnan(values)]
+                entry[name] = float(values.mean()) if len(values) else None
+            result.append(entry)
+        return result
+
+    def save(self, path):
+        # Ring buffer contents as a .npz archive
+        times, speeds, densities = self.heatmap()
+        series = {f'detector{i}_{name}': values
+                  for i in range(len(self.detector_positions))
+                  for name, values in self.detector_series(i).items()}
+        np.savez(path, detector_positions=self.detector_positions, detector_lanes=self.detector_lanes,
+                 heatmap_times=times, heatmap_speed_kmh=speeds, heatmap_density_veh_km=densities,
+                 bin_length=self.bin_length, **series)
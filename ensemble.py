@@ -0,0 +1,229 @@
+import random
+import time
+import numpy as np
+import detectors
+from model import Road, equilibrium_layout
+from vectorized import VectorizedSimulationController, FIELDS
+
+# K independent replicas of one scenario advanced together.
+#
+# The replicas share the road (length, speed limit zones) and parameters;
+# each has its own random stream, vehicles and ids. They live in a single
+# VectorizedSimulationController state where replica r owns lanes
+# r * num_lanes .. (r + 1) * num_lanes - 1. Neighbor lookups and the ring
+# wrap never leave a lane and _adjacent stops at the replica's outer lanes,
+# so nothing crosses between replicas: one batched step moves every replica
+# exactly as if it ran alone with its seed, for the interpreter overhead of
+# a single run. Monitoring keeps one TrafficMonitor per replica.
+#   sim = EnsembleSimulationController(32, seeds=range(32))
+#   sim.set_target_vehicle_count(150)
+#   metrics = sim.step(1 / 60)  # {'mean_speed_kmh': array of 32, ...}
+
+
+class ReplicaMonitors:
+    # One TrafficMonitor per replica, each fed only the rows of its replica
+    # with their own lanes, so it sees what the replica would alone
+    def __init__(self, monitors, lanes_per_replica):
+        self.monitors = monitors
+        self.lanes_per_replica = lanes_per_replica
+        self._before = None
+
+    def __getitem__(self, r):
+        return self.monitors[r]
+
+    def __len__(self):
+        return len(self.monitors)
+
+    def begin_step(self, sim):
+        self._before = sim.positions.copy()
+
+    def observe(self, sim, dt):
+        before, self._before = self._before, None
+        replica = sim.lanes // self.lanes_per_replica
+        # Rows grouped by replica, each group still in position order
+        order = np.argsort(replica, kind='stable')
+        bounds = np.searchsorted(replica[order], np.arange(len(self.monitors) + 1))
+        for r, monitor in enumerate(self.monitors):
+            rows = order[bounds[r]:bounds[r + 1]]
+            monitor.observe_step(sim.current_time, dt, None if before is None else before[rows],
+                                 sim.positions[rows], sim.lanes[rows] - r * self.lanes_per_replica,
+                                 sim.lengths[rows])
+
+
+class EnsembleSimulationController(VectorizedSimulationController):
+    def __init__(self, replicas, road_length=2000, seeds=None, num_lanes=2, integrator='euler'):
+        super().__init__(road_length, None, num_lanes * replicas, integrator)
+        seeds = list(range(replicas)) if seeds is None else list(seeds)
+        if len(seeds) != replicas:
+            raise ValueError(f"{len(seeds)} seeds for {replicas} replicas")
+        self.replicas = replicas
+        self.lanes_per_replica = num_lanes
+        self.seeds = seeds
+        self.rngs = [random.Random(seed) for seed in seeds]
+        self.rng = None # one stream per replica instead
+        self.next_vehicle_ids = np.zeros(replicas, dtype=np.int64)
+        self.target_vehicle_counts = np.zeros(replicas, dtype=np.int64)
+
+    def enable_monitoring(self, positions=(), interval=detectors.DEFAULT_INTERVAL,
+                          bin_length=detectors.DEFAULT_BIN_LENGTH, capacity=detectors.DEFAULT_CAPACITY):
+        # The same detectors on every replica, lanes numbered within the
+        # replica; monitor[r] is the detectors.TrafficMonitor of replica r
+        self.monitor = ReplicaMonitors([
+            detectors.TrafficMonitor(self.road.length, self.lanes_per_replica, positions, interval,
+                                     bin_length, capacity, start_time=self.current_time)
+            for _ in range(self.replicas)], self.lanes_per_replica)
+        return self.monitor
+
+    def replica_of(self):
+        # Replica of each vehicle row
+        return self.lanes // self.lanes_per_replica
+
+    def replica_counts(self):
+        return np.bincount(self.replica_of(), minlength=self.replicas)
+
+    def set_target_vehicle_count(self, count, immediate=False):
+        # One count for every replica, or one per replica. immediate keeps
+        # only the first rows of each replica up to its count.
+        self.target_vehicle_counts[:] = count
+        self.target_vehicle_count = int(self.target_vehicle_counts.sum())
+        if immediate:
+            replica = self.replica_of()
+            counts = np.bincount(replica, minlength=self.replicas)
+            starts = np.cumsum(counts) - counts
+            order = np.argsort(replica, kind='stable')
+            rank = np.empty(self.vehicle_count, dtype=np.int64)
+            rank[order] = np.arange(self.vehicle_count) - starts[replica[order]]
+            self._reorder(rank < self.target_vehicle_counts[replica])
+
+    def populate(self, count=None, perturbation=0.0):
+        # Each replica as VectorizedSimulationController.populate with its
+        # own stream; count is one for all or one per replica
+        if count is not None:
+            self.set_target_vehicle_count(count)
+        self._despawn_last(self.vehicle_count)
+        size = self.lanes_per_replica
+        road = Road(self.road.length, num_lanes=size)
+        for r, rng in enumerate(self.rngs):
+            layout = equilibrium_layout(rng, int(self.target_vehicle_counts[r]), road,
+                                        self.base_desired_speed, self.fleet, perturbation)
+            self._append_columns(self._layout_columns(layout, int(self.next_vehicle_ids[r]), r * size))
+            self.next_vehicle_ids[r] += len(layout)
+
+    def _adjacent(self, offset):
+        target = self.lanes + offset
+        size = self.lanes_per_replica
+        return target, (target >= 0) & (target // size == self.lanes // size)
+
+    def _spawn_despawn(self):
+        # One vehicle in or out per replica and step, like a single run
+        counts = self.replica_counts()
+        over = np.nonzero(counts > self.target_vehicle_counts)[0]
+        if len(over):
+            # Drop the last row of each of those replicas
+            last = np.full(self.replicas, -1)
+            np.maximum.at(last, self.replica_of(), np.arange(self.vehicle_count))
+            keep = np.ones(self.vehicle_count, dtype=bool)
+            keep[last[over]] = False
+            self._reorder(keep)
+        rows = []
+        size = self.lanes_per_replica
+        for r in np.nonzero(counts < self.target_vehicle_counts)[0]:
+            row = self._draw_vehicle(self.rngs[r], int(self.next_vehicle_ids[r]), r * size, size)
+            if row is not None:
+                self.next_vehicle_ids[r] += 1
+                rows.append(row)
+        if rows:
+            self._append_rows(rows)
+
+    def step(self, dt):
+        # Advance every replica by dt and return metrics()
+        self.update(dt)
+        return self.metrics()
+
+    def metrics(self):
+        # Per replica arrays: vehicles, mean speed (km/h), density (veh/km,
+        # all lanes), flow (veh/h) and fraction of stopped vehicles, the
+        # quantities headless.run samples
+        replica = self.replica_of()
+        counts = np.bincount(replica, minlength=self.replicas)
+        present = np.maximum(counts, 1)
+        mean_speed = np.bincount(replica, weights=self.velocities, minlength=self.replicas) / present
+        density = counts / (self.road.length / 1000.0)
+        stopped = np.bincount(replica, weights=self.velocities < 2, minlength=self.replicas) / present
+        return {
+            'vehicles': counts,
+            'mean_speed_kmh': mean_speed * 3.6,
+            'density_veh_km': density,
+            'flow_veh_h': density * mean_speed * 3.6,
+            'stopped_fraction': stopped,
+        }
+
+    def replica(self, r):
+        # Standalone VectorizedSimulationController with the state of
+        # replica r, e.g. to checkpoint or keep running it alone
+        sim = VectorizedSimulationController(self.road.length, num_lanes=self.lanes_per_replica,
+                                             integrator=self.integrator)
+        sim.rng.setstate(self.rngs[r].getstate())
+        for zone in self.road.speed_limit_zones:
+            sim.road.add_speed_limit_zone(zone['start'], zone['end'], zone['limit'])
+        sim.current_time = self.current_time
+        sim.next_vehicle_id = int(self.next_vehicle_ids[r])
+        sim.target_vehicle_count = int(self.target_vehicle_counts[r])
+        sim.base_desired_speed = self.base_desired_speed
+        sim.fleet = self.fleet
+        if self.lane_scheduler is not None:
+            sim.enable_lane_change_scheduling(self.lane_scheduler.interval).step = self.lane_scheduler.step
+        rows = self.replica_of() == r
+        for name, _ in FIELDS:
+            setattr(sim, name, getattr(self, name)[rows])
+        sim.lanes = sim.lanes - r * self.lanes_per_replica
+        return sim
+
+
+def build_ensemble(replicas, road_length, vehicles=40, speed_kmh=120, zones=(), seeds=None,
+                   num_lanes=2, integrator='euler'):
+    # headless.build_controller for an ensemble: replica r matches the
+    # vectorized run with seed seeds[r]
+    sim = EnsembleSimulationController(replicas, road_length, seeds, num_lanes, integrator)
+    sim.set_target_vehicle_count(vehicles)
+    sim.set_base_desired_speed(speed_kmh / 3.6)
+    for start, end, limit_kmh in zones:
+        sim.road.add_speed_limit_zone(start, end, limit_kmh / 3.6)
+    return sim
+
+
+def run(sim, duration, dt, warmup=0.0, sample_interval=1.0):
+    # headless.run for every replica: a list with one metrics dict per
+    # replica. wall_time is the shared wall time split evenly.
+    steps = int(round(duration / dt))
+    warmup_steps = int(round(warmup / dt))
+    sample_every = max(1, int(round(sample_interval / dt)))
+    names = ('mean_speed_kmh', 'density_veh_km', 'flow_veh_h', 'stopped_fraction')
+    sums = {name: np.zeros(sim.replicas) for name in names}
+    samples = 0
+
+    wall_start = time.perf_counter()
+    for step in range(1, steps + 1):
+        sim.update(dt)
+        if step <= warmup_steps or (step - warmup_steps) % sample_every:
+            continue
+        metrics = sim.metrics()
+        for name in names:
+            sums[name] += metrics[name]
+        samples += 1
+    wall_time = (time.perf_counter() - wall_start) / sim.replicas
+
+    simulated = steps * dt
+    n = max(samples, 1)
+    vehicles = sim.replica_counts()
+    return [{
+        'simulated_time': simulated,
+        'steps': steps,
+        'dt': dt,
+        'warmup': warmup,
+        'samples': samples,
+        'vehicles': int(vehicles[r]),
+        **{name: float(sums[name][r] / n) for name in names},
+        'wall_time': wall_time,
+        'speedup': simulated / wall_time if wall_time > 0 else float('inf'),
+    } for r in range(sim.replicas)]
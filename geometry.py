@@ -0,0 +1,85 @@
+import math
+import numpy as np
+
+# Mapping from linear road position to screen coordinates on the oval track.
+# Kept free of pygame so it can be used (and benchmarked) headless.
+#
+# Centerline definition:
+#   Top Straight: [0, S]              left to right at y = -r
+#   Right Curve:  [S, S + pi*R]       angle -pi/2 .. pi/2
+#   Bot Straight: [S + pi*R, 2S + pi*R]  right to left at y = r
+#   Left Curve:   [2S + pi*R, 2S + 2pi*R] angle pi/2 .. 3pi/2
+# Lane offset k draws at radius R + k * lane_width; the logical length is the
+# centerline one for every lane. A road of another length (road_length) is
+# scaled to fit the oval; positions passed in are road positions.
+
+
+class OvalTrack:
+    def __init__(self, center_x, center_y, straight_length, radius, lane_width=15,
+                 num_lanes=2, resolution=0.5, road_length=None):
+        self.center_x = center_x
+        self.center_y = center_y
+        self.straight_length = straight_length
+        self.radius = radius
+        self.lane_width = lane_width
+        self.length = 2 * (straight_length + math.pi * radius)
+        self.road_length = self.length if road_length is None else road_length
+        self.scale = self.length / self.road_length # screen length per road metre
+        self.resolution = resolution
+        self._build_table(num_lanes)
+
+    def point(self, linear_pos, lane_offset):
+        # Exact (x, y) for one position
+        return self._point(linear_pos * self.scale, lane_offset)
+
+    def _point(self, p, lane_offset):
+        # (x, y) at p along the centerline
+        r = self.radius + lane_offset * self.lane_width
+        s_len = self.straight_length
+        arc_len = math.pi * self.radius
+        cx, cy = self.center_x, self.center_y
+
+        if p < s_len:
+            return cx - s_len / 2 + p, cy - r
+        p -= s_len
+        if p < arc_len:
+            angle = -math.pi / 2 + p / arc_len * math.pi
+            return cx + s_len / 2 + math.cos(angle) * r, cy + math.sin(angle) * r
+        p -= arc_len
+        if p < s_len:
+            return cx + s_len / 2 - p, cy + r
+        p -= s_len
+        angle = math.pi / 2 + p / arc_len * math.pi
+        return cx - s_len / 2 + math.cos(angle) * r, cy + math.sin(angle) * r
+
+    def _build_table(self, num_lanes):
+        # One row of samples per lane every `resolution` meters, plus one
+        # past the end so interpolation never reads out of bounds
+        samples = int(math.ceil(self.length / self.resolution)) + 2
+        positions = np.arange(samples) * self.resolution
+        self.xs = np.empty((num_lanes, samples))
+        self.ys = np.empty((num_lanes, samples))
+        for lane in range(num_lanes):
+            for k, p in enumerate(positions.tolist()):
+                self.xs[lane, k], self.ys[lane, k] = self._point(p, lane)
+
+    def lookup(self, positions, lanes):
+        # Batched (xs, ys) for arrays of positions and lane offsets, by linear
+        # interpolation in the precomputed table
+        positions = np.clip(np.asarray(positions, dtype=np.float64) * self.scale, 0.0, self.length)
+        lanes = np.asarray(lanes, dtype=np.int64)
+        scaled = positions / self.resolution
+        i = scaled.astype(np.int64)
+        frac = scaled - i
+        xs = self.xs[lanes, i] * (1 - frac) + self.xs[lanes, i + 1] * frac
+        ys = self.ys[lanes, i] * (1 - frac) + self.ys[lanes, i + 1] * frac
+        return xs, ys
+
+    def polyline(self, start, end, lane_offset, step=5.0):
+        # Screen points along [start, end] (wrapping past the end of the road)
+        # (step in screen length)
+        if end < start:
+            end += self.road_length
+        count = max(2, int((end - start) * self.scale / step) + 1)
+        return [self.point((start + (end - start) * k / (count - 1)) % self.road_length, lane_offset)
+                for k in range(count)]
@@ -0,0 +1,279 @@
+import argparse
+import json
+import math
+import sys
+import time
+import numpy as np
+import checkpoint
+import detectors
+from recorder import TrajectoryRecorder
+from model import INTEGRATORS
+from scenario import Scenario, ScenarioPlayer
+from simulation import SimulationController
+from vectorized import VectorizedSimulationController
+
+# Headless batch runner: fixed dt, no display, no pygame.
+#   python headless.py --duration 3600 --dt 0.05 --vehicles 150 --output metrics.json
+
+# Same oval as main.py
+DEFAULT_ROAD_LENGTH = 2 * (800 + math.pi * 150)
+DEFAULT_VEHICLES = 40
+DEFAULT_SPEED_KMH = 120
+
+ENGINES = {
+    'object': SimulationController,
+    'vectorized': VectorizedSimulationController,
+}
+
+
+def vehicle_state(sim):
+    # (positions, velocities, lanes) arrays for either engine
+    if hasattr(sim, 'vehicles'):
+        vehicles = sim.vehicles
+        return (np.array([v.position for v in vehicles], dtype=np.float64),
+                np.array([v.velocity for v in vehicles], dtype=np.float64),
+                np.array([v.lane for v in vehicles], dtype=np.int64))
+    return sim.positions, sim.velocities, sim.lanes
+
+
+def build_controller(engine='object', road_length=DEFAULT_ROAD_LENGTH, vehicles=DEFAULT_VEHICLES,
+                     speed_kmh=DEFAULT_SPEED_KMH, zones=(), seed=None, num_lanes=2, integrator='euler'):
+    sim = ENGINES[engine](road_length=road_length, seed=seed, num_lanes=num_lanes, integrator=integrator)
+    sim.set_target_vehicle_count(vehicles)
+    sim.set_base_desired_speed(speed_kmh / 3.6)
+    for start, end, limit_kmh in zones:
+        sim.road.add_speed_limit_zone(start, end, limit_kmh / 3.6)
+    return sim
+
+
+def run(sim, duration, dt, warmup=0.0, sample_interval=1.0, schedule=None):
+    # Advance sim for duration simulated seconds and return aggregate
+    # metrics sampled every sample_interval seconds after the warm-up.
+    # schedule: a scenario.ScenarioPlayer, played before each step.
+    steps = int(round(duration / dt))
+    warmup_steps = int(round(warmup / dt))
+    sample_every = max(1, int(round(sample_interval / dt)))
+    road_km = sim.road.length / 1000.0
+
+    speed_sum = 0.0
+    density_sum = 0.0
+    flow_sum = 0.0
+    stopped_sum = 0.0
+    samples = 0
+
+    wall_start = time.perf_counter()
+    for step in range(1, steps + 1):
+        if schedule is not None:
+            schedule.advance(sim, sim.current_time)
+        sim.update(dt)
+        if step <= warmup_steps or (step - warmup_steps) % sample_every:
+            continue
+        _, velocities, _ = vehicle_state(sim)
+        count = len(velocities)
+        mean_speed = float(velocities.mean()) if count else 0.0
+        density = count / road_km # veh/km, all lanes
+        speed_sum += mean_speed
+        density_sum += density
+        flow_sum += density * mean_speed * 3.6 # veh/h
+        stopped_sum += float((velocities < 2).mean()) if count else 0.0
+        samples += 1
+    wall_time = time.perf_counter() - wall_start
+
+    simulated = steps * dt
+    n = max(samples, 1)
+    return {
+        'simulated_time': simulated,
+        'steps': steps,
+        'dt': dt,
+        'warmup': warmup,
+        'samples': samples,
+        'vehicles': len(vehicle_state(sim)[0]),
+        'mean_speed_kmh': speed_sum / n * 3.6,
+        'density_veh_km': density_sum / n,
+        'flow_veh_h': flow_sum / n,
+        'stopped_fraction': stopped_sum / n,
+        'wall_time': wall_time,
+        'speedup': simulated / wall_time if wall_time > 0 else float('inf'),
+    }
+
+
+def scenario_defaults(scenario):
+    # Option defaults taken from the setup of a scenario file
+    options = {'length': 'road_length', 'lanes': 'lanes', 'seed': 'seed', 'vehicles': 'vehicles',
+               'speed_kmh': 'speed', 'fleet': 'fleet', 'integrator': 'integrator',
+               'equilibrium': 'equilibrium', 'perturbation': 'perturbation'}
+    defaults = {option: scenario.get(key) for key, option in options.items() if key in scenario.setup}
+    defaults['zone'] = list(scenario.zones)
+    return defaults
+
+
+def parse_zone(text):
+    start, end, limit = (float(x) for x in text.split(':'))
+    return start, end, limit
+
+
+def parse_detector(text):
+    # POSITION or POSITION:LANE
+    position, _, lane = text.partition(':')
+    return (float(position), int(lane)) if lane else float(position)
+
+
+def parse_fleet(text):
+    # car=0.8,truck=0.15,bus=0.05
+    shares = {}
+    for item in text.split(','):
+        name, share = item.split('=')
+        shares[name] = float(share)
+    return shares
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the traffic simulation without a display.")
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='object')
+    parser.add_argument('--duration', type=float, default=600.0, help="simulated seconds")
+    parser.add_argument('--dt', type=float, default=1 / 60, help="fixed time step (s)")
+    parser.add_argument('--warmup', type=float, default=0.0, help="seconds excluded from the metrics")
+    parser.add_argument('--sample-interval', type=float, default=1.0)
+    parser.add_argument('--vehicles', type=int,
+                        help=f"target vehicle count (default {DEFAULT_VEHICLES}, or the one saved in --checkpoint-in)")
+    parser.add_argument('--speed', type=float,
+                        help=f"base desired speed (km/h; default {DEFAULT_SPEED_KMH}, or the one saved "
+                             f"in --checkpoint-in)")
+    parser.add_argument('--road-length', type=float, default=DEFAULT_ROAD_LENGTH)
+    parser.add_argument('--lanes', type=int, default=2)
+    parser.add_argument('--integrator', choices=sorted(INTEGRATORS),
+                        help="ballistic/adaptive stay collision-free at dt up to 1 s (default euler, "
+                             "or the one saved in --checkpoint-in)")
+    parser.add_argument('--fleet', type=parse_fleet, metavar='TYPE=SHARE,...',
+                        help="vehicle type mix for new vehicles, e.g. car=0.8,truck=0.15,bus=0.05")
+    parser.add_argument('--zone', type=parse_zone, action='append', default=[],
+                        metavar='START:END:KMH',
+                        help="speed limit zone, repeatable; replaces the zones of --checkpoint-in")
+    parser.add_argument('--seed', type=int, help="random seed (runs are reproducible given a seed)")
+    parser.add_argument('--equilibrium', action='store_true',
+                        help="start with every vehicle placed at once at the IDM equilibrium "
+                             "instead of spawning one per step")
+    parser.add_argument('--perturbation', type=float, default=0.0, metavar='FRACTION',
+                        help="with --equilibrium, change each starting speed by up to this "
+                             "fraction to trigger stop-and-go waves")
+    parser.add_argument('--checkpoint-in', help="start from this checkpoint instead of an empty road")
+    parser.add_argument('--checkpoint-out', help="save the final state to this checkpoint")
+    parser.add_argument('--lane-check-interval', type=float, metavar='SECONDS',
+                        help="evaluate lane changes at this interval, except for vehicles "
+                             "held back by their leader (same lane changes, less work)")
+    parser.add_argument('--detector', type=parse_detector, action='append', default=[],
+                        metavar='POSITION[:LANE]', help="loop detector, repeatable")
+    parser.add_argument('--aggregate-interval', type=float, default=detectors.DEFAULT_INTERVAL,
+                        help="seconds per detector and heatmap row")
+    parser.add_argument('--heatmap-bin', type=float, default=detectors.DEFAULT_BIN_LENGTH,
+                        help="metres per time-space heatmap bin")
+    parser.add_argument('--monitor-out', help="save detector series and the speed heatmap to this .npz")
+    parser.add_argument('--profile', action='store_true',
+                        help="time the update phases (object engine) and report them")
+    parser.add_argument('--record', help="stream per-step vehicle state to this trajectory file")
+    parser.add_argument('--output', help="write the metrics as JSON to this file")
+    parser.add_argument('--scenario', help="scenario file (see scenario.py): its setup replaces the "
+                                           "defaults of these options, and its schedule is played")
+    args = parser.parse_args(argv)
+    schedule = None
+    if args.scenario:
+        try:
+            scenario = Scenario.load(args.scenario)
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+        parser.set_defaults(**scenario_defaults(scenario))
+        args = parser.parse_args(argv)
+        schedule = ScenarioPlayer(scenario.actions())
+
+    if args.checkpoint_in:
+        sim = checkpoint.load(args.checkpoint_in, ENGINES[args.engine])
+        if args.seed is not None:
+            sim.rng.seed(args.seed)
+        if args.integrator is not None:
+            sim.set_integrator(args.integrator)
+        # Options given explicitly change the saved scenario: a branch
+        if args.vehicles is not None:
+            sim.set_target_vehicle_count(args.vehicles)
+        if args.speed is not None:
+            sim.set_base_desired_speed(args.speed / 3.6)
+        if args.zone:
+            sim.road.clear_zones()
+            for start, end, limit_kmh in args.zone:
+                sim.road.add_speed_limit_zone(start, end, limit_kmh / 3.6)
+    else:
+        sim = build_controller(args.engine, args.road_length,
+                               DEFAULT_VEHICLES if args.vehicles is None else args.vehicles,
+                               DEFAULT_SPEED_KMH if args.speed is None else args.speed,
+                               args.zone, args.seed, args.lanes, args.integrator or 'euler')
+    if args.fleet:
+        try:
+            sim.set_fleet(args.fleet)
+        except ValueError as e:
+            parser.error(str(e))
+    if args.equilibrium:
+        if args.checkpoint_in:
+            parser.error("--equilibrium would replace the vehicles of --checkpoint-in")
+        try:
+            sim.populate(args.vehicles, args.perturbation)
+        except ValueError as e:
+            parser.error(str(e))
+    if args.detector or args.monitor_out:
+        try:
+            sim.enable_monitoring(args.detector, args.aggregate_interval, args.heatmap_bin,
+                                  capacity=max(1, int(args.duration // args.aggregate_interval) + 1))
+        except ValueError as e:
+            parser.error(str(e))
+    if args.record:
+        sim.recorder = TrajectoryRecorder(args.record, sim.road, sim.base_desired_speed)
+    if args.lane_check_interval:
+        sim.enable_lane_change_scheduling(args.lane_check_interval)
+    if args.profile:
+        if not hasattr(sim, 'enable_profiling'):
+            parser.error("--profile needs the object engine")
+        sim.enable_profiling(window=int(round(args.duration / args.dt)))
+    try:
+        metrics = run(sim, args.duration, args.dt, args.warmup, args.sample_interval, schedule)
+    except (ValueError, IndexError) as e:
+        if schedule is None:
+            raise
+        parser.error(f"scenario: {e}")
+    if schedule is not None:
+        metrics['scenario_actions'] = schedule.applied
+    if args.profile:
+        metrics['profile'] = sim.profiler.stats()
+    if sim.monitor is not None:
+        start = sim.current_time - args.duration
+        metrics['detectors'] = sim.monitor.summary(since=start + args.warmup)
+        if args.monitor_out:
+            sim.monitor.save(args.monitor_out)
+    if sim.lane_scheduler is not None:
+        metrics['lane_checks'] = sim.lane_scheduler.stats()
+    if sim.recorder is not None:
+        sim.recorder.close()
+    if args.checkpoint_out:
+        checkpoint.save(sim, args.checkpoint_out)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(metrics, f, indent=2)
+    for key, value in metrics.items():
+        if key == 'profile':
+            for phase, st in value['phases'].items():
+                print(f"profile.{phase}: p50 {st['p50']:.3f} ms, p95 {st['p95']:.3f} ms")
+            print(f"profile.lane_changes: {value['lane_changes']}")
+        elif key == 'detectors':
+            for d in value:
+                where = f"{d['position']:g} m" + ('' if d['lane'] is None else f" lane {d['lane']}")
+                fields = ', '.join(f"{name} {d[name]:.2f}" for name in detectors.DETECTOR_COLUMNS[1:]
+                                   if d[name] is not None)
+                print(f"detector {where}: {fields or 'no crossings'}")
+        elif key == 'lane_checks':
+            print(f"lane_checks: {value['evaluated']} evaluated, {value['parked']} parked, "
+                  f"{value['deferred']} deferred ({value['evaluated_fraction']:.1%} evaluated)")
+        else:
+            print(f"{key}: {value:.4f}" if isinstance(value, float) else f"{key}: {value}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,115 @@
+import bisect
+import heapq
+from operator import attrgetter
+
+position_of = attrgetter('position')
+
+class LaneIndex:
+    # Per-lane lists of vehicles ordered by position, kept up to date between
+    # steps instead of being rebuilt. keys[lane] holds the positions the lane
+    # was last sorted with, so neighbor queries are binary searches.
+    def __init__(self, num_lanes):
+        self.lanes = [[] for _ in range(num_lanes)]
+        self.keys = [[] for _ in range(num_lanes)]
+
+    def rebuild(self, vehicles):
+        self.lanes = [[] for _ in self.lanes]
+        for v in vehicles:
+            self.lanes[v.lane].append(v)
+        for cars in self.lanes:
+            cars.sort(key=position_of)
+        self.keys = [[v.position for v in cars] for cars in self.lanes]
+
+    def insert(self, vehicle):
+        keys = self.keys[vehicle.lane]
+        i = bisect.bisect_right(keys, vehicle.position)
+        keys.insert(i, vehicle.position)
+        self.lanes[vehicle.lane].insert(i, vehicle)
+
+    def remove(self, vehicle):
+        # Must be called while the vehicle is still at its indexed position
+        self._remove(vehicle, vehicle.lane, vehicle.position)
+
+    def _remove(self, vehicle, lane, key):
+        keys = self.keys[lane]
+        cars = self.lanes[lane]
+        i = bisect.bisect_left(keys, key)
+        while cars[i] is not vehicle:
+            i += 1
+        del keys[i]
+        del cars[i]
+
+    def move(self, vehicle, lane, key):
+        # Re-file a vehicle indexed in lane under key into its current lane,
+        # keeping the key: a lane change made during the step becomes visible
+        # to the vehicles updated after it
+        self._remove(vehicle, lane, key)
+        keys = self.keys[vehicle.lane]
+        i = bisect.bisect_right(keys, key)
+        keys.insert(i, key)
+        self.lanes[vehicle.lane].insert(i, vehicle)
+
+    def leader(self, position, lane, wrap=True):
+        # First vehicle with position > position, wrapping to the first one
+        # (or None on an open road)
+        cars = self.lanes[lane]
+        if not cars: return None
+        i = bisect.bisect_right(self.keys[lane], position)
+        if i == len(cars):
+            if not wrap: return None
+            i = 0
+        return cars[i]
+
+    def follower(self, position, lane, wrap=True):
+        # Last vehicle with position < position, wrapping to the last one
+        # (or None on an open road)
+        cars = self.lanes[lane]
+        if not cars: return None
+        i = bisect.bisect_left(self.keys[lane], position) - 1
+        if i < 0 and not wrap: return None
+        return cars[i] # i == -1 wraps to the last car
+
+    def take_beyond(self, position):
+        # Remove and return the vehicles indexed past position (open roads,
+        # after repair), lane by lane
+        out = []
+        for lane, keys in enumerate(self.keys):
+            i = bisect.bisect_right(keys, position)
+            if i < len(keys):
+                out.extend(self.lanes[lane][i:])
+                del self.lanes[lane][i:]
+                del keys[i:]
+        return out
+
+    def between(self, lane, start, end):
+        # Vehicles of a lane with start <= position <= end, in order
+        keys = self.keys[lane]
+        return self.lanes[lane][bisect.bisect_left(keys, start):bisect.bisect_right(keys, end)]
+
+    def ordered(self):
+        # All vehicles sorted by position (merge of the sorted lanes)
+        return list(heapq.merge(*self.lanes, key=position_of))
+
+    def repair(self, road_length):
+        # Bring the index up to date after every vehicle moved one step.
+        # Vehicles that crossed the start line move to the front of their
+        # lane, which leaves each lane nearly sorted, so the (adaptive) sort
+        # costs about O(n). Lane changers are then re-inserted by bisection.
+        half = road_length / 2
+        movers = []
+        for lane, cars in enumerate(self.lanes):
+            wrapped = []
+            stay = []
+            for v, key in zip(cars, self.keys[lane]):
+                if v.lane != lane:
+                    movers.append(v)
+                elif v.position + half < key:
+                    wrapped.append(v)
+                else:
+                    stay.append(v)
+            cars = wrapped + stay
+            cars.sort(key=position_of)
+            self.lanes[lane] = cars
+            self.keys[lane] = [v.position for v in cars]
+        for v in movers:
+            self.insert(v)
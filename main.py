@@ -1,7 +1,17 @@
+import argparse
 import pygame
 import sys
 import math
+import numpy as np
+from time import perf_counter
+from geometry import OvalTrack
+from model import Road
+from profiling import PhaseProfiler
 from simulation import SimulationController
+from recorder import TrajectoryRecorder, TrajectoryReader
+from render import VehicleRenderer
+from scenario import Scenario, ScenarioPlayer
+from worker import SimulationWorker, PHYSICS_DT, MAX_CATCHUP_STEPS
 
 # Configuration
 WIDTH, HEIGHT = 1200, 700 # Bigger for oval
@@ -12,6 +22,21 @@ OVAL_RADIUS = 150
 STRAIGHT_LENGTH = 800
 # Total logical length
 ROAD_LENGTH = 2 * (STRAIGHT_LENGTH + math.pi * OVAL_RADIUS) 
+MAX_VEHICLES = 150 # top of the vehicle slider
+MAX_ZONE_SLIDERS = 4 # zones past these have no slider
+
+# Setup without a scenario file (see scenario.py): 40 vehicles at 120 km/h
+# and 2 zones at that same speed, so they limit nothing to start with.
+# Road structure: Top Straight -> Right Curve -> Bottom Straight -> Left Curve
+# Top Straight: 0 to 800
+# Right Curve: 800 to 800 + pi*R (~1271)
+# Bottom Straight: 1271 to 2071
+DEFAULT_SCENARIO = {
+    'vehicles': 40,
+    'speed_kmh': 120,
+    # Zone 1 on the top straight, zone 2 on the bottom straight
+    'zones': [[200, 600, 120], [1400, 1800, 120]],
+}
 
 # Colors
 WHITE = (255, 255, 255)
@@ -21,7 +46,8 @@ MARKER_COLOR = (255, 255, 255)
 ZONE_COLOR = (255, 100, 100) # Light red overlay
 
 class App:
-    def __init__(self):
+    def __init__(self, replay_path=None, record_path=None, use_worker=True, scenario=None,
+                 max_vehicles=MAX_VEHICLES, engine='object'):
         pygame.init()
         self.screen = pygame.display.set_mode((WIDTH, HEIGHT))
         pygame.display.set_caption("Simulación de Tráfico V2 - Circuito Ovalado")
@@ -29,211 +55,223 @@ class App:
         self.font = pygame.font.SysFont("Arial", 14)
         self.title_font = pygame.font.SysFont("Arial", 20, bold=True)
 
-        self.sim = SimulationController(road_length=ROAD_LENGTH)
-        self.sim.set_target_vehicle_count(40)
-        self.sim.set_base_desired_speed(120 / 3.6) # 120 km/h default
-
-        # Zones: 2 configurable zones
-        # Init zones: Zone 1 at top straight, Zone 2 at bottom straight
-        # Start vals: Max speed (no limit)
-        self.zone1_limit_kmh = 120
-        self.zone2_limit_kmh = 120
-        
-        # Zone 1: 200m to 600m (Top straight)
-        self.zone1_range = (200, 600)
-        # Zone 2: 1500m to 1900m (Bottom straight approx) 
-        # Road structure: Top Straight -> Right Curve -> Bottom Straight -> Left Curve
-        # Top Straight: 0 to 800
-        # Right Curve: 800 to 800 + pi*R (~1271)
-        # Bottom Straight: 1271 to 2071
-        self.zone2_range = (1400, 1800)
-        
-        self.update_zones()
+        # Physics runs in a worker process unless asked to stay in this one
+        # (or there is nothing to simulate). Either way self.sim takes the
+        # same setter calls; self.road holds the zones the UI edits.
+        if scenario is None:
+            scenario = Scenario(DEFAULT_SCENARIO)
+        num_lanes = scenario.get('lanes', 2)
+        road_length = scenario.get('length', ROAD_LENGTH)
+        seed = scenario.get('seed')
+        integrator = scenario.get('integrator', 'euler')
+        self.worker = None
+        self.replay = None
+        if replay_path:
+            # Replay mode: draw a recorded run instead of simulating
+            self.replay = TrajectoryReader(replay_path)
+            num_lanes = self.replay.num_lanes
+            road_length = self.replay.road_length
+        if use_worker and not replay_path:
+            self.worker = SimulationWorker(engine=engine, road_length=road_length, num_lanes=num_lanes,
+                                           seed=seed, capacity=max(1 << 12, max_vehicles),
+                                           record_path=record_path, integrator=integrator).start()
+            self.sim = self.worker
+            self.road = Road(road_length, num_lanes=num_lanes)
+        else:
+            self.sim = SimulationController(road_length=road_length, seed=seed, num_lanes=num_lanes,
+                                            integrator=integrator)
+            self.road = self.sim.road
+        self.accumulator = 0.0 # unsimulated time when stepping in this process
+        self.profiling = False
+        self.render_profiler = PhaseProfiler()
+        vehicles = scenario.get('vehicles', 40)
+        speed_kmh = scenario.get('speed_kmh', 120)
+        self.sim.set_target_vehicle_count(vehicles)
+        self.reference_speed = speed_kmh / 3.6 # colours vehicles by speed
+        self.sim.set_base_desired_speed(self.reference_speed)
+        if scenario.get('fleet') is not None:
+            self.sim.set_fleet(scenario.get('fleet'))
+        # A replay draws the zones of the recording instead (advance_replay)
+        for start, end, limit_kmh in scenario.zones if not replay_path else ():
+            self.road.add_speed_limit_zone(start, end, limit_kmh / 3.6)
+        if self.worker is not None:
+            self.worker.set_speed_limit_zones(self.road.speed_limit_zones)
+        if scenario.get('equilibrium'):
+            self.sim.populate(vehicles, scenario.get('perturbation', 0.0))
+        # Scheduled actions, played as the simulated time reaches them
+        self.schedule = ScenarioPlayer(scenario.actions()) if scenario.path and not replay_path else None
 
         # UI
         self.dragging_slider = None
-        # Helper config for sliders
-        self.sliders = [
-            {'name': 'Cant. Vehículos', 'min': 0, 'max': 150, 'val': 40, 'y': 50, 'action': self.update_count_ui},
-            {'name': 'Vel. Global (km/h)', 'min': 30, 'max': 180, 'val': 120, 'y': 90, 'action': self.update_speed_ui},
-            {'name': 'Límite Zona 1 (km/h)', 'min': 10, 'max': 150, 'val': 120, 'y': 130, 'action': self.update_z1},
-            {'name': 'Límite Zona 2 (km/h)', 'min': 10, 'max': 150, 'val': 120, 'y': 170, 'action': self.update_z2}
-        ]
-        
+        # Helper config for sliders; ranges stretch to fit the scenario
+        self.count_slider = {'name': 'Cant. Vehículos', 'min': 0, 'max': max(max_vehicles, vehicles),
+                             'val': vehicles, 'action': self.update_count_ui}
+        self.speed_slider = {'name': 'Vel. Global (km/h)', 'min': min(30, speed_kmh), 'max': max(180, speed_kmh),
+                             'val': speed_kmh, 'action': self.update_speed_ui}
+        self.zone_sliders = []
+        for i, zone in enumerate(self.road.speed_limit_zones[:MAX_ZONE_SLIDERS]):
+            limit_kmh = zone['limit'] * 3.6
+            self.zone_sliders.append({'name': f'Límite Zona {i + 1} (km/h)', 'min': min(10, limit_kmh),
+                                      'max': max(150, limit_kmh), 'val': limit_kmh,
+                                      'action': lambda val, i=i: self.set_zone_limit(i, val / 3.6)})
+        self.sliders = [self.count_slider, self.speed_slider] + self.zone_sliders
+        for k, sl in enumerate(self.sliders):
+            sl['y'] = 50 + 40 * k
+
         self.center_x = WIDTH // 2
         self.center_y = HEIGHT // 2
+        # Lanes get narrower on screen past two so the oval fits the window
+        lane_width = min(15, 35 / max(1, num_lanes - 1))
+        # A road longer than the drawn oval is scaled to fit it
+        self.track = OvalTrack(self.center_x, self.center_y, STRAIGHT_LENGTH, OVAL_RADIUS,
+                               lane_width=lane_width, num_lanes=num_lanes, road_length=road_length)
+        self.renderer = VehicleRenderer()
+
+        # Cached surfaces: static road layer, UI panel, profiler overlay
+        # (rebuilt when its size changes) and text labels
+        self._road_layer = None
+        self._panel = None
+        self._profiler_panel = None
+        self._labels = {}
+
+        if record_path and self.worker is None:
+            self.sim.recorder = TrajectoryRecorder(record_path, self.sim.road, self.sim.base_desired_speed)
 
-    def update_zones(self):
-        self.sim.road.clear_zones()
-        self.sim.road.add_speed_limit_zone(self.zone1_range[0], self.zone1_range[1], self.zone1_limit_kmh / 3.6)
-        self.sim.road.add_speed_limit_zone(self.zone2_range[0], self.zone2_range[1], self.zone2_limit_kmh / 3.6)
+        if self.replay is not None:
+            self.replay_time = self.replay.start_time
+            self.replay_zones = []
+            self.paused = False
+            self.sliders = [
+                {'name': 'Tiempo (s)', 'min': self.replay.start_time, 'max': max(self.replay.end_time, self.replay.start_time + 1),
+                 'val': self.replay.start_time, 'y': 50, 'action': self.seek_replay},
+            ]
+
+    # Setters shared by the sliders and the scenario schedule: each passes
+    # the change on to the simulation and moves its slider to match
+
+    def set_target_vehicle_count(self, count):
+        self.sim.set_target_vehicle_count(count)
+        self.count_slider['val'] = count
+
+    def set_base_desired_speed(self, speed):
+        self.reference_speed = speed
+        self.sim.set_base_desired_speed(speed)
+        self.speed_slider['val'] = speed * 3.6
+
+    def set_zone_limit(self, index, limit):
+        # Only that zone changes; the road layer stays, the limit labels
+        # are drawn over it
+        self.road.set_zone_limit(index, limit)
+        if self.worker is not None:
+            self.worker.set_zone_limit(index, limit)
+        if index < len(self.zone_sliders):
+            self.zone_sliders[index]['val'] = limit * 3.6
+
+    def set_fleet(self, shares):
+        self.sim.set_fleet(shares)
+
+    def advance_schedule(self, time):
+        if self.schedule is not None:
+            self.schedule.advance(self, time)
 
     def update_count_ui(self, val):
-        self.sim.set_target_vehicle_count(val)
+        self.set_target_vehicle_count(val)
 
     def update_speed_ui(self, val):
-        self.sim.set_base_desired_speed(val / 3.6)
+        self.set_base_desired_speed(val / 3.6)
 
-    def update_z1(self, val):
-        self.zone1_limit_kmh = val
-        self.update_zones()
+    def seek_replay(self, val):
+        self.replay_time = val
 
-    def update_z2(self, val):
-        self.zone2_limit_kmh = val
-        self.update_zones()
+    def advance_replay(self, dt):
+        if not self.paused:
+            self.replay_time = min(self.replay_time + dt, self.replay.end_time)
+        self.sliders[0]['val'] = self.replay_time
+        zones = self.replay.zones_at(self.replay_time)
+        if zones != self.replay_zones:
+            # Rare: redraw the road layer with the zones of this moment
+            self.replay_zones = zones
+            self.road.clear_zones()
+            for start, end, limit in zones:
+                self.road.add_speed_limit_zone(start, end, limit)
+            self._road_layer = None
 
     def get_pos_on_oval(self, linear_pos, lane_offset):
-        # Map linear pos (0 to ROAD_LENGTH) to (x, y)
-        # 0 starts at left-top of straight: (-S/2, -R) ? No, let's center it.
-        # Let's say loop starts at Top-Left of straight section, moving Right.
-        
-        # Geometry:
-        # Top Straight: from x = -S/2 to S/2 at y = -R
-        # Right Arc: from angle -90 to 90 (or 270 to 90)
-        # Bottom Straight: from S/2 to -S/2 at y = R
-        # Left Arc: from 90 to 270
-        
-        # Lane offset: outer lane is larger radius?
-        # Standard track: lane 0 inner, lane 1 outer?
-        # Logic is simpler if lane 0 is r, lane 1 is r + lane_width
-        
-        base_r = OVAL_RADIUS
-        # Visual lane width approx 15px
-        r = base_r + (lane_offset * 15) 
-         
-        s_len = STRAIGHT_LENGTH
-        curve_len = math.pi * r # Approximate curve length for specific lane?
-        # Note: logic road length is fixed (centerline approximation). 
-        # Visually we might speed up/slow down cars on curves if we map strictly 1:1, but acceptable for demo.
-        
-        # Mapping based on Centerline definition:
-        # Top Straight: [0, S]
-        # Right Curve: [S, S + pi*R_center]
-        # Bot Straight: [S + pi*R, 2S + pi*R]
-        # Left Curve: [2S + pi*R, 2S + 2pi*R]
-        
-        arc_len = math.pi * OVAL_RADIUS
-        
-        p = linear_pos
-        
-        # Adjust coordinate system origin to center of screen
-        cx, cy = self.center_x, self.center_y
-        
-        if p < s_len:
-            # Top Straight (Left to Right)
-            # x goes from -S/2 to S/2
-            # y = -r
-            pct = p / s_len
-            x = -s_len/2 + pct * s_len
-            y = -r
-            return cx + x, cy + y
-            
-        p -= s_len
-        if p < arc_len:
-            # Right Curve
-            # Angle goes from -pi/2 (top) to +pi/2 (bottom) clockwise
-            pct = p / arc_len
-            angle = -math.pi/2 + pct * math.pi
-            x = s_len/2 + math.cos(angle) * r
-            y = math.sin(angle) * r
-            return cx + x, cy + y
-            
-        p -= arc_len
-        if p < s_len:
-            # Bottom Straight (Right to Left)
-            pct = p / s_len
-            x = s_len/2 - pct * s_len
-            y = r
-            return cx + x, cy + y
-            
-        p -= s_len
-        # Left Curve
-        # Angle goes from pi/2 to 3pi/2 (top)
-        pct = p / arc_len # Remain 
-        angle = math.pi/2 + pct * math.pi
-        x = -s_len/2 + math.cos(angle) * r
-        y = math.sin(angle) * r
-        return cx + x, cy + y
+        # Map linear pos (0 to ROAD_LENGTH) to (x, y); geometry lives in OvalTrack
+        return self.track.point(linear_pos, lane_offset)
+
+    def text(self, text):
+        # Rendered labels, reused while the text is unchanged
+        surface = self._labels.get(text)
+        if surface is None:
+            if len(self._labels) > 512:
+                self._labels.clear()
+            surface = self._labels[text] = self.font.render(text, True, WHITE)
+        return surface
+
+    def render_road_layer(self):
+        # Grass, asphalt and zone markers never move: draw them once onto an
+        # off-screen surface and blit that every frame
+        layer = pygame.Surface((WIDTH, HEIGHT)).convert()
+        layer.fill(BG_COLOR)
+
+        # Asphalt from 10 px inside lane 0 to 10 px outside the last lane
+        # (lane k is drawn at radius OVAL_RADIUS + k * lane_width):
+        # rects for the straights, rings for the curves
+        inner = OVAL_RADIUS - 10
+        outer = int(OVAL_RADIUS + (self.road.num_lanes - 1) * self.track.lane_width + 10)
+        top_rect = pygame.Rect(self.center_x - STRAIGHT_LENGTH//2, self.center_y - outer, STRAIGHT_LENGTH, outer - inner)
+        bot_rect = pygame.Rect(self.center_x - STRAIGHT_LENGTH//2, self.center_y + inner, STRAIGHT_LENGTH, outer - inner)
+        pygame.draw.rect(layer, ROAD_COLOR, top_rect)
+        pygame.draw.rect(layer, ROAD_COLOR, bot_rect)
+
+        for cx in (self.center_x + STRAIGHT_LENGTH//2, self.center_x - STRAIGHT_LENGTH//2):
+            pygame.draw.circle(layer, ROAD_COLOR, (int(cx), self.center_y), outer)
+            pygame.draw.circle(layer, BG_COLOR, (int(cx), self.center_y), inner)
 
-    def draw_road(self):
-        # Draw Grass
-        self.screen.fill(BG_COLOR)
-        
-        # Draw Layout (thick gray line)
-        # We need to draw 2 ovals: inner edge and outer edge?
-        # Or just one thick line
-        
-        # For zone highlighting, it's tricky on oval. We can iterate small steps?
-        # Or just draw zones first if we can map them.
-        
-        # Simplest: Draw Asphalt
-        # Inner loop
-        # Rects for straights
-        rect_h = 40 # 2 lanes * 20
-        # Top Straight
-        top_rect = pygame.Rect(self.center_x - STRAIGHT_LENGTH//2, self.center_y - OVAL_RADIUS - 10, STRAIGHT_LENGTH, 35) # 10 is lane offset visual
-        bot_rect = pygame.Rect(self.center_x - STRAIGHT_LENGTH//2, self.center_y + OVAL_RADIUS - 10, STRAIGHT_LENGTH, 35)
-        
-        pygame.draw.rect(self.screen, ROAD_COLOR, top_rect)
-        pygame.draw.rect(self.screen, ROAD_COLOR, bot_rect)
-        
-        # Arcs
-        # Pygame arc is not filled properly for roads easily.
-        # Draw circles.
-        # Right Circle
-        right_center = (int(self.center_x + STRAIGHT_LENGTH//2), self.center_y)
-        pygame.draw.circle(self.screen, ROAD_COLOR, right_center, OVAL_RADIUS + 25)
-        pygame.draw.circle(self.screen, BG_COLOR, right_center, OVAL_RADIUS - 10)
-        # Box clear left side of circle to make it semi?
-        # Not needed if we layer right.
-        # Cover left half of right circle with BG? No, straights connect.
-        
-        # Left Circle
-        left_center = (int(self.center_x - STRAIGHT_LENGTH//2), self.center_y)
-        pygame.draw.circle(self.screen, ROAD_COLOR, left_center, OVAL_RADIUS + 25)
-        pygame.draw.circle(self.screen, BG_COLOR, left_center, OVAL_RADIUS - 10)
-        
         # Redraw Center grass to clean up overlaps
-        center_rect = pygame.Rect(self.center_x - STRAIGHT_LENGTH//2, self.center_y - OVAL_RADIUS + 10, STRAIGHT_LENGTH, (OVAL_RADIUS - 10)*2)
-        pygame.draw.rect(self.screen, BG_COLOR, center_rect)
-
-        # Draw Zone Markers (Visual approx)
-        # Zone 1 (Top Straight part)
-        z1_start_x = self.center_x - STRAIGHT_LENGTH//2 + 200
-        z1_width = 400
-        pygame.draw.rect(self.screen, ZONE_COLOR, (z1_start_x, self.center_y - OVAL_RADIUS - 15, z1_width, 5))
-        
-        # Zone 2 (Bottom Straight part)
-        # 1400 linear starts at 1400 - (800 + 471) = ~129 into bottom straight? 
-        # Approx visual: just draw where we logically put it
-        z2_start_x = self.center_x + STRAIGHT_LENGTH//2 - (1400 - (STRAIGHT_LENGTH + math.pi*OVAL_RADIUS)) # Approx math
-        # Actually logic is: Bottom straight starts at Right side. Moving Left.
-        # Linear 1400 is relative to 000.
-        # Start of Bot Straight is S + pi*R = 800 + 471 = 1271.
-        # 1400 is 129m into straight.
-        # Since it goes Right to Left, x = RightEdge - 129.
-        if z2_start_x:
-            pass # calculated in paint logic above is better?
-             
-        # Simple Labels for zones
-        l1 = self.font.render("ZONA 1", True, WHITE)
-        self.screen.blit(l1, (self.center_x, self.center_y - OVAL_RADIUS - 40))
-        l2 = self.font.render("ZONA 2", True, WHITE)
-        self.screen.blit(l2, (self.center_x, self.center_y + OVAL_RADIUS + 30))
+        center_rect = pygame.Rect(self.center_x - STRAIGHT_LENGTH//2, self.center_y - inner, STRAIGHT_LENGTH, inner * 2)
+        pygame.draw.rect(layer, BG_COLOR, center_rect)
 
+        # Dashed lines between lanes
+        for k in range(self.road.num_lanes - 1):
+            points = self.track.polyline(0, self.track.road_length, k + 0.5, step=6.0)
+            for i in range(0, len(points) - 1, 2):
+                pygame.draw.line(layer, MARKER_COLOR, points[i], points[i + 1])
+
+        # Zone markers along the outer edge, wherever the zones really are,
+        # and where their labels go
+        label_offset = (outer + 20 - OVAL_RADIUS) / self.track.lane_width # in lanes
+        self._zone_label_points = []
+        for zone in self.road.speed_limit_zones:
+            points = self.track.polyline(zone['start'], zone['end'], self.road.num_lanes - 0.5)
+            pygame.draw.lines(layer, ZONE_COLOR, False, points, 5)
+            end = zone['end'] if zone['end'] >= zone['start'] else zone['end'] + self.track.road_length
+            x, y = self.track.point(((zone['start'] + end) / 2) % self.track.road_length, label_offset)
+            self._zone_label_points.append((int(x), int(y)))
+        return layer
+
+    def draw_road(self):
+        if self._road_layer is None:
+            self._road_layer = self.render_road_layer()
+        self.screen.blit(self._road_layer, (0, 0))
+        # Limit labels on top, so a limit change redraws nothing else
+        for i, (zone, center) in enumerate(zip(self.road.speed_limit_zones, self._zone_label_points)):
+            label = self.text(f"ZONA {i + 1}: {int(round(zone['limit'] * 3.6))} km/h")
+            self.screen.blit(label, label.get_rect(center=center))
 
     def draw_ui(self):
         # Panel
-        panel_rect = pygame.Rect(20, 20, 260, 200)
-        s = pygame.Surface((panel_rect.width, panel_rect.height), pygame.SRCALPHA)
-        s.fill((0, 0, 0, 180)) # Semi-transparent black
-        self.screen.blit(s, (panel_rect.x, panel_rect.y))
+        panel_rect = pygame.Rect(20, 20, 260, max(200, 40 * len(self.sliders) + 40))
+        if self._panel is None:
+            self._panel = pygame.Surface((panel_rect.width, panel_rect.height), pygame.SRCALPHA)
+            self._panel.fill((0, 0, 0, 180)) # Semi-transparent black
+        self.screen.blit(self._panel, (panel_rect.x, panel_rect.y))
         
         for sl in self.sliders:
             # Label
             val_txt = f"{int(sl['val'])}"
-            lbl = self.font.render(f"{sl['name']}: {val_txt}", True, WHITE)
-            self.screen.blit(lbl, (panel_rect.x + 10, sl['y'] - 15))
+            self.screen.blit(self.text(f"{sl['name']}: {val_txt}"), (panel_rect.x + 10, sl['y'] - 15))
             
             # Bar
             bar_rect = pygame.Rect(panel_rect.x + 10, sl['y'], 200, 10)
@@ -241,17 +279,66 @@ class App:
             
             # Knob
             rng = sl['max'] - sl['min']
-            pct = (sl['val'] - sl['min']) / rng
+            pct = min(max((sl['val'] - sl['min']) / rng, 0.0), 1.0)
             kx = bar_rect.x + pct * bar_rect.width
             pygame.draw.circle(self.screen, WHITE, (int(kx), bar_rect.centery), 8)
             
             # Store rect for input
             sl['rect'] = bar_rect
 
+    def toggle_profiler(self):
+        self.profiling = not self.profiling
+        self.render_profiler.reset()
+        if self.profiling:
+            self.sim.enable_profiling()
+        else:
+            self.sim.disable_profiling()
+
+    def draw_profiler(self):
+        # Overlay next to the UI panel: per-phase ms per step (p50 / p95)
+        lines = ["Perfil (ms)      p50     p95"]
+        if self.worker is not None:
+            stats = self.worker.stats() # arrives from the worker a bit later
+        else:
+            stats = self.sim.profiler.stats()
+        phases = dict(stats['phases']) if stats else {}
+        phases.update(self.render_profiler.stats()['phases'])
+        for phase, st in phases.items():
+            lines.append(f"{phase:<12} {st['p50']:7.2f} {st['p95']:7.2f}")
+        if stats:
+            lc = stats['lane_changes']
+            lines.append(f"Cambios carril: {lc['evaluations_per_step']:.1f} eval/paso")
+            lines.append(f"  aceptados: {lc['accepted_total']} ({lc['acceptance_rate']:.1%})")
+
+        panel_rect = pygame.Rect(300, 20, 240, 20 + 18 * len(lines))
+        if self._profiler_panel is None or self._profiler_panel.get_size() != panel_rect.size:
+            self._profiler_panel = pygame.Surface(panel_rect.size, pygame.SRCALPHA)
+            self._profiler_panel.fill((0, 0, 0, 180))
+        self.screen.blit(self._profiler_panel, (panel_rect.x, panel_rect.y))
+        for i, line in enumerate(lines):
+            self.screen.blit(self.text(line), (panel_rect.x + 10, panel_rect.y + 10 + 18 * i))
+
     def handle_input(self):
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 return False
+
+            elif event.type == pygame.KEYDOWN and self.replay is None:
+                # P toggles the profiler overlay, E restarts the traffic at
+                # equilibrium with the slider's vehicle count
+                if event.key == pygame.K_p:
+                    self.toggle_profiler()
+                elif event.key == pygame.K_e:
+                    self.sim.populate()
+
+            elif event.type == pygame.KEYDOWN:
+                # Replay controls: space pauses, arrows seek 5 s
+                if event.key == pygame.K_SPACE:
+                    self.paused = not self.paused
+                elif event.key == pygame.K_LEFT:
+                    self.replay_time = max(self.replay.start_time, self.replay_time - 5)
+                elif event.key == pygame.K_RIGHT:
+                    self.replay_time = min(self.replay.end_time, self.replay_time + 5)
             
             elif event.type == pygame.MOUSEBUTTONDOWN:
                 mx, my = pygame.mouse.get_pos()
@@ -278,32 +365,134 @@ class App:
         s['val'] = new_val
         s['action'](new_val)
 
+    def draw_vehicles(self):
+        # Screen positions for every vehicle in one table lookup
+        if self.replay is not None:
+            # Colours against the recorded reference speed since desired
+            # speeds are not stored
+            frame = self.replay.frame(self.replay.step_at(self.replay_time))
+            xs, ys = self.track.lookup(frame['positions'], frame['lanes'])
+            self.renderer.draw(self.screen, xs, ys, velocities=frame['velocities'],
+                               reference_speed=self.replay.reference_speed)
+            return
+
+        if self.worker is not None:
+            self.draw_shared_vehicles()
+            return
+
+        vehicles = self.sim.vehicles
+        positions = np.fromiter((v.position for v in vehicles), np.float64, len(vehicles))
+        # Lane 0 is the innermost
+        lanes = np.fromiter((v.lane for v in vehicles), np.int64, len(vehicles))
+        xs, ys = self.track.lookup(positions, lanes)
+        if len(vehicles) > self.renderer.lod_vehicles:
+            # Binned: coloured by mean speed, so skip each vehicle's colour
+            velocities = np.fromiter((v.velocity for v in vehicles), np.float64, len(vehicles))
+            self.renderer.draw(self.screen, xs, ys, velocities=velocities, reference_speed=self.reference_speed)
+        else:
+            colors = np.array([v.color for v in vehicles], dtype=np.uint8).reshape(-1, 3)
+            self.renderer.draw(self.screen, xs, ys, colors)
+
+    def draw_shared_vehicles(self):
+        # Latest two worker states, read in place and blended by alpha. A
+        # vehicle missing from the older state is drawn where it is now.
+        for _ in range(3):
+            frames = self.worker.state.read()
+            if frames is None:
+                return
+            prev, curr, alpha, token = frames
+            xs, ys = self.track.lookup(curr['positions'], curr['lanes'])
+            if alpha < 1.0 and len(prev['ids']):
+                j = np.minimum(np.searchsorted(prev['ids'], curr['ids']), len(prev['ids']) - 1)
+                matched = prev['ids'][j] == curr['ids']
+                j = j[matched]
+                px, py = self.track.lookup(prev['positions'][j], prev['lanes'][j])
+                xs[matched] = px + (xs[matched] - px) * alpha
+                ys[matched] = py + (ys[matched] - py) * alpha
+            colors = curr['colors'].copy()
+            velocities = curr['velocities'].copy()
+            if self.worker.state.unchanged(token):
+                break
+        if len(xs) > self.renderer.lod_vehicles:
+            self.renderer.draw(self.screen, xs, ys, velocities=velocities, reference_speed=self.reference_speed)
+        else:
+            self.renderer.draw(self.screen, xs, ys, colors)
+
+    def draw_frame(self):
+        self.draw_road()
+        self.draw_vehicles()
+        self.draw_ui()
+
     def run(self):
         running = True
         while running:
             running = self.handle_input()
             dt = self.clock.tick(FPS) / 1000.0
-            
-            self.sim.update(dt)
-            
-            self.draw_road()
-            
-            # Draw Vehicles
-            for v in self.sim.vehicles:
-                # Determine visual lane offset
-                # Lane 0: Inner, Lane 1: Outer
-                lane_off = 0 if v.lane == 0 else 1
-                
-                x, y = self.get_pos_on_oval(v.position, lane_off)
-                
-                # Draw
-                pygame.draw.circle(self.screen, v.color, (int(x), int(y)), 5)
-            
-            self.draw_ui()
+
+            if self.replay is not None:
+                self.advance_replay(dt)
+            elif self.worker is None:
+                # Fixed physics step whatever the frame time; a long stall
+                # drops simulated time instead of taking a huge step
+                self.accumulator = min(self.accumulator + dt, MAX_CATCHUP_STEPS * PHYSICS_DT)
+                while self.accumulator >= PHYSICS_DT:
+                    self.advance_schedule(self.sim.current_time)
+                    self.sim.update(PHYSICS_DT)
+                    self.accumulator -= PHYSICS_DT
+            elif not self.worker.is_alive():
+                print("the simulation worker stopped unexpectedly", file=sys.stderr)
+                running = False
+            else:
+                # The schedule follows the published time, so its actions
+                # reach the worker up to a frame late
+                self.advance_schedule(self.worker.state.latest_time())
+
+            t0 = perf_counter()
+            self.draw_frame()
+            if self.profiling:
+                self.render_profiler.add('render', perf_counter() - t0)
+                self.draw_profiler()
             pygame.display.flip()
 
+        if self.worker is not None:
+            self.worker.stop()
+        elif self.sim.recorder is not None:
+            self.sim.recorder.close()
         pygame.quit()
         sys.exit()
 
 if __name__ == "__main__":
-    App().run()
+    parser = argparse.ArgumentParser(description="Simulación de tráfico en un circuito ovalado.")
+    parser.add_argument('--record', help="grabar la trayectoria de la simulación en este archivo")
+    parser.add_argument('--replay', help="reproducir una trayectoria grabada sin simular")
+    parser.add_argument('--inline', action='store_true',
+                        help="simular en el mismo proceso que la ventana en lugar de un proceso aparte")
+    parser.add_argument('--lanes', type=int, help="cantidad de carriles (por defecto 2)")
+    parser.add_argument('--road-length', type=float,
+                        help="largo de la vía en metros; se escala al óvalo (por defecto el del óvalo)")
+    parser.add_argument('--scenario', help="archivo de escenario (ver scenario.py); --lanes y "
+                                           "--road-length tienen prioridad sobre el archivo")
+    parser.add_argument('--max-vehicles', type=int, default=MAX_VEHICLES,
+                        help=f"tope del control de cantidad de vehículos (por defecto {MAX_VEHICLES})")
+    parser.add_argument('--engine', choices=('object', 'vectorized'), default='object',
+                        help="motor de física del proceso de simulación (por defecto object)")
+    args = parser.parse_args()
+    if args.engine != 'object' and (args.inline or args.replay):
+        # Only the worker process builds the engine by name; in this process
+        # the drawing and the profiler need the object engine
+        parser.error("--engine solo se aplica a la simulación en un proceso aparte; "
+                     "no se puede combinar con --inline ni con --replay")
+    scenario = Scenario(DEFAULT_SCENARIO)
+    if args.scenario:
+        if args.replay:
+            parser.error("--scenario y --replay no se pueden combinar")
+        try:
+            scenario = Scenario.load(args.scenario)
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+    if args.lanes is not None:
+        scenario.setup['lanes'] = args.lanes
+    if args.road_length is not None:
+        scenario.setup['length'] = args.road_length
+    App(replay_path=args.replay, record_path=args.record, use_worker=not args.inline,
+        scenario=scenario, max_vehicles=args.max_vehicles, engine=args.engine).run()
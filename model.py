@@ -1,71 +1,367 @@
+import bisect
+import heapq
 import math
 import random
+import numpy as np
+
+# Integrators (see Vehicle.update and Vehicle.update_ballistic)
+# Most substeps the adaptive integrator splits a step into
+MAX_SUBSTEPS = 8
+# Adaptive substeps: split so each closes at most this fraction of the gap
+SUBSTEP_GAP_FRACTION = 0.25
+# Free space a vehicle needs ahead and behind to spawn under the ballistic
+# integrators, same as the lane change safety gaps
+SPAWN_GAP = 10
 
 class Road:
-    def __init__(self, length, num_lanes=2):
+    def __init__(self, length, num_lanes=2, closed=True):
         self.length = length
         self.num_lanes = num_lanes
-        # List of tuples: (start_pos, end_pos, limit)
+        # A closed road is a ring: vehicles past the end come back at the
+        # start. Open roads (network segments) hand them over instead.
+        self.closed = closed
+        # List of zone dicts: {'start', 'end', 'limit'}
         # We assume limits apply to all lanes for simplicity in this version
         self.speed_limit_zones = []
+        # Compiled lookup table, rebuilt lazily after the zones change
+        self._limit_table = None
 
     def add_speed_limit_zone(self, start, end, limit):
         # Remove existing zone overlapping or just append?
         # Simple append, logic will take the lowest limit if multiple overlap
+        # A zone with end < start wraps past the end of the road
         self.speed_limit_zones.append({'start': start, 'end': end, 'limit': limit})
-    
+        self._limit_table = None
+
+    def set_zone_limit(self, index, limit):
+        # Change the limit of one zone. A compiled table is patched over
+        # that zone's span instead of being rebuilt: the breakpoints stay
+        # the same, only the limits between them are taken again from the
+        # zones that overlap the span (known since compiling), so a change
+        # costs the overlapping zones, not every zone. Nothing changes when
+        # the index or the limit is rejected.
+        if not 0 <= index < len(self.speed_limit_zones):
+            raise IndexError(f"no zone {index} ({len(self.speed_limit_zones)} zones)")
+        try:
+            value = float(limit)
+        except (TypeError, ValueError):
+            raise ValueError(f"bad speed limit {limit!r}") from None
+        if not math.isfinite(value) or value < 0:
+            raise ValueError(f"bad speed limit {limit!r}")
+        self.speed_limit_zones[index] = dict(self.speed_limit_zones[index], limit=value)
+        if self._limit_table is None:
+            return
+        _, interval_table, point_table, _, interval_list, point_list = self._limit_table
+        for i, j in self._zone_spans[index]:
+            interval_limits = np.full(j - i, np.inf)
+            point_limits = np.full(j - i + 1, np.inf)
+            for other in self._zone_overlaps[index]:
+                zone = self.speed_limit_zones[other]
+                for a, b in self._zone_spans[other]:
+                    lo, hi = max(a, i), min(b, j)
+                    if lo < hi:
+                        interval_limits[lo - i:hi - i] = np.minimum(interval_limits[lo - i:hi - i], zone['limit'])
+                    if lo <= hi:
+                        point_limits[lo - i:hi - i + 1] = np.minimum(point_limits[lo - i:hi - i + 1],
+                                                                    zone['limit'])
+            interval_table[i + 1:j + 1] = interval_limits
+            point_table[i:j + 1] = point_limits
+            interval_list[i + 1:j + 1] = interval_limits.tolist()
+            point_list[i:j + 1] = point_limits.tolist()
+
     def clear_zones(self):
         self.speed_limit_zones = []
+        self._limit_table = None
+
+    def _zone_intervals(self, zone):
+        # Split a zone into closed intervals inside [0, length]
+        start, end = zone['start'], zone['end']
+        if 0 <= start <= end <= self.length:
+            return [(start, end)]
+        if 0 <= end < start <= self.length:
+            return [(start, self.length), (0.0, end)]
+        # Zone given outside [0, length]: reduce it modulo the road length
+        if abs(end - start) >= self.length:
+            return [(0.0, self.length)]
+        lo = start % self.length
+        hi = end % self.length
+        if lo <= hi:
+            return [(lo, hi)]
+        return [(lo, self.length), (0.0, hi)]
+
+    def _compile_zones(self):
+        # Piecewise-constant table of the minimum limit. breakpoints are the
+        # sorted zone edges; point_limits[i] applies exactly at breakpoints[i]
+        # and interval_limits[i] between breakpoints[i-1] and breakpoints[i]
+        # (the first and last entries cover the road outside every zone).
+        intervals = []
+        owners = [] # zone index of each interval
+        for index, zone in enumerate(self.speed_limit_zones):
+            for lo, hi in self._zone_intervals(zone):
+                intervals.append((lo, hi, zone['limit']))
+                owners.append(index)
+
+        breakpoints = np.unique(np.array([x for lo, hi, _ in intervals for x in (lo, hi)], dtype=np.float64))
+        interval_limits = np.full(len(breakpoints) + 1, np.inf)
+        point_limits = np.full(len(breakpoints), np.inf)
+        # Breakpoint index spans (i, j) of each zone, for set_zone_limit
+        self._zone_spans = [[] for _ in self.speed_limit_zones]
+        for (lo, hi, limit), index in zip(intervals, owners):
+            i = int(np.searchsorted(breakpoints, lo))
+            j = int(np.searchsorted(breakpoints, hi))
+            # Open intervals (bp[i], bp[j]) are interval_limits[i+1 .. j]
+            interval_limits[i + 1:j + 1] = np.minimum(interval_limits[i + 1:j + 1], limit)
+            point_limits[i:j + 1] = np.minimum(point_limits[i:j + 1], limit)
+            self._zone_spans[index].append((i, j))
+
+        # Zones sharing a breakpoint with each zone (itself included): a
+        # sweep over the spans by start, keeping those not yet ended
+        self._zone_overlaps = [{index} for index in range(len(self.speed_limit_zones))]
+        active = [] # heap of (end, zone)
+        for i, j, index in sorted((i, j, index) for index, spans in enumerate(self._zone_spans)
+                                  for i, j in spans):
+            while active and active[0][0] < i:
+                heapq.heappop(active)
+            for _, other in active:
+                self._zone_overlaps[index].add(other)
+                self._zone_overlaps[other].add(index)
+            heapq.heappush(active, (j, index))
+
+        self._limit_table = (breakpoints, interval_limits, point_limits,
+                             breakpoints.tolist(), interval_limits.tolist(), point_limits.tolist())
+        return self._limit_table
 
     def get_speed_limit_at(self, position):
-        min_limit = float('inf')
-        for zone in self.speed_limit_zones:
-            # Handle wrapping zones if needed (not implemented yet for simplicity)
-            if zone['start'] <= position <= zone['end']:
-                if zone['limit'] < min_limit:
-                    min_limit = zone['limit']
-        return min_limit
+        table = self._limit_table or self._compile_zones()
+        breakpoints, interval_limits, point_limits = table[3:]
+        i = bisect.bisect_left(breakpoints, position)
+        if i < len(breakpoints) and breakpoints[i] == position:
+            return point_limits[i]
+        return interval_limits[i]
+
+    def get_speed_limits_at(self, positions):
+        # Batched get_speed_limit_at over an array of positions
+        breakpoints, interval_limits, point_limits = (self._limit_table or self._compile_zones())[:3]
+        positions = np.asarray(positions, dtype=np.float64)
+        if len(breakpoints) == 0:
+            return np.full(positions.shape, np.inf)
+        i = np.searchsorted(breakpoints, positions, side='left')
+        at = np.minimum(i, len(breakpoints) - 1)
+        on_breakpoint = breakpoints[at] == positions
+        return np.where(on_breakpoint, point_limits[at], interval_limits[i])
+
+class VehicleType:
+    # Size and IDM parameters shared by every vehicle of a class. Vehicles
+    # only reference their type, so a fleet carries one copy per type.
+    __slots__ = ('name', 'length', 'width', 'max_acceleration', 'comfortable_deceleration',
+                 'min_gap', 'time_headway', 'speed_factor', 'braking_term')
+
+    def __init__(self, name, length, width, max_acceleration, comfortable_deceleration,
+                 min_gap, time_headway, speed_factor=1.0):
+        self.name = name
+        self.length = length
+        self.width = width
+        self.max_acceleration = max_acceleration # a
+        self.comfortable_deceleration = comfortable_deceleration # b
+        self.min_gap = min_gap # s0
+        self.time_headway = time_headway # T
+        # Desired speed relative to the base desired speed of the road
+        self.speed_factor = speed_factor
+        # Denominator of the dynamic term of the IDM desired gap, 2*sqrt(a*b)
+        self.braking_term = 2 * math.sqrt(max_acceleration * comfortable_deceleration)
+
+    def parameters(self):
+        return (self.length, self.width, self.max_acceleration, self.comfortable_deceleration,
+                self.min_gap, self.time_headway)
+
+    def __reduce__(self):
+        # Unpickle to the shared instance (vehicles migrating between workers)
+        return (vehicle_type, self.parameters())
+
+# Vehicle classes by name. 'car' is the original vehicle and the default.
+VEHICLE_TYPES = {
+    'car': VehicleType('car', 5, 2, 1.0, 1.5, 2.0, 1.5),
+    'truck': VehicleType('truck', 12, 2.5, 0.7, 1.5, 3.0, 1.8, speed_factor=0.75),
+    'bus': VehicleType('bus', 12, 2.5, 0.8, 1.5, 3.0, 1.6, speed_factor=0.8),
+}
+# Types created by vehicle_type for parameters no named type has
+_CUSTOM_TYPES = {}
+
+def vehicle_type(length, width, max_acceleration, comfortable_deceleration, min_gap, time_headway):
+    # Shared VehicleType with these parameters: a named one when they match,
+    # else one custom type per distinct set (used when restoring vehicles
+    # from arrays or checkpoints)
+    key = (length, width, max_acceleration, comfortable_deceleration, min_gap, time_headway)
+    for t in VEHICLE_TYPES.values():
+        if t.parameters() == key:
+            return t
+    t = _CUSTOM_TYPES.get(key)
+    if t is None:
+        t = _CUSTOM_TYPES[key] = VehicleType('custom', *key)
+    return t
+
+def fleet_mix(shares):
+    # Cumulative table for pick_vehicle_type from {type name: share}; shares
+    # need not add up to 1
+    total = 0.0
+    for name, share in shares.items():
+        if name not in VEHICLE_TYPES:
+            raise ValueError(f"unknown vehicle type {name!r}")
+        if share < 0:
+            raise ValueError(f"negative share for {name!r}")
+        total += share
+    if total <= 0:
+        raise ValueError("fleet mix needs a positive share")
+    table = []
+    acc = 0.0
+    for name, share in shares.items():
+        acc += share / total
+        table.append((acc, VEHICLE_TYPES[name]))
+    return table
+
+def pick_vehicle_type(rng, fleet):
+    # fleet: table from fleet_mix, or None for cars only (no random draw, so
+    # runs without a mix repeat the original random sequence)
+    if fleet is None:
+        return VEHICLE_TYPES['car']
+    u = rng.random()
+    for acc, t in fleet:
+        if u < acc:
+            return t
+    return fleet[-1][1]
+
+def equilibrium_gaps(min_gaps, time_headways, v, desired_speeds):
+    # Bumper gaps at which the IDM acceleration at speed v, following a
+    # leader at the same speed, is zero (arrays of the IDM parameters)
+    if v <= 0:
+        return np.array(min_gaps, dtype=np.float64)
+    return (min_gaps + v * time_headways) / np.sqrt(1 - (v / desired_speeds) ** 4)
+
+def _equilibrium_speed(min_gaps, time_headways, desired_speeds, free):
+    # Common speed at which the equilibrium gaps of a lane add up to free
+    # (the gaps grow with v, so bisect between 0 and the slowest desired
+    # speed)
+    lo, hi = 0.0, float(desired_speeds.min())
+    if free <= min_gaps.sum() or hi <= 0:
+        return 0.0
+    for _ in range(60):
+        v = 0.5 * (lo + hi)
+        if equilibrium_gaps(min_gaps, time_headways, v, desired_speeds).sum() > free:
+            hi = v
+        else:
+            lo = v
+    return lo
+
+def equilibrium_layout(rng, count, road, base_desired_speed, fleet=None, perturbation=0.0):
+    # count vehicles in IDM equilibrium on a ring road: spread over the lanes
+    # in turn, every vehicle of a lane at the lane's common speed with its
+    # equilibrium gap to its leader. Types and desired speeds are drawn like
+    # spawns do, then each lane's starting point. Speed limit zones are left
+    # out, the traffic adapts to them as it runs. Without a disturbance the
+    # equilibrium can hold where spawned traffic would jam: perturbation
+    # changes each speed by up to that fraction (0.2 = +-20%) to seed
+    # stop-and-go waves.
+    # Returns (position, lane, desired_speed, velocity, vehicle_type) tuples.
+    drawn = []
+    for _ in range(count):
+        t = pick_vehicle_type(rng, fleet)
+        drawn.append((t, (base_desired_speed + rng.uniform(-2, 2)) * t.speed_factor))
+    layout = []
+    for lane in range(road.num_lanes):
+        cars = drawn[lane::road.num_lanes]
+        start = rng.uniform(0, road.length)
+        if not cars:
+            continue
+        lengths = np.array([t.length for t, _ in cars], dtype=np.float64)
+        min_gaps = np.array([t.min_gap for t, _ in cars], dtype=np.float64)
+        time_headways = np.array([t.time_headway for t, _ in cars], dtype=np.float64)
+        desired_speeds = np.array([v0 for _, v0 in cars], dtype=np.float64)
+        free = road.length - lengths.sum()
+        if free < 0:
+            raise ValueError(f"{count} vehicles do not fit in {road.num_lanes} lanes of {road.length} m")
+        v = _equilibrium_speed(min_gaps, time_headways, desired_speeds, free)
+        gaps = equilibrium_gaps(min_gaps, time_headways, v, desired_speeds)
+        # Close the ring exactly (also below the minimum gaps in a jam)
+        gaps *= free / gaps.sum()
+        # Each vehicle is followed by the next one; a vehicle's own length
+        # and gap separate it from its leader
+        positions = ((start - np.cumsum(lengths + gaps)) % road.length).tolist()
+        for (t, v0), position in zip(cars, positions):
+            speed = v * (1 + rng.uniform(-perturbation, perturbation)) if perturbation > 0 else v
+            layout.append((position, lane, v0, speed, t))
+    return layout
 
 class Vehicle:
-    def __init__(self, id, position, lane, desired_speed):
+    # Per-vehicle state only; size and IDM parameters come from the shared
+    # VehicleType. No __dict__: a vehicle is a handful of slots.
+    __slots__ = ('id', 'position', 'lane', 'velocity', 'desired_speed', 'acceleration',
+                 'cooldown', 'color', 'type', 'length')
+
+    def __init__(self, id, position, lane, desired_speed, vehicle_type=None):
+        self.reset(id, position, lane, desired_speed, vehicle_type)
+
+    def reset(self, id, position, lane, desired_speed, vehicle_type=None):
+        # (Re)initialize, so pooled vehicles are reused as new ones
+        self.type = VEHICLE_TYPES['car'] if vehicle_type is None else vehicle_type
+        # Copied from the type: every follower reads it
+        self.length = self.type.length
         self.id = id
         self.position = position
         self.lane = lane
         self.velocity = desired_speed * 0.5
         self.desired_speed = desired_speed
         self.acceleration = 0
-        self.length = 5
-        self.width = 2
-        
-        # IDM Parameters
-        self.max_acceleration = 1.0 # a
-        self.comfortable_deceleration = 1.5 # b
-        self.min_gap = 2.0 # s0
-        self.time_headway = 1.5 # T
         
         # Lane Change Parameters
         self.cooldown = 0
         
         self.color = (0, 0, 255)
+        return self
+
+    # Read-only views of the type parameters
+    @property
+    def width(self):
+        return self.type.width
+
+    @property
+    def max_acceleration(self):
+        return self.type.max_acceleration
+
+    @property
+    def comfortable_deceleration(self):
+        return self.type.comfortable_deceleration
+
+    @property
+    def min_gap(self):
+        return self.type.min_gap
+
+    @property
+    def time_headway(self):
+        return self.type.time_headway
 
     def update(self, dt, lead_vehicle, road, neighbors):
-        # Neighbors is a dict: {'left_lead', 'left_floll', 'right_lead', 'right_foll'}
+        # Neighbors is a dict: {'left_leader', 'left_follower', 'right_leader', 'right_follower'}
+        # with the keys of the lanes that exist on either side, or None to
+        # skip the lane change this step
+        # Returns the lane change outcome (see _try_lane_change)
         
         if self.cooldown > 0:
             self.cooldown -= dt
 
         # 1. Update Position
         self.position += self.velocity * dt
-        if self.position > road.length:
+        if self.position > road.length and road.closed:
             self.position -= road.length
 
+        # Speed limit at the new position, shared by steps 2 and 3
+        limit = road.get_speed_limit_at(self.position)
+        effective_desired = min(self.desired_speed, limit)
+
         # 2. Lane Change Logic (Simple)
         # If stuck behind slow car, and other lane is faster/free
-        self._try_lane_change(lead_vehicle, neighbors, road)
+        lane_change = self._try_lane_change(lead_vehicle, neighbors, road, effective_desired)
 
         # 3. IDM Acceleration (Longitudinal)
-        limit = road.get_speed_limit_at(self.position)
-        effective_desired = min(self.desired_speed, limit)
         
         self.acceleration = self._calculate_idm_accel(self.velocity, effective_desired, lead_vehicle, road.length)
 
@@ -75,6 +371,91 @@ class Vehicle:
         
         # Color Update
         self._update_color(effective_desired)
+        return lane_change
+
+    def update_ballistic(self, dt, lead_vehicle, road, neighbors, max_substeps=1):
+        # Same decisions as update, integrated ballistically: the acceleration
+        # is taken from the state at the start of the step and the position
+        # advances by v*dt + a*dt^2/2. A vehicle that would stop inside the
+        # step stops where its speed reaches 0 instead of rolling on.
+        # With max_substeps > 1 the step is split when the vehicle closes in
+        # on its leader fast for the gap (the leader assumed to keep its
+        # speed meanwhile). The vehicle never ends up past where its leader
+        # was; nobody reverses, so lanes stay collision-free at any dt.
+        # The position is not wrapped around a closed road here: the
+        # controller does it after the step, so vehicles deciding later in
+        # the step still see which neighbors crossed the line past them.
+
+        if self.cooldown > 0:
+            self.cooldown -= dt
+
+        # Speed limit at the start of the step
+        limit = road.get_speed_limit_at(self.position)
+        effective_desired = min(self.desired_speed, limit)
+
+        lane = self.lane
+        lane_change = self._try_lane_change(lead_vehicle, neighbors, road, effective_desired, strict=True)
+        if lane_change:
+            # Follow the leader of the new lane from this step on
+            lead_vehicle = neighbors['left_leader' if self.lane > lane else 'right_leader']
+        if lead_vehicle is self:
+            lead_vehicle = None # alone in the lane
+
+        v = self.velocity
+        gap = float('inf')
+        lead_v = 0.0
+        steps = 1
+        if lead_vehicle:
+            gap = lead_vehicle.position - self.position
+            if gap < 0: gap += road.length
+            gap -= self.length
+            lead_v = lead_vehicle.velocity
+            if max_substeps > 1 and v > lead_v:
+                closing = (v - lead_v) * dt
+                if gap > 0:
+                    steps = min(max_substeps, 1 + int(closing / (SUBSTEP_GAP_FRACTION * gap)))
+                else:
+                    steps = max_substeps
+
+        h = dt / steps
+        travelled = 0.0
+        for k in range(steps):
+            a = self._idm(v, effective_desired, gap + lead_v * (k * h) - travelled, v - lead_v)
+            if v + a * h < 0:
+                travelled -= v * v / (2 * a)
+                v = 0.0
+            else:
+                travelled += v * h + 0.5 * a * h * h
+                v += a * h
+
+        if travelled > gap:
+            travelled = max(gap, 0.0)
+            v = min(v, lead_v)
+
+        self.acceleration = a
+        self.velocity = v
+        self.position += travelled
+
+        self._update_color(effective_desired)
+        return lane_change
+
+    def update_adaptive(self, dt, lead_vehicle, road, neighbors):
+        return self.update_ballistic(dt, lead_vehicle, road, neighbors, MAX_SUBSTEPS)
+
+    def leader_pressure(self, leader, road_len):
+        # Braking the leader imposes on top of the free-road acceleration,
+        # a * (s*/s)^2 in the IDM. Changing lanes cannot gain more than this:
+        # below the lane change threshold there is nothing to evaluate.
+        s = leader.position - self.position
+        if s < 0: s += road_len
+        t = self.type
+        s -= t.length
+        if s <= 0.1: s = 0.1
+        v = self.velocity
+        s_star = (t.min_gap +
+                  (v * t.time_headway) +
+                  (v * (v - leader.velocity)) / t.braking_term)
+        return t.max_acceleration * (s_star / s) ** 2
 
     def _calculate_idm_accel(self, v, v0, leader, road_len):
         delta_v = 0
@@ -85,78 +466,88 @@ class Vehicle:
             if s < 0: s += road_len
             s -= self.length
             delta_v = v - leader.velocity
-        
+        return self._idm(v, v0, s, delta_v)
+
+    def _idm(self, v, v0, s, delta_v):
+        # s is the bumper gap to the leader (inf without one)
         # Safety clamp for s
         if s <= 0.1: s = 0.1
 
-        s_star = (self.min_gap + 
-                  (v * self.time_headway) + 
-                  (v * delta_v) / (2 * math.sqrt(self.max_acceleration * self.comfortable_deceleration)))
+        t = self.type
+        s_star = (t.min_gap + 
+                  (v * t.time_headway) + 
+                  (v * delta_v) / t.braking_term)
 
         term1 = (v / v0) ** 4 if v0 > 0 else 0
         term2 = (s_star / s) ** 2
         
-        return self.max_acceleration * (1 - term1 - term2)
+        return t.max_acceleration * (1 - term1 - term2)
 
-    def _try_lane_change(self, lead, neighbors, road):
-        if self.cooldown > 0: return
+    def _try_lane_change(self, lead, neighbors, road, eff_speed, strict=False):
+        # None: not evaluated (cooldown, or neighbors is None when a
+        # scheduler left the vehicle out of this step), False: rejected,
+        # True: changed lane
+        # strict: a neighbor that already moved this step may have passed
+        # this vehicle; a leader behind or a follower ahead (by less than
+        # half the road) makes the lane unsafe instead of wrapping around.
+        if self.cooldown > 0 or neighbors is None: return None
 
         # Only consider changing if speed is inhibited
         # or if random probability (politeness factor?)
         
-        current_acc = self.acceleration
-        
-        # Check lanes
-        # Assume 2 lanes: 0 and 1.
-        target_lane = 1 - self.lane
-        
-        # Get neighbors in target lane
-        # We need to know who would be my leader and follower in target lane
-        # "neighbors" arg passed from simulation should have this info for the target lane
-        
-        # Simplified: Simulation passes us the object candidates
-        # simulation.py will have to find:
-        # target_leader = closest vehicle ahead in target lane
-        # target_follower = closest vehicle behind in target lane
-        
-        target_leader = neighbors['target_leader']
-        target_follower = neighbors['target_follower']
+        # Check lanes: left (lane + 1) first, then right (lane - 1). The
+        # "neighbors" dict from simulation.py only has keys for lanes that
+        # exist: the closest vehicle ahead ('<side>_leader') and behind
+        # ('<side>_follower') in that lane.
+        best_lane = None
+        best_acc = None
 
-        # Safety Criterion: Would I crash into target_leader? Would target_follower crash into me?
-        # Check simple gaps
-        safe_gap_front = 10 # meters, simplified
-        safe_gap_back = 10
-        
-        gap_front = float('inf')
-        if target_leader:
-            dist = target_leader.position - self.position
-            if dist < 0: dist += road.length
-            gap_front = dist - target_leader.length
+        for leader_key, follower_key, target_lane in (('left_leader', 'left_follower', self.lane + 1),
+                                                      ('right_leader', 'right_follower', self.lane - 1)):
+            if leader_key not in neighbors:
+                continue
+            target_leader = neighbors[leader_key]
+            target_follower = neighbors[follower_key]
+
+            # Safety Criterion: Would I crash into target_leader? Would target_follower crash into me?
+            # Check simple gaps
+            safe_gap_front = 10 # meters, simplified
+            safe_gap_back = 10
             
-        gap_back = float('inf')
-        if target_follower:
-            dist = self.position - target_follower.position
-            if dist < 0: dist += road.length
-            gap_back = dist - self.length
-
-        if gap_front < safe_gap_front or gap_back < safe_gap_back:
-            return # Unsafe
-
-        # Incentive Criterion:
-        # Gain in acceleration? 
-        # Calculate accel if I stay related to 'lead'
-        # Calculate accel if I move related to 'target_leader'
-        
-        limit = road.get_speed_limit_at(self.position)
-        eff_speed = min(self.desired_speed, limit)
+            gap_front = float('inf')
+            if target_leader:
+                dist = target_leader.position - self.position
+                if dist < 0:
+                    if strict and dist > -road.length / 2: continue
+                    dist += road.length
+                gap_front = dist - target_leader.length
+                
+            gap_back = float('inf')
+            if target_follower:
+                dist = self.position - target_follower.position
+                if dist < 0:
+                    if strict and dist > -road.length / 2: continue
+                    dist += road.length
+                gap_back = dist - self.length
 
-        acc_stay = self._calculate_idm_accel(self.velocity, eff_speed, lead, road.length)
-        acc_move = self._calculate_idm_accel(self.velocity, eff_speed, target_leader, road.length)
-        
-        # Hysteresis threshold
-        if acc_move > acc_stay + 0.5: # significant gain needed
-            self.lane = target_lane
-            self.cooldown = 2.0 # Wait 2 seconds before changing again
+            if gap_front < safe_gap_front or gap_back < safe_gap_back:
+                continue # Unsafe
+
+            # Incentive Criterion: gain in acceleration if I move related to
+            # 'target_leader' instead of staying behind 'lead'
+            if best_acc is None:
+                acc_stay = self._calculate_idm_accel(self.velocity, eff_speed, lead, road.length)
+                best_acc = acc_stay + 0.5 # Hysteresis: significant gain needed
+            acc_move = self._calculate_idm_accel(self.velocity, eff_speed, target_leader, road.length)
+            if acc_move > best_acc:
+                best_lane = target_lane
+                best_acc = acc_move
+
+        if best_lane is None:
+            return False
+        self.lane = best_lane
+        self.cooldown = 2.0 # Wait 2 seconds before changing again
+        return True
 
     def _update_color(self, limit):
         if self.velocity < 2:
@@ -165,3 +556,13 @@ class Vehicle:
             self.color = (255, 165, 0)
         else:
             self.color = (0, 255, 0)
+
+# Vehicle step functions by integrator name:
+#   euler: explicit Euler, position first (the original update)
+#   ballistic: see Vehicle.update_ballistic
+#   adaptive: ballistic with up to MAX_SUBSTEPS substeps for tight gaps
+INTEGRATORS = {
+    'euler': Vehicle.update,
+    'ballistic': Vehicle.update_ballistic,
+    'adaptive': Vehicle.update_adaptive,
+}
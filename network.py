@@ -0,0 +1,325 @@
+import bisect
+import random
+from model import Road, Vehicle
+from lane_index import LaneIndex
+
+# Open road network: segments (each an open Road with its own lanes, zones
+# and lane index) joined end to start by connections.
+#
+# A connection takes some lanes at the end of its source into the target,
+# shifted by `shift` lanes and entering at `offset` meters along it, so one
+# description covers the usual pieces:
+#   continuation   A -> B, all lanes, shift 0
+#   lane gain      A (2 lanes) -> B (3 lanes), shift +1: lane 0 of B starts empty
+#   diverge        A lane 0 -> off-ramp, A lanes 1.. -> B with shift -1
+#   merge          ramp lane 0 -> B lane 0 at offset, yielding to B's traffic
+# Routing is by lane: a vehicle leaves a segment through the connection of the
+# lane it is in. A lane of a segment with connections but none for that lane
+# ends there (vehicles stop and must change lanes); a segment without any
+# outgoing connection is a sink and vehicles leave the network.
+#
+# Vehicles on another segment are seen as they were at the start of the step
+# (ghosts), within REACH meters of the joint. Inside a segment the update is
+# the same as SimulationController's. Because nothing crosses a segment
+# boundary mid-step, the segments can be split across processes (see
+# decomposition.py) with the same results as a single process.
+
+# How far past a joint vehicles look for leaders and followers (m)
+REACH = 200.0
+# Free space a merging vehicle needs ahead and behind, plus this many seconds
+# of the oncoming vehicle's speed behind
+MERGE_GAP = 10.0
+MERGE_HEADWAY = 1.0
+# Free space needed at the start of a lane to let a new vehicle in (m)
+SPAWN_GAP = 20.0
+
+
+class Ghost:
+    # Start-of-step copy of a vehicle on a neighboring segment, placed in the
+    # coordinates of the segment looking at it
+    def __init__(self, id, position, velocity, length, lane):
+        self.id = id
+        self.position = position
+        self.velocity = velocity
+        self.length = length
+        self.lane = lane
+
+
+class Connection:
+    def __init__(self, index, source, target, lanes, shift, offset, merge):
+        self.index = index
+        self.source = source
+        self.target = target
+        self.lanes = lanes # source lanes
+        self.shift = shift
+        self.offset = offset
+        self.merge = merge
+
+
+class Segment:
+    def __init__(self, index, name, length, num_lanes, inflow):
+        self.index = index
+        self.name = name
+        self.road = Road(length, num_lanes, closed=False)
+        self.inflow = inflow # veh/h entering at the start
+        self.outgoing = [None] * num_lanes # per lane
+        self.incoming = []
+        # Simulation state, filled by NetworkSimulation for owned segments
+        self.lane_index = LaneIndex(num_lanes)
+        self.rng = None
+        self.pending = 0 # arrivals waiting for space
+        self.spawned = 0
+        self.exited = 0
+        self.beyond = [None] * num_lanes # leader past the end, per lane
+        self.ghosts_behind = [[] for _ in range(num_lanes)]
+        self.ghost_keys = [[] for _ in range(num_lanes)]
+
+    @property
+    def length(self):
+        return self.road.length
+
+    @property
+    def num_lanes(self):
+        return self.road.num_lanes
+
+    @property
+    def is_sink(self):
+        return not any(self.outgoing)
+
+
+class RoadNetwork:
+    def __init__(self):
+        self.segments = []
+        self.connections = []
+        self._by_name = {}
+
+    def add_segment(self, name, length, num_lanes=2, inflow=0.0):
+        if name in self._by_name:
+            raise ValueError(f"duplicate segment {name!r}")
+        if length < REACH:
+            raise ValueError(f"segment {name!r} is shorter than REACH ({REACH} m)")
+        segment = Segment(len(self.segments), name, length, num_lanes, inflow)
+        self.segments.append(segment)
+        self._by_name[name] = segment
+        return segment
+
+    def segment(self, name):
+        return self._by_name[name]
+
+    def connect(self, source, target, lanes=None, shift=0, offset=0.0, merge=False):
+        # source/target: names. lanes: source lanes to connect, default all
+        # that land on a lane of the target.
+        a, b = self._by_name[source], self._by_name[target]
+        if lanes is None:
+            lanes = [l for l in range(a.num_lanes) if 0 <= l + shift < b.num_lanes]
+        for lane in lanes:
+            if not 0 <= lane + shift < b.num_lanes:
+                raise ValueError(f"{source} lane {lane} has no lane {lane + shift} in {target}")
+            if a.outgoing[lane] is not None:
+                raise ValueError(f"{source} lane {lane} is already connected")
+        if not 0 <= offset < b.length:
+            raise ValueError(f"offset {offset} outside {target}")
+        connection = Connection(len(self.connections), a.index, b.index, list(lanes), shift, offset, merge)
+        self.connections.append(connection)
+        for lane in lanes:
+            a.outgoing[lane] = connection
+        b.incoming.append(connection)
+        return connection
+
+
+def corridor(sections, lanes=3, length=1000.0, weave_length=400.0, ramp_length=300.0,
+             inflow=3600.0, ramp_inflow=600.0):
+    # Motorway with an on-ramp / off-ramp pair per section. Each section is a
+    # mainline segment followed by a weaving segment with an auxiliary lane
+    # (lane 0) that starts at the on-ramp and ends at the off-ramp.
+    net = RoadNetwork()
+    net.add_segment('main0', length, lanes, inflow)
+    for i in range(sections):
+        net.add_segment(f'on{i}', ramp_length, 1, ramp_inflow)
+        net.add_segment(f'weave{i}', weave_length, lanes + 1)
+        net.add_segment(f'off{i}', ramp_length, 1)
+        net.add_segment(f'main{i + 1}', length, lanes)
+        net.connect(f'main{i}', f'weave{i}', shift=1)
+        net.connect(f'on{i}', f'weave{i}', lanes=[0])
+        net.connect(f'weave{i}', f'off{i}', lanes=[0])
+        net.connect(f'weave{i}', f'main{i + 1}', lanes=list(range(1, lanes + 1)), shift=-1)
+    return net
+
+
+class NetworkSimulation:
+    # Steps the segments in `owned` (default all). With every segment owned,
+    # update() is a complete step; decomposition.py drives the phases itself
+    # and exchanges the boundary data between processes.
+    def __init__(self, network, seed=None, owned=None, base_desired_speed=30):
+        self.network = network
+        self.owned = sorted(owned) if owned is not None else [s.index for s in network.segments]
+        self.base_desired_speed = base_desired_speed
+        self.current_time = 0
+        for i in self.owned:
+            # One generator per segment, so results do not depend on how the
+            # network is split
+            network.segments[i].rng = random.Random(None if seed is None else f"{seed}/{i}")
+
+    def vehicles(self):
+        for i in self.owned:
+            for cars in self.network.segments[i].lane_index.lanes:
+                yield from cars
+
+    def update(self, dt):
+        self.begin_step(dt)
+        migrants = self.step(dt, self.boundary())
+        self.arrive(migrants)
+
+    def begin_step(self, dt):
+        # Advance the clock and let arrivals in at the sources (Bernoulli per
+        # step), when there is room
+        self.current_time += dt
+        count = len(self.network.segments)
+        for i in self.owned:
+            seg = self.network.segments[i]
+            if seg.inflow <= 0:
+                continue
+            if seg.rng.random() < seg.inflow * dt / 3600:
+                seg.pending += 1
+            if not seg.pending:
+                continue
+            lane = seg.rng.randrange(seg.num_lanes)
+            first = seg.lane_index.leader(float('-inf'), lane, wrap=False)
+            if first is not None and first.position - first.length < SPAWN_GAP:
+                continue
+            v = Vehicle(seg.spawned * count + i, 0.0, lane,
+                        self.base_desired_speed + seg.rng.uniform(-2, 2))
+            if first is not None:
+                v.velocity = min(v.velocity, first.velocity)
+            seg.spawned += 1
+            seg.pending -= 1
+            seg.lane_index.insert(v)
+
+    def boundary(self):
+        # Start-of-step data owned segments publish for their neighbors:
+        #   ('ahead', c)  target vehicles near the entry point of connection c
+        #   ('behind', c) source vehicles near the end, in the lanes of c
+        # as {lane: [(id, position, velocity, length), ...]} in own coordinates
+        owned = set(self.owned)
+        data = {}
+        for c in self.network.connections:
+            if c.target in owned:
+                seg = self.network.segments[c.target]
+                data[('ahead', c.index)] = {
+                    lane + c.shift: [(v.id, v.position, v.velocity, v.length) for v in
+                                     seg.lane_index.between(lane + c.shift, c.offset - REACH, c.offset + REACH)]
+                    for lane in c.lanes}
+            if c.source in owned:
+                seg = self.network.segments[c.source]
+                data[('behind', c.index)] = {
+                    lane: [(v.id, v.position, v.velocity, v.length) for v in
+                           seg.lane_index.between(lane, seg.length - REACH, seg.length)]
+                    for lane in c.lanes}
+        return data
+
+    def _prepare_ghosts(self, data):
+        for i in self.owned:
+            seg = self.network.segments[i]
+            for lane in range(seg.num_lanes):
+                seg.beyond[lane] = self._leader_beyond(seg, lane, data)
+            behind = [[] for _ in range(seg.num_lanes)]
+            for c in seg.incoming:
+                source_length = self.network.segments[c.source].length
+                for lane, cars in data[('behind', c.index)].items():
+                    for id, position, velocity, length in cars:
+                        behind[lane + c.shift].append(
+                            Ghost(id, c.offset - (source_length - position), velocity, length, lane + c.shift))
+            for lane, ghosts in enumerate(behind):
+                ghosts.sort(key=lambda g: g.position)
+                seg.ghosts_behind[lane] = ghosts
+                seg.ghost_keys[lane] = [g.position for g in ghosts]
+
+    def _leader_beyond(self, seg, lane, data):
+        c = seg.outgoing[lane]
+        if c is None:
+            if seg.is_sink:
+                return None # the road goes on off the network
+            return Ghost(-1, seg.length, 0.0, 0.0, lane) # lane ends: stopped at the end
+        cars = data[('ahead', c.index)][lane + c.shift]
+        if c.merge:
+            # Yield: treat the end as closed while the target lane has
+            # somebody at the entry point or closing in on it
+            for id, position, velocity, length in cars:
+                rel = position - c.offset
+                if -(MERGE_GAP + velocity * MERGE_HEADWAY) < rel < MERGE_GAP + length:
+                    return Ghost(-1, seg.length, 0.0, 0.0, lane)
+        for id, position, velocity, length in cars:
+            if position >= c.offset:
+                return Ghost(id, seg.length + position - c.offset, velocity, length, lane)
+        return None
+
+    def _leader(self, seg, position, lane):
+        v = seg.lane_index.leader(position, lane, wrap=False)
+        return v if v is not None else seg.beyond[lane]
+
+    def _follower(self, seg, position, lane):
+        v = seg.lane_index.follower(position, lane, wrap=False)
+        keys = seg.ghost_keys[lane]
+        if keys:
+            i = bisect.bisect_left(keys, position) - 1
+            if i >= 0 and (v is None or keys[i] > v.position):
+                return seg.ghosts_behind[lane][i]
+        return v
+
+    def step(self, dt, data):
+        # Move every vehicle of the owned segments one step. Returns the
+        # vehicles that crossed into another segment as (target, source,
+        # vehicle), already in the target's coordinates.
+        self._prepare_ghosts(data)
+        migrants = []
+        for i in self.owned:
+            seg = self.network.segments[i]
+            index = seg.lane_index
+            num_lanes = seg.num_lanes
+            for v in index.ordered():
+                leader = self._leader(seg, v.position, v.lane)
+                neighbors = {}
+                left = v.lane + 1
+                if left < num_lanes:
+                    neighbors['left_leader'] = self._leader(seg, v.position, left)
+                    neighbors['left_follower'] = self._follower(seg, v.position, left)
+                right = v.lane - 1
+                if right >= 0:
+                    neighbors['right_leader'] = self._leader(seg, v.position, right)
+                    neighbors['right_follower'] = self._follower(seg, v.position, right)
+                v.update(dt, leader, seg.road, neighbors)
+            index.repair(seg.length)
+
+            for v in index.take_beyond(seg.length):
+                c = seg.outgoing[v.lane]
+                if c is not None:
+                    v.position = c.offset + (v.position - seg.length)
+                    v.lane += c.shift
+                    migrants.append((c.target, i, v))
+                elif seg.is_sink:
+                    seg.exited += 1
+                else:
+                    # Overshot the end of a closing lane: hold it there
+                    v.position = seg.length
+                    v.velocity = 0.0
+                    index.insert(v)
+        return migrants
+
+    def arrive(self, migrants):
+        # Insert vehicles handed over by step(), in a fixed order so the
+        # result does not depend on where they came from
+        migrants.sort(key=lambda m: (m[0], m[1], m[2].id))
+        for target, _, v in migrants:
+            self.network.segments[target].lane_index.insert(v)
+
+    def stats(self):
+        segments = [self.network.segments[i] for i in self.owned]
+        speeds = [v.velocity for v in self.vehicles()]
+        return {
+            'time': self.current_time,
+            'vehicles': len(speeds),
+            'speed_sum': sum(speeds),
+            'spawned': sum(s.spawned for s in segments),
+            'exited': sum(s.exited for s in segments),
+            'pending': sum(s.pending for s in segments),
+        }
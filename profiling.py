@@ -0,0 +1,124 @@
+from collections import deque
+from time import perf_counter
+
+# Phases timed by SimulationController.update when profiling is on
+PHASES = ('spawn', 'sort', 'neighbors', 'vehicles', 'lanes')
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    i = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[i]
+
+
+class PhaseProfiler:
+    # Rolling per-phase timings (seconds per step) over the last `window`
+    # steps, plus lane-change counters. Anybody can add phases of their own,
+    # e.g. the renderer timing each frame.
+    def __init__(self, window=600):
+        self.window = window
+        self.samples = {phase: deque(maxlen=window) for phase in PHASES}
+        self.lane_change_evaluations = 0
+        self.lane_change_accepted = 0
+        self._lane_changes = deque(maxlen=window) # (evaluated, accepted) per step
+
+    def add(self, phase, seconds):
+        samples = self.samples.get(phase)
+        if samples is None:
+            samples = self.samples[phase] = deque(maxlen=self.window)
+        samples.append(seconds)
+
+    def count_lane_changes(self, evaluated, accepted):
+        self.lane_change_evaluations += evaluated
+        self.lane_change_accepted += accepted
+        self._lane_changes.append((evaluated, accepted))
+
+    # Hooks SimulationController.update calls at the boundaries of its
+    # phases. Each adds the time since the previous hook to a phase; the
+    # neighbor lookups and vehicle updates of a step add up per vehicle.
+    def begin_step(self):
+        self._neighbors = self._vehicles = 0.0
+        self._evaluated = self._accepted = 0
+        self._mark = perf_counter()
+
+    def end_phase(self, phase):
+        now = perf_counter()
+        self.add(phase, now - self._mark)
+        self._mark = now
+
+    def lookups_done(self):
+        now = perf_counter()
+        self._neighbors += now - self._mark
+        self._mark = now
+
+    def vehicle_done(self, lane_change):
+        # lane_change: what the integrator returned (None: not evaluated)
+        now = perf_counter()
+        self._vehicles += now - self._mark
+        self._mark = now
+        if lane_change is not None:
+            self._evaluated += 1
+            self._accepted += lane_change
+
+    def vehicles_done(self):
+        self.add('neighbors', self._neighbors)
+        self.add('vehicles', self._vehicles)
+        self.count_lane_changes(self._evaluated, self._accepted)
+        self._mark = perf_counter()
+
+    def reset(self):
+        for samples in self.samples.values():
+            samples.clear()
+        self.lane_change_evaluations = 0
+        self.lane_change_accepted = 0
+        self._lane_changes.clear()
+
+    def stats(self):
+        # {'phases': {phase: {last, mean, p50, p95, p99} in ms}, 'lane_changes': {...}}
+        phases = {}
+        for phase, samples in self.samples.items():
+            if not samples:
+                continue
+            ordered = sorted(samples)
+            phases[phase] = {
+                'last': samples[-1] * 1e3,
+                'mean': sum(ordered) / len(ordered) * 1e3,
+                'p50': percentile(ordered, 0.50) * 1e3,
+                'p95': percentile(ordered, 0.95) * 1e3,
+                'p99': percentile(ordered, 0.99) * 1e3,
+            }
+        evaluated = sum(e for e, _ in self._lane_changes)
+        accepted = sum(a for _, a in self._lane_changes)
+        steps = max(len(self._lane_changes), 1)
+        return {
+            'phases': phases,
+            'lane_changes': {
+                'evaluations_total': self.lane_change_evaluations,
+                'accepted_total': self.lane_change_accepted,
+                'evaluations_per_step': evaluated / steps,
+                'accepted_per_step': accepted / steps,
+                'acceptance_rate': accepted / evaluated if evaluated else 0.0,
+            },
+        }
+
+
+class NullProfiler:
+    # The hooks of PhaseProfiler doing nothing, used while profiling is off
+    def begin_step(self):
+        pass
+
+    def end_phase(self, phase):
+        pass
+
+    def lookups_done(self):
+        pass
+
+    def vehicle_done(self, lane_change):
+        pass
+
+    def vehicles_done(self):
+        pass
+
+
+NO_PROFILER = NullProfiler()
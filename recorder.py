@@ -0,0 +1,193 @@
+import bisect
+import struct
+import numpy as np
+
+# Chunked columnar trajectory files.
+#
+# File:   MAGIC, FILE_HEADER, then chunks appended as the run goes.
+# Chunk:  CHUNK_HEADER (tag, n_steps, n_rows, reserved)
+#         times   float64[n_steps]   simulation time of each step
+#         counts  uint32[n_steps]    vehicles recorded in each step
+#         one block per column in COLUMNS, n_rows values each
+# Zones:  CHUNK_HEADER (ZONE_TAG, n_zones, 0, 0)
+#         time    float64            first step with these zones
+#         zones   float64[n_zones, 3] start, end, limit
+#         written whenever the speed limit zones change, so a replay draws
+#         the zones the vehicles were really driving through
+# A step never spans two chunks. The writer only buffers the current chunk,
+# so memory stays bounded however long the run is; the reader memory-maps
+# the file and hands out zero-copy views.
+
+MAGIC = b'SIMTRAJ\x00'
+VERSION = 2 # 1: no zone chunks
+# version, num_lanes, road_length, reference_speed (m/s, used for colours)
+FILE_HEADER = struct.Struct('<HHdd')
+CHUNK_TAG = b'CHNK'
+CHUNK_HEADER = struct.Struct('<4sIII')
+ZONE_TAG = b'ZONE'
+
+COLUMNS = (
+    ('ids', np.dtype('<i8')),
+    ('positions', np.dtype('<f4')),
+    ('lanes', np.dtype('u1')),
+    ('velocities', np.dtype('<f4')),
+    ('accelerations', np.dtype('<f4')),
+)
+
+
+def _vehicle_columns(sim):
+    if hasattr(sim, 'vehicles'):
+        vehicles = sim.vehicles
+        return (np.fromiter((v.id for v in vehicles), np.int64, len(vehicles)),
+                np.fromiter((v.position for v in vehicles), np.float64, len(vehicles)),
+                np.fromiter((v.lane for v in vehicles), np.int64, len(vehicles)),
+                np.fromiter((v.velocity for v in vehicles), np.float64, len(vehicles)),
+                np.fromiter((v.acceleration for v in vehicles), np.float64, len(vehicles)))
+    return sim.ids, sim.positions, sim.lanes, sim.velocities, sim.accelerations
+
+
+class TrajectoryRecorder:
+    def __init__(self, path, road, reference_speed=0.0, chunk_rows=1 << 16):
+        self.path = path
+        self.chunk_rows = chunk_rows
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+        self.file.write(FILE_HEADER.pack(VERSION, road.num_lanes, road.length, reference_speed))
+        self._zones = () # last zones written
+        self._reset_chunk()
+
+    def _reset_chunk(self):
+        self._times = []
+        self._counts = []
+        self._blocks = [[] for _ in COLUMNS]
+        self._rows = 0
+
+    def record(self, sim):
+        # Called by the controller at the end of each update
+        zones = tuple((z['start'], z['end'], z['limit']) for z in sim.road.speed_limit_zones)
+        if zones != self._zones:
+            self.record_zones(sim.current_time, zones)
+        self.record_step(sim.current_time, *_vehicle_columns(sim))
+
+    def record_zones(self, time, zones):
+        # The steps before the change go out first, keeping the file in
+        # time order
+        self.flush()
+        self.file.write(CHUNK_HEADER.pack(ZONE_TAG, len(zones), 0, 0))
+        self.file.write(np.array([time], dtype='<f8').tobytes())
+        self.file.write(np.array(zones, dtype='<f8').reshape(-1, 3).tobytes())
+        self._zones = tuple(zones)
+
+    def record_step(self, time, ids, positions, lanes, velocities, accelerations):
+        for block, (_, dtype), values in zip(self._blocks, COLUMNS,
+                                             (ids, positions, lanes, velocities, accelerations)):
+            block.append(np.asarray(values).astype(dtype))
+        self._times.append(time)
+        self._counts.append(len(ids))
+        self._rows += len(ids)
+        if self._rows >= self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+        if not self._times:
+            return
+        write = self.file.write
+        write(CHUNK_HEADER.pack(CHUNK_TAG, len(self._times), self._rows, 0))
+        write(np.array(self._times, dtype='<f8').tobytes())
+        write(np.array(self._counts, dtype='<u4').tobytes())
+        for block, (_, dtype) in zip(self._blocks, COLUMNS):
+            write(np.concatenate(block).astype(dtype, copy=False).tobytes() if block else b'')
+        self.file.flush()
+        self._reset_chunk()
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+
+class TrajectoryReader:
+    def __init__(self, path):
+        self.data = np.memmap(path, dtype=np.uint8, mode='r')
+        if bytes(self.data[:len(MAGIC)]) != MAGIC:
+            raise ValueError(f"{path} is not a trajectory file")
+        offset = len(MAGIC)
+        version, self.num_lanes, self.road_length, self.reference_speed = \
+            FILE_HEADER.unpack_from(self.data, offset)
+        if version not in (1, VERSION):
+            raise ValueError(f"unsupported trajectory version {version}")
+        offset += FILE_HEADER.size
+
+        # Scan the chunk headers once; the payload stays on disk
+        self.chunks = []
+        self.zone_times = [] # when the zones changed
+        self.zone_sets = [] # [(start, end, limit), ...] from then on
+        times, step_chunk, step_start, step_count = [], [], [], []
+        while offset + CHUNK_HEADER.size <= len(self.data):
+            tag, n_steps, n_rows, _ = CHUNK_HEADER.unpack_from(self.data, offset)
+            if tag == ZONE_TAG:
+                size = CHUNK_HEADER.size + 8 + n_steps * 24
+                if offset + size > len(self.data):
+                    break
+                pos = offset + CHUNK_HEADER.size
+                self.zone_times.append(float(np.frombuffer(self.data, '<f8', 1, pos)[0]))
+                zones = np.frombuffer(self.data, '<f8', n_steps * 3, pos + 8).reshape(-1, 3)
+                self.zone_sets.append([tuple(float(x) for x in zone) for zone in zones])
+                offset += size
+                continue
+            size = CHUNK_HEADER.size + n_steps * 12 + n_rows * sum(d.itemsize for _, d in COLUMNS)
+            if tag != CHUNK_TAG or offset + size > len(self.data):
+                break # truncated tail of an interrupted recording
+            pos = offset + CHUNK_HEADER.size
+            chunk_times = np.frombuffer(self.data, '<f8', n_steps, pos)
+            pos += n_steps * 8
+            counts = np.frombuffer(self.data, '<u4', n_steps, pos)
+            pos += n_steps * 4
+            columns = {}
+            for name, dtype in COLUMNS:
+                columns[name] = np.frombuffer(self.data, dtype, n_rows, pos)
+                pos += n_rows * dtype.itemsize
+            self.chunks.append(columns)
+            times.append(chunk_times)
+            step_chunk.append(np.full(n_steps, len(self.chunks) - 1, dtype=np.int64))
+            step_start.append(np.cumsum(counts, dtype=np.int64) - counts)
+            step_count.append(counts.astype(np.int64))
+            offset += size
+
+        def join(parts, dtype):
+            return np.concatenate(parts) if parts else np.empty(0, dtype=dtype)
+
+        # Per-step lookup tables, enough to seek to any time in O(log steps)
+        self.times = join(times, np.float64)
+        self._step_chunk = join(step_chunk, np.int64)
+        self._step_start = join(step_start, np.int64)
+        self._step_count = join(step_count, np.int64)
+
+    def __len__(self):
+        return len(self.times)
+
+    @property
+    def start_time(self):
+        return float(self.times[0]) if len(self.times) else 0.0
+
+    @property
+    def end_time(self):
+        return float(self.times[-1]) if len(self.times) else 0.0
+
+    def step_at(self, time):
+        # Index of the last recorded step at or before time
+        i = int(np.searchsorted(self.times, time, side='right')) - 1
+        return min(max(i, 0), len(self.times) - 1)
+
+    def zones_at(self, time):
+        # Speed limit zones in force at time: [(start, end, limit), ...] in
+        # m and m/s
+        i = bisect.bisect_right(self.zone_times, time) - 1
+        return self.zone_sets[i] if i >= 0 else []
+
+    def frame(self, step):
+        # Zero-copy views of one step: dict column name -> array
+        columns = self.chunks[self._step_chunk[step]]
+        start = self._step_start[step]
+        stop = start + self._step_count[step]
+        return {name: columns[name][start:stop] for name, _ in COLUMNS}
@@ -0,0 +1,118 @@
+import numpy as np
+import pygame
+
+# Batch drawing of vehicle markers.
+#
+# Up to LOD_VEHICLES every vehicle is a filled disc, as before, but instead
+# of one pygame.draw.circle call each the discs are pre-rendered once per
+# colour and the whole frame goes out in a single Surface.blits call.
+# Past that the discs would merge into a solid band anyway (and even batched
+# they cost more than the rest of the frame): vehicles are binned into
+# squares of LOD_BIN pixels instead, and each occupied square is painted,
+# in one array write into the screen pixels, by the mean speed of its
+# vehicles, or their mean colour when no speeds are given.
+
+MARKER_RADIUS = 5 # px, the size of the pygame.draw.circle markers
+LOD_VEHICLES = 2000
+LOD_BIN = 3 # px
+
+# Same colours and thresholds as Vehicle._update_color
+STOPPED_COLOR = (255, 0, 0)
+SLOW_COLOR = (255, 165, 0)
+FREE_COLOR = (0, 255, 0)
+STOPPED_SPEED = 2.0 # m/s
+SLOW_FRACTION = 0.6 # of the reference speed
+
+
+def status_colors(velocities, reference_speed):
+    # Vehicle._update_color for arrays of speeds, against one reference
+    # speed instead of each vehicle's limit
+    velocities = np.asarray(velocities)
+    colors = np.empty((len(velocities), 3), dtype=np.uint8)
+    colors[:] = FREE_COLOR
+    colors[velocities < reference_speed * SLOW_FRACTION] = SLOW_COLOR
+    colors[velocities < STOPPED_SPEED] = STOPPED_COLOR
+    return colors
+
+
+def speed_ramp(ratios):
+    # Continuous version of the status colours for mean speeds, as a
+    # fraction of the reference speed: red when stopped, orange at
+    # SLOW_FRACTION, green from 1 on
+    stops = np.array([0.0, SLOW_FRACTION, 1.0])
+    ratios = np.clip(ratios, 0.0, 1.0)
+    return np.stack([np.interp(ratios, stops, [STOPPED_COLOR[c], SLOW_COLOR[c], FREE_COLOR[c]])
+                     for c in range(3)], axis=1).astype(np.uint8)
+
+
+class VehicleRenderer:
+    def __init__(self, radius=MARKER_RADIUS, lod_vehicles=LOD_VEHICLES, lod_bin=LOD_BIN):
+        self.radius = radius
+        self.lod_vehicles = lod_vehicles
+        self.lod_bin = lod_bin
+        self.block = tuple(a.ravel() for a in np.mgrid[0:lod_bin, 0:lod_bin])
+        self.sprites = {} # packed 0xRRGGBB -> disc surface
+        self.mode = None # 'markers' or 'lod', for the last frame drawn
+
+    def draw(self, surface, xs, ys, colors=None, velocities=None, reference_speed=None):
+        # colors (n, 3), or velocities and reference_speed to colour by
+        # status/mean speed
+        xs = np.asarray(xs).astype(np.int64) # truncated, like int(x)
+        ys = np.asarray(ys).astype(np.int64)
+        if len(xs) > self.lod_vehicles:
+            self.mode = 'lod'
+            self._draw_bins(surface, xs, ys, colors, velocities, reference_speed)
+        else:
+            self.mode = 'markers'
+            if colors is None:
+                colors = status_colors(velocities, reference_speed)
+            self._draw_markers(surface, xs, ys, np.asarray(colors, dtype=np.int64).reshape(-1, 3))
+
+    def _sprite(self, key):
+        # Disc of colour key on a colour key background (its complement, so
+        # never the disc colour itself)
+        sprite = self.sprites.get(key)
+        if sprite is None:
+            color = ((key >> 16) & 255, (key >> 8) & 255, key & 255)
+            size = 2 * self.radius + 1
+            sprite = pygame.Surface((size, size))
+            sprite.fill(tuple(255 - c for c in color))
+            sprite.set_colorkey(tuple(255 - c for c in color))
+            pygame.draw.circle(sprite, color, (self.radius, self.radius), self.radius)
+            self.sprites[key] = sprite
+        return sprite
+
+    def _draw_markers(self, surface, xs, ys, colors):
+        # Later vehicles cover earlier ones, as with one draw call each
+        keys = (colors[:, 0] << 16) | (colors[:, 1] << 8) | colors[:, 2]
+        sprites = {key: self._sprite(key) for key in set(keys.tolist())}
+        r = self.radius
+        surface.blits([(sprites[key], (x - r, y - r))
+                       for key, x, y in zip(keys.tolist(), xs.tolist(), ys.tolist())], doreturn=False)
+
+    def _draw_bins(self, surface, xs, ys, colors, velocities, reference_speed):
+        b = self.lod_bin
+        width, height = surface.get_size()
+        inside = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+        columns = (height + b - 1) // b
+        keys = (xs[inside] // b) * columns + ys[inside] // b
+        occupied, index, counts = np.unique(keys, return_inverse=True, return_counts=True)
+        if velocities is not None:
+            speeds = np.bincount(index, weights=np.asarray(velocities)[inside]) / counts
+            bin_colors = speed_ramp(speeds / reference_speed)
+        else:
+            colors = np.asarray(colors, dtype=np.float64)[inside]
+            bin_colors = np.stack([np.bincount(index, weights=colors[:, c]) / counts for c in range(3)],
+                                  axis=1).astype(np.uint8)
+
+        # Every pixel of every occupied square in one write, as mapped
+        # surface colours
+        dx, dy = self.block
+        px = ((occupied // columns) * b)[:, None] + dx
+        py = ((occupied % columns) * b)[:, None] + dy
+        fits = (px < width) & (py < height)
+        mapped = pygame.surfarray.map_array(surface, bin_colors)
+        rows = np.broadcast_to(np.arange(len(occupied))[:, None], px.shape)
+        pixels = pygame.surfarray.pixels2d(surface)
+        pixels[px[fits], py[fits]] = mapped[rows[fits]]
+        del pixels # unlocks the surface
@@ -0,0 +1,139 @@
+import json
+from model import INTEGRATORS, fleet_mix
+
+# Declarative scenario files: road, zones, vehicle mix, seed and a timed
+# schedule of control actions, as JSON lines.
+#
+# The first line is the setup; every key is optional:
+#   {"length": 3442.5, "lanes": 2, "seed": 7, "vehicles": 150, "speed_kmh": 120,
+#    "fleet": {"car": 0.8, "truck": 0.2}, "integrator": "euler",
+#    "zones": [[200, 600, 120], [1400, 1800, 80]],
+#    "equilibrium": true, "perturbation": 0.1}
+# (zones as [start, end, km/h], like --zone). Every other line is one
+# action at simulated time t, in time order; a line may combine several:
+#   {"t": 30, "zone": 1, "limit_kmh": 40}
+#   {"t": 90, "speed_kmh": 100, "vehicles": 200}
+#   {"t": 120, "fleet": {"car": 0.5, "truck": 0.5}}
+#
+# Loading reads the setup line only. The schedule is read one line at a time
+# as the simulation reaches it, so a file with thousands of actions costs
+# neither the time to parse them up front nor the memory to hold them.
+# Actions become the setter calls the controllers, worker.SimulationWorker
+# and server.SimulationClient share; a zone limit change is
+# set_zone_limit(index, limit), which patches that zone alone.
+
+SETUP_KEYS = ('name', 'length', 'lanes', 'seed', 'vehicles', 'speed_kmh', 'fleet', 'integrator',
+              'zones', 'equilibrium', 'perturbation')
+# Time slack when comparing action times with a clock summed from steps
+TIME_EPSILON = 1e-9
+
+
+def _check_fleet(shares, where):
+    try:
+        fleet_mix(shares)
+    except (ValueError, AttributeError, TypeError) as e:
+        raise ValueError(f"{where}: bad fleet: {e}") from None
+
+
+def parse_action(entry, where='action'):
+    # (t, [(command, args), ...]) for one schedule entry
+    if not isinstance(entry, dict) or not isinstance(entry.get('t'), (int, float)):
+        raise ValueError(f"{where}: an action needs a time 't'")
+    calls = []
+    if 'zone' in entry or 'limit_kmh' in entry:
+        if not isinstance(entry.get('zone'), int) or not isinstance(entry.get('limit_kmh'), (int, float)):
+            raise ValueError(f"{where}: a zone change needs 'zone' (index) and 'limit_kmh'")
+        calls.append(('set_zone_limit', (entry['zone'], entry['limit_kmh'] / 3.6)))
+    if 'speed_kmh' in entry:
+        calls.append(('set_base_desired_speed', (entry['speed_kmh'] / 3.6,)))
+    if 'vehicles' in entry:
+        calls.append(('set_target_vehicle_count', (int(entry['vehicles']),)))
+    if 'fleet' in entry:
+        _check_fleet(entry['fleet'], where)
+        calls.append(('set_fleet', (entry['fleet'],)))
+    unknown = set(entry) - {'t', 'zone', 'limit_kmh', 'speed_kmh', 'vehicles', 'fleet'}
+    if unknown or not calls:
+        raise ValueError(f"{where}: unknown action {sorted(unknown) or entry}")
+    return float(entry['t']), calls
+
+
+class Scenario:
+    def __init__(self, setup=None, path=None):
+        # setup: dict of SETUP_KEYS; path: file the schedule is read from
+        setup = dict(setup or {})
+        where = path or 'scenario'
+        unknown = set(setup) - set(SETUP_KEYS)
+        if unknown:
+            raise ValueError(f"{where}: unknown setup keys {sorted(unknown)}")
+        if setup.get('fleet') is not None:
+            _check_fleet(setup['fleet'], where)
+        if setup.get('integrator', 'euler') not in INTEGRATORS:
+            raise ValueError(f"{where}: unknown integrator {setup['integrator']!r}")
+        self.setup = setup
+        self.path = path
+        self.zones = [tuple(float(x) for x in zone) for zone in setup.get('zones', ())]
+        if any(len(zone) != 3 for zone in self.zones):
+            raise ValueError(f"{where}: zones are [start, end, km/h]")
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            line = f.readline()
+        try:
+            setup = json.loads(line)
+        except ValueError as e:
+            raise ValueError(f"{path}:1: {e}") from None
+        if not isinstance(setup, dict):
+            raise ValueError(f"{path}:1: the first line is the setup object")
+        return cls(setup, path)
+
+    def get(self, key, default=None):
+        return self.setup.get(key, default)
+
+    def actions(self):
+        # (t, command, args) in schedule order, read lazily from the file;
+        # a time going backwards is an error when it is reached
+        if self.path is None:
+            return
+        last = float('-inf')
+        with open(self.path) as f:
+            f.readline()
+            for number, line in enumerate(f, 2):
+                if not line.strip():
+                    continue
+                where = f"{self.path}:{number}"
+                try:
+                    entry = json.loads(line)
+                except ValueError as e:
+                    raise ValueError(f"{where}: {e}") from None
+                t, calls = parse_action(entry, where)
+                if t < last:
+                    raise ValueError(f"{where}: t={t:g} comes after t={last:g}")
+                last = t
+                for command, args in calls:
+                    yield t, command, args
+
+
+class ScenarioPlayer:
+    # Applies the actions of a schedule as simulated time reaches them,
+    # holding only the next one
+    def __init__(self, actions):
+        self._actions = iter(actions)
+        self._next = next(self._actions, None)
+        self.applied = 0
+
+    @property
+    def done(self):
+        return self._next is None
+
+    def advance(self, target, time):
+        # Call every action due by time on target (a controller, a worker
+        # handle or anything else with the same setters); returns how many
+        count = 0
+        while self._next is not None and self._next[0] <= time + TIME_EPSILON:
+            _, command, args = self._next
+            getattr(target, command)(*args)
+            count += 1
+            self._next = next(self._actions, None)
+        self.applied += count
+        return count
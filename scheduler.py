@@ -0,0 +1,74 @@
+# Lane change scheduling.
+#
+# Evaluating a lane change means looking up four neighbors and computing two
+# IDM accelerations, and almost every evaluation rejects. A lane change only
+# pays off when the acceleration gained beats the threshold (0.5 m/s², see
+# Vehicle._try_lane_change), and the gain can never exceed the braking the
+# current leader imposes, Vehicle.leader_pressure. Each step the scheduler
+# decides who evaluates:
+#   - vehicles still in cooldown are parked: no lookups at all
+#   - vehicles whose pressure is above PRIORITY_PRESSURE (caught up with a
+#     slower leader, gap closing) are evaluated every step
+#   - everybody else cannot gain enough to change lanes; they are only
+#     checked once every `interval` seconds, staggered by id
+# The traffic is statistically equivalent to evaluating every vehicle every
+# step, not identical in general. The pressure is taken before the vehicle
+# moves, and PRIORITY_PRESSURE leaves room for what a step changes in
+# between. With small steps (dt = 0.1 s, or 0.5 s with the ballistic
+# integrators) the lane changes fall on exactly the same steps. A large
+# Euler step can take a vehicle from below the threshold to a lane change in
+# one go; at dt = 0.5 s the runs part within a few hundred steps. Delaying
+# the pressured vehicles too is not an option: most opportunities last a
+# step or two, before another vehicle takes the gap.
+
+PRIORITY_PRESSURE = 0.25 # m/s², half the lane change threshold
+DEFAULT_INTERVAL = 1.0 # seconds between checks of the other vehicles
+
+
+class LaneChangeScheduler:
+    def __init__(self, interval=DEFAULT_INTERVAL, threshold=PRIORITY_PRESSURE):
+        self.interval = interval
+        self.threshold = threshold
+        self.step = 0
+        self.period = 1
+        # Decisions since the last reset
+        self.evaluated = 0
+        self.parked = 0
+        self.deferred = 0
+
+    def begin_step(self, dt):
+        self.step += 1
+        self.period = max(1, int(round(self.interval / dt)))
+
+    def due(self, vehicle, leader, dt, road_length):
+        # Whether vehicle evaluates a lane change in this step. leader is its
+        # leader in the current lane, as passed to the vehicle's update.
+        cooldown = vehicle.cooldown
+        if cooldown > 0 and cooldown - dt > 0:
+            self.parked += 1
+            return False
+        if ((self.step + vehicle.id) % self.period == 0 or leader is vehicle or
+                (leader is not None and vehicle.leader_pressure(leader, road_length) > self.threshold)):
+            self.evaluated += 1
+            return True
+        self.deferred += 1
+        return False
+
+    def due_many(self, ids, cooldowns, pressures):
+        # Batched due() for the vectorized engine: cooldowns are already
+        # decremented for this step, pressures are inf for a vehicle alone in
+        # its lane and 0 without a leader
+        return (cooldowns <= 0) & (((self.step + ids) % self.period == 0) | (pressures > self.threshold))
+
+    def record(self, evaluated, parked, deferred):
+        self.evaluated += evaluated
+        self.parked += parked
+        self.deferred += deferred
+
+    def stats(self):
+        total = self.evaluated + self.parked + self.deferred
+        return {'evaluated': self.evaluated, 'parked': self.parked, 'deferred': self.deferred,
+                'evaluated_fraction': self.evaluated / total if total else 0.0}
+
+    def reset(self):
+        self.evaluated = self.parked = self.deferred = 0
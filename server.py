@@ -0,0 +1,480 @@
+import argparse
+import asyncio
+import json
+import struct
+import sys
+import time
+import numpy as np
+import headless
+from worker import apply_command, vehicle_state, PHYSICS_DT, MAX_CATCHUP_STEPS
+
+# Streams the simulation to remote dashboards over TCP and takes commands
+# back.
+#
+# The server steps a controller against the wall clock inside the event loop
+# and takes a snapshot of the vehicles every frame interval. Each client is
+# sent the latest snapshot whenever it has fewer than MAX_IN_FLIGHT frames
+# not yet acknowledged: a client that reads slowly skips the snapshots that
+# came meanwhile, instead of falling behind through the socket buffers, and
+# never holds the physics back.
+#
+# Every message, both ways, is a uint32 length followed by the payload.
+# Server to client, a one-byte tag and then:
+#   b'I' JSON   road and stream info, on connect and when the zones change
+#   b'F' frame  vehicle state, see below
+#   b'E' JSON   a command that failed
+# Client to server: an empty message acknowledges a frame once it has been
+# handled; anything else is JSON {"command": name, "args": [...]} with the
+# commands of worker.apply_command (set_target_vehicle_count,
+# set_base_desired_speed, set_speed_limit_zones, set_zone_limit, set_fleet,
+# populate). Commands run between steps inside the event loop, so vehicle
+# counts from clients are capped at max_vehicles, like the shared buffer of
+# worker.SimulationWorker caps its own: a populate(10**7) would otherwise
+# stall the physics and every client.
+#
+# Frames are delta encoded against the previous frame sent to the same
+# client, with vehicles sorted by id. Positions are quantized to
+# POSITION_QUANTUM and speeds to SPEED_QUANTUM; deltas are taken between
+# quantized values, so the client rebuilds exactly what was encoded and
+# rounding never accumulates.
+#   FRAME_HEADER     simulation time, step, kept, removed, added
+#   removed ids      uint32[removed]
+#   kept vehicles    int16 position deltas, int16 speed deltas, int8 lane
+#                    deltas: the vehicles of the previous frame, minus the
+#                    removed ones, in order
+#   added vehicles   uint32 ids, uint32 positions, uint16 speeds, uint8 lanes
+# A vehicle whose change does not fit its delta (frames far apart) is sent
+# as removed and added again. The first frame adds every vehicle: a kept
+# vehicle costs 5 bytes, an added one 11.
+#   python server.py --port 8765 --vehicles 150
+#   python server.py --connect 127.0.0.1:8765 --duration 10
+
+DEFAULT_PORT = 8765
+FRAME_INTERVAL = 1 / 30 # seconds of simulation between snapshots
+MAX_IN_FLIGHT = 2 # frames sent to a client and not acknowledged yet
+DEFAULT_MAX_VEHICLES = 1 << 12 # most vehicles a client can ask for
+# Commands whose first argument is a vehicle count
+COUNT_COMMANDS = ('set_target_vehicle_count', 'populate')
+POSITION_QUANTUM = 0.01 # m
+SPEED_QUANTUM = 0.01 # m/s
+
+MESSAGE_HEADER = struct.Struct('<I')
+INFO = b'I'
+FRAME = b'F'
+ERROR = b'E'
+FRAME_HEADER = struct.Struct('<dqIII')
+DELTA_LIMIT = 32767 # int16
+LANE_DELTA_LIMIT = 127 # int8
+
+
+def _message(payload):
+    return MESSAGE_HEADER.pack(len(payload)) + payload
+
+
+async def _read_message(reader):
+    # Payload of the next message, or None once the peer has closed
+    try:
+        size, = MESSAGE_HEADER.unpack(await reader.readexactly(MESSAGE_HEADER.size))
+        return await reader.readexactly(size)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+
+
+def snapshot(sim, step, road_length):
+    # (time, step, ids, positions, speeds, lanes), quantized and sorted by id
+    ids, positions, velocities, lanes, _ = vehicle_state(sim)
+    order = np.argsort(ids, kind='stable')
+    modulus = int(round(road_length / POSITION_QUANTUM))
+    return (sim.current_time, step, ids[order].astype(np.uint32),
+            np.rint(positions[order] / POSITION_QUANTUM).astype(np.int64) % modulus,
+            np.clip(np.rint(velocities[order] / SPEED_QUANTUM), 0, 65535).astype(np.int64),
+            lanes[order].astype(np.int64))
+
+
+class FrameEncoder:
+    # Server side of one client's stream: remembers the last frame sent
+    def __init__(self, road_length):
+        self.modulus = int(round(road_length / POSITION_QUANTUM))
+        self.ids = np.empty(0, dtype=np.uint32)
+        self.positions = np.empty(0, dtype=np.int64)
+        self.speeds = np.empty(0, dtype=np.int64)
+        self.lanes = np.empty(0, dtype=np.int64)
+
+    def encode(self, snapshot):
+        time, step, ids, positions, speeds, lanes = snapshot
+        # Where each vehicle of the previous frame is in this one
+        at = np.minimum(np.searchsorted(ids, self.ids), max(len(ids) - 1, 0))
+        if len(ids):
+            dpos = (positions[at] - self.positions) % self.modulus
+            dpos = np.where(dpos > self.modulus // 2, dpos - self.modulus, dpos) # across the line
+            dspeed = speeds[at] - self.speeds
+            dlane = lanes[at] - self.lanes
+            kept = ((ids[at] == self.ids) & (np.abs(dpos) <= DELTA_LIMIT) &
+                    (np.abs(dspeed) <= DELTA_LIMIT) & (np.abs(dlane) <= LANE_DELTA_LIMIT))
+        else:
+            kept = np.zeros(len(self.ids), dtype=bool)
+        added = np.ones(len(ids), dtype=bool)
+        added[at[kept]] = False
+
+        parts = [FRAME_HEADER.pack(time, step, int(kept.sum()), int(len(kept) - kept.sum()), int(added.sum())),
+                 self.ids[~kept].astype('<u4').tobytes()]
+        if kept.any():
+            parts += [dpos[kept].astype('<i2').tobytes(), dspeed[kept].astype('<i2').tobytes(),
+                      dlane[kept].astype('i1').tobytes()]
+        parts += [ids[added].astype('<u4').tobytes(), positions[added].astype('<u4').tobytes(),
+                  speeds[added].astype('<u2').tobytes(), lanes[added].astype('u1').tobytes()]
+        self.ids, self.positions, self.speeds, self.lanes = ids, positions, speeds, lanes
+        return b''.join(parts)
+
+
+class FrameDecoder:
+    # Client side: rebuilds the state from the frames of one stream
+    def __init__(self, road_length):
+        self.modulus = int(round(road_length / POSITION_QUANTUM))
+        self.ids = np.empty(0, dtype=np.uint32)
+        self.positions = np.empty(0, dtype=np.int64)
+        self.speeds = np.empty(0, dtype=np.int64)
+        self.lanes = np.empty(0, dtype=np.int64)
+
+    def decode(self, payload):
+        # {'time', 'step', 'ids', 'positions' (m), 'velocities' (m/s), 'lanes'}
+        time, step, kept, removed, added = FRAME_HEADER.unpack_from(payload)
+        offset = FRAME_HEADER.size
+
+        def take(dtype, count):
+            nonlocal offset
+            values = np.frombuffer(payload, dtype, count, offset)
+            offset += values.nbytes
+            return values
+
+        gone = take('<u4', removed)
+        dpos, dspeed, dlane = take('<i2', kept), take('<i2', kept), take('i1', kept)
+        new_ids, new_positions = take('<u4', added), take('<u4', added)
+        new_speeds, new_lanes = take('<u2', added), take('u1', added)
+
+        keep = ~np.isin(self.ids, gone, assume_unique=True)
+        ids = np.concatenate((self.ids[keep], new_ids))
+        positions = np.concatenate(((self.positions[keep] + dpos) % self.modulus, new_positions))
+        speeds = np.concatenate((self.speeds[keep] + dspeed, new_speeds))
+        lanes = np.concatenate((self.lanes[keep] + dlane, new_lanes))
+        order = np.argsort(ids, kind='stable')
+        self.ids, self.positions, self.speeds, self.lanes = ids[order], positions[order], speeds[order], lanes[order]
+        return {'time': time, 'step': step, 'ids': self.ids,
+                'positions': self.positions * POSITION_QUANTUM, 'velocities': self.speeds * SPEED_QUANTUM,
+                'lanes': self.lanes}
+
+
+class _Subscriber:
+    # One connected client: the latest snapshot waiting for it, replaced by
+    # newer ones while its connection is busy
+    def __init__(self, writer, road_length):
+        self.writer = writer
+        self.encoder = FrameEncoder(road_length)
+        self.pending = None
+        self.in_flight = 0
+        self.wake = asyncio.Event()
+        self.sent = 0
+        self.dropped = 0
+
+    def offer(self, snapshot):
+        if self.pending is not None:
+            self.dropped += 1
+        self.pending = snapshot
+        self.wake.set()
+
+    def acknowledge(self):
+        if self.in_flight > 0:
+            self.in_flight -= 1
+            self.wake.set()
+
+    async def send_frames(self):
+        while True:
+            await self.wake.wait()
+            self.wake.clear()
+            if self.pending is None or self.in_flight >= MAX_IN_FLIGHT:
+                continue
+            snapshot, self.pending = self.pending, None
+            self.writer.write(_message(FRAME + self.encoder.encode(snapshot)))
+            self.in_flight += 1
+            self.sent += 1
+            # Only this client waits while its socket buffer is full
+            try:
+                await self.writer.drain()
+            except ConnectionError:
+                return # gone; its handler cleans up
+
+
+class SimulationServer:
+    def __init__(self, sim, dt=PHYSICS_DT, frame_interval=FRAME_INTERVAL, max_vehicles=DEFAULT_MAX_VEHICLES):
+        self.sim = sim
+        self.dt = dt
+        self.max_vehicles = max_vehicles
+        self.frame_every = max(1, int(round(frame_interval / dt)))
+        self.step = 0
+        self.subscribers = set()
+        self.server = None
+        self._physics = None
+        self._handlers = set()
+
+    async def start(self, host='127.0.0.1', port=DEFAULT_PORT):
+        # port 0 picks a free one, see self.port
+        self.server = await asyncio.start_server(self._handle, host, port)
+        self._physics = asyncio.create_task(self._run())
+        return self
+
+    @property
+    def port(self):
+        return self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        # Closing the connections ends their handlers, see _handle
+        self._physics.cancel()
+        self.server.close()
+        for subscriber in list(self.subscribers):
+            subscriber.writer.close()
+        await asyncio.gather(*self._handlers, return_exceptions=True)
+        await self.server.wait_closed()
+
+    def info(self):
+        road = self.sim.road
+        return {'road_length': road.length, 'num_lanes': road.num_lanes,
+                'zones': [(z['start'], z['end'], z['limit']) for z in road.speed_limit_zones],
+                'dt': self.dt, 'frame_interval': self.frame_every * self.dt,
+                'position_quantum': POSITION_QUANTUM, 'speed_quantum': SPEED_QUANTUM}
+
+    def stats(self):
+        return {'step': self.step, 'clients': len(self.subscribers),
+                'sent': sum(s.sent for s in self.subscribers),
+                'dropped': sum(s.dropped for s in self.subscribers)}
+
+    async def _run(self):
+        # Fixed steps against the loop clock, like worker.run_worker
+        loop = asyncio.get_running_loop()
+        next_step = loop.time()
+        while True:
+            now = loop.time()
+            steps = 0
+            frame_due = False
+            while next_step <= now and steps < MAX_CATCHUP_STEPS:
+                self.sim.update(self.dt)
+                self.step += 1
+                steps += 1
+                next_step += self.dt
+                frame_due = frame_due or self.step % self.frame_every == 0
+            if next_step < now:
+                next_step = now # too far behind: drop the backlog, keep dt fixed
+            if frame_due and self.subscribers:
+                state = snapshot(self.sim, self.step, self.sim.road.length)
+                for subscriber in self.subscribers:
+                    subscriber.offer(state)
+            await asyncio.sleep(max(0.0, next_step - loop.time()))
+
+    async def _handle(self, reader, writer):
+        self._handlers.add(asyncio.current_task())
+        subscriber = _Subscriber(writer, self.sim.road.length)
+        writer.write(_message(INFO + json.dumps(self.info()).encode()))
+        self.subscribers.add(subscriber)
+        sender = asyncio.create_task(subscriber.send_frames())
+        try:
+            while True:
+                payload = await _read_message(reader)
+                if payload is None:
+                    break
+                if payload:
+                    self._command(subscriber, payload)
+                else:
+                    subscriber.acknowledge()
+        finally:
+            self.subscribers.discard(subscriber)
+            self._handlers.discard(asyncio.current_task())
+            sender.cancel()
+            writer.close()
+
+    def _command(self, subscriber, payload):
+        try:
+            message = json.loads(payload)
+            args = list(message.get('args', []))
+            if message['command'] in COUNT_COMMANDS and args and args[0] is not None:
+                args[0] = min(int(args[0]), self.max_vehicles)
+            apply_command(self.sim, message['command'], args)
+        except Exception as e:
+            # Whatever a client sends, the answer is an error frame: one bad
+            # command must not close its connection
+            subscriber.writer.write(_message(ERROR + json.dumps({'error': str(e)}).encode()))
+            return
+        if message['command'] in ('set_speed_limit_zones', 'set_zone_limit'):
+            info = _message(INFO + json.dumps(self.info()).encode())
+            for other in self.subscribers:
+                other.writer.write(info)
+
+
+class SimulationClient:
+    # Local or remote end of a SimulationServer stream. Setters mirror
+    # SimulationController's, like worker.SimulationWorker.
+    def __init__(self, reader, writer, info):
+        self.reader = reader
+        self.writer = writer
+        self.info = info
+        self.decoder = FrameDecoder(info['road_length'])
+        self.errors = []
+        self.bytes_received = 0
+
+    @classmethod
+    async def connect(cls, host='127.0.0.1', port=DEFAULT_PORT):
+        reader, writer = await asyncio.open_connection(host, port)
+        payload = await _read_message(reader)
+        if payload is None or payload[:1] != INFO:
+            raise ConnectionError("no stream info from the server")
+        return cls(reader, writer, json.loads(payload[1:]))
+
+    async def frames(self):
+        # Decoded frames until the server closes; info and error messages
+        # update self.info and self.errors on the way. Each frame is
+        # acknowledged when the next one is asked for.
+        decoded = False
+        while True:
+            if decoded:
+                self.writer.write(_message(b''))
+                decoded = False
+            payload = await _read_message(self.reader)
+            if payload is None:
+                return
+            self.bytes_received += MESSAGE_HEADER.size + len(payload)
+            tag, body = payload[:1], payload[1:]
+            if tag == FRAME:
+                decoded = True
+                yield self.decoder.decode(body)
+            elif tag == INFO:
+                self.info = json.loads(body)
+            elif tag == ERROR:
+                self.errors.append(json.loads(body)['error'])
+
+    def send(self, command, *args):
+        self.writer.write(_message(json.dumps({'command': command, 'args': args}).encode()))
+
+    def set_target_vehicle_count(self, count, immediate=False):
+        self.send('set_target_vehicle_count', int(count), immediate)
+
+    def set_base_desired_speed(self, speed):
+        self.send('set_base_desired_speed', speed)
+
+    def set_speed_limit_zones(self, zones):
+        # zones: (start, end, limit) triples, replacing the current ones
+        self.send('set_speed_limit_zones', [list(zone) for zone in zones])
+
+    def set_zone_limit(self, index, limit):
+        self.send('set_zone_limit', int(index), limit)
+
+    def set_fleet(self, shares):
+        self.send('set_fleet', shares)
+
+    def populate(self, count=None, perturbation=0.0):
+        self.send('populate', count, perturbation)
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+
+
+async def serve(sim, host, port, dt, frame_interval, max_vehicles=DEFAULT_MAX_VEHICLES):
+    server = await SimulationServer(sim, dt, frame_interval, max_vehicles).start(host, port)
+    print(f"serving on {host}:{server.port}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.close()
+
+
+async def watch(host, port, duration, slow=0.0, commands=()):
+    # Test client: sends commands, then prints once a second what arrives
+    client = await SimulationClient.connect(host, port)
+    info = client.info
+    print(f"road {info['road_length']:g} m, {info['num_lanes']} lanes, "
+          f"frame every {info['frame_interval']:.3f} s")
+    for command, args in commands:
+        client.send(command, *args)
+    frame_steps = max(1, int(round(info['frame_interval'] / info['dt'])))
+    start = report = time.monotonic()
+    frames = skipped = 0
+    received = client.bytes_received
+    last_step = None
+    async for frame in client.frames():
+        frames += 1
+        if last_step is not None:
+            skipped += max(0, (frame['step'] - last_step) // frame_steps - 1)
+        last_step = frame['step']
+        if slow:
+            await asyncio.sleep(slow)
+        now = time.monotonic()
+        if now - report >= 1.0:
+            n = len(frame['ids'])
+            speed = float(frame['velocities'].mean()) * 3.6 if n else 0.0
+            size = (client.bytes_received - received) / frames
+            print(f"t={frame['time']:.1f} s: {frames} frames, {skipped} skipped, {size:.0f} bytes/frame "
+                  f"({size / max(n, 1):.1f}/vehicle), {n} vehicles, {speed:.1f} km/h")
+            for error in client.errors:
+                print(f"error: {error}")
+            client.errors.clear()
+            report = now
+            frames = skipped = 0
+            received = client.bytes_received
+        if now - start >= duration:
+            break
+    await client.close()
+
+
+def parse_address(text):
+    host, _, port = text.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stream the simulation to remote clients over TCP.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--engine', choices=sorted(headless.ENGINES), default='object')
+    parser.add_argument('--vehicles', type=int, default=40)
+    parser.add_argument('--speed', type=float, default=120, help="base desired speed (km/h)")
+    parser.add_argument('--road-length', type=float, default=headless.DEFAULT_ROAD_LENGTH)
+    parser.add_argument('--lanes', type=int, default=2)
+    parser.add_argument('--integrator', choices=sorted(headless.INTEGRATORS), default='euler')
+    parser.add_argument('--zone', type=headless.parse_zone, action='append', default=[],
+                        metavar='START:END:KMH', help="speed limit zone, repeatable")
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--equilibrium', action='store_true',
+                        help="start with the vehicles placed at the IDM equilibrium")
+    parser.add_argument('--dt', type=float, default=PHYSICS_DT, help="fixed time step (s)")
+    parser.add_argument('--max-vehicles', type=int, default=DEFAULT_MAX_VEHICLES,
+                        help="most vehicles a client can set or populate")
+    parser.add_argument('--frame-interval', type=float, default=FRAME_INTERVAL,
+                        help="simulated seconds between frames")
+    parser.add_argument('--connect', type=parse_address, metavar='HOST:PORT',
+                        help="run a test client against a server instead of serving")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds the test client watches")
+    parser.add_argument('--slow', type=float, default=0.0, metavar='SECONDS',
+                        help="test client delay per frame, to see frames being skipped")
+    parser.add_argument('--set-vehicles', type=int, help="test client: change the vehicle count")
+    parser.add_argument('--set-speed', type=float, help="test client: change the desired speed (km/h)")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.connect:
+            commands = []
+            if args.set_vehicles is not None:
+                commands.append(('set_target_vehicle_count', (args.set_vehicles,)))
+            if args.set_speed is not None:
+                commands.append(('set_base_desired_speed', (args.set_speed / 3.6,)))
+            asyncio.run(watch(*args.connect, args.duration, args.slow, commands))
+        else:
+            sim = headless.build_controller(args.engine, args.road_length, args.vehicles, args.speed,
+                                            args.zone, args.seed, args.lanes, args.integrator)
+            if args.equilibrium:
+                sim.populate()
+            asyncio.run(serve(sim, args.host, args.port, args.dt, args.frame_interval, args.max_vehicles))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,98 +1,248 @@
 import random
-from model import Vehicle, Road
+from model import Vehicle, Road, INTEGRATORS, SPAWN_GAP, fleet_mix, pick_vehicle_type, equilibrium_layout
+from lane_index import LaneIndex
+from profiling import PhaseProfiler, NO_PROFILER
+from scheduler import LaneChangeScheduler, DEFAULT_INTERVAL
+import detectors
 
 class SimulationController:
-    def __init__(self, road_length=2000):
-        self.road = Road(road_length, num_lanes=2)
+    def __init__(self, road_length=2000, seed=None, num_lanes=2, integrator='euler'):
+        self.road = Road(road_length, num_lanes=num_lanes)
+        self.rng = random.Random(seed)
         self.vehicles = []
+        self.lane_index = LaneIndex(self.road.num_lanes)
         self.current_time = 0
         self.next_vehicle_id = 0
         self.target_vehicle_count = 0
         self.base_desired_speed = 30 # m/s
+        # Name of the vehicle integrator, one of model.INTEGRATORS
+        self.set_integrator(integrator)
+        # Optional recorder.TrajectoryRecorder, fed at the end of each update
+        self.recorder = None
+        # PhaseProfiler while profiling is enabled; None costs nothing
+        self.profiler = None
+        # LaneChangeScheduler, or None to evaluate every vehicle every step
+        self.lane_scheduler = None
+        # detectors.TrafficMonitor, fed at the end of each update
+        self.monitor = None
+        # Vehicle type table from model.fleet_mix, or None for cars only
+        self.fleet = None
+        # Despawned vehicles, reused by the next spawns
+        self.vehicle_pool = []
 
-    def set_target_vehicle_count(self, count):
+    def set_target_vehicle_count(self, count, immediate=False):
+        # update() adds or removes one vehicle per step until count is
+        # reached. immediate removes the excess at once (for many vehicles at
+        # once on an empty road, see populate).
         self.target_vehicle_count = int(count)
+        if immediate and len(self.vehicles) > self.target_vehicle_count:
+            self._despawn_vehicles(len(self.vehicles) - self.target_vehicle_count)
+
+    def populate(self, count=None, perturbation=0.0):
+        # Replace every vehicle with count of them (default: the target
+        # count) already in equilibrium, instead of spawning them one per
+        # step at half speed and waiting for the traffic to settle. See
+        # model.equilibrium_layout for perturbation.
+        count = self.target_vehicle_count if count is None else int(count)
+        layout = equilibrium_layout(self.rng, count, self.road, self.base_desired_speed,
+                                    self.fleet, perturbation)
+        self._despawn_vehicles(len(self.vehicles))
+        for position, lane, desired_speed, velocity, vehicle_type in layout:
+            v = self._new_vehicle(position, lane, desired_speed, vehicle_type)
+            v.velocity = velocity
+            self.vehicles.append(v)
+        self.lane_index.rebuild(self.vehicles)
+        self.target_vehicle_count = count
+
+    def set_fleet(self, shares):
+        # shares: {vehicle type name: share} for new vehicles, or None
+        self.fleet = None if shares is None else fleet_mix(shares)
+
+    def set_integrator(self, name):
+        if name not in INTEGRATORS:
+            raise ValueError(f"unknown integrator {name!r}")
+        self.integrator = name
+
+    def enable_profiling(self, window=600):
+        if self.profiler is None:
+            self.profiler = PhaseProfiler(window)
+        return self.profiler
+
+    def disable_profiling(self):
+        self.profiler = None
+
+    def enable_lane_change_scheduling(self, interval=DEFAULT_INTERVAL):
+        if self.lane_scheduler is None:
+            self.lane_scheduler = LaneChangeScheduler(interval)
+        return self.lane_scheduler
+
+    def disable_lane_change_scheduling(self):
+        self.lane_scheduler = None
+
+    def enable_monitoring(self, positions=(), interval=detectors.DEFAULT_INTERVAL,
+                          bin_length=detectors.DEFAULT_BIN_LENGTH, capacity=detectors.DEFAULT_CAPACITY):
+        # Loop detectors at positions (or (position, lane) pairs) and a
+        # time-space heatmap, aggregated every interval seconds from now on
+        self.monitor = detectors.TrafficMonitor(self.road.length, self.road.num_lanes, positions, interval,
+                                                bin_length, capacity, start_time=self.current_time)
+        return self.monitor
+
+    def disable_monitoring(self):
+        self.monitor = None
 
     def set_base_desired_speed(self, speed):
+        # Shift every desired speed by the change of the base, keeping each
+        # vehicle's own random offset (and the random stream) as they were
+        change = float(speed) - self.base_desired_speed
         self.base_desired_speed = float(speed)
-        for v in self.vehicles:
-            v.desired_speed = self.base_desired_speed + random.uniform(-2, 2)
+        if change:
+            for v in self.vehicles:
+                v.desired_speed += change * v.type.speed_factor
+
+    def set_zone_limit(self, index, limit):
+        # One zone's limit, patched in place (see Road.set_zone_limit)
+        self.road.set_zone_limit(index, limit)
 
     def update(self, dt):
+        # Profiling hooks are no-ops unless profiling is enabled
+        prof = self.profiler or NO_PROFILER
+        prof.begin_step()
         self.current_time += dt
 
         # Spawn/Despawn
         if len(self.vehicles) < self.target_vehicle_count:
             self._spawn_vehicle()
         elif len(self.vehicles) > self.target_vehicle_count:
-            self.vehicles.pop()
+            self._despawn_vehicle()
+        prof.end_phase('spawn')
 
-        # Sort for easy linear neighbor lookup
-        self.vehicles.sort(key=lambda v: v.position)
+        # Update order: by position, taken from the per-lane index
+        self.vehicles = self.lane_index.ordered()
+        prof.end_phase('sort')
+        if self.monitor is not None:
+            self.monitor.begin_step(self)
 
-        # Build lane lists for easy lookup
-        lanes = [[], []]
-        for v in self.vehicles:
-            lanes[v.lane].append(v)
-            
         # Update each vehicle
+        step = INTEGRATORS[self.integrator]
+        ballistic = self.integrator != 'euler'
+        scheduler = self.lane_scheduler
+        if scheduler is not None:
+            scheduler.begin_step(dt)
         for v in self.vehicles:
-            current_lane_cars = lanes[v.lane]
-            target_lane_idx = 1 - v.lane
-            target_lane_cars = lanes[target_lane_idx]
-            
             # Find leader in current lane
-            leader = self._find_leader(v, current_lane_cars)
-            
-            # Find neighbors in target lane for LCD (Lane Change Decision)
-            target_leader = self._find_leader(v, target_lane_cars)
-            target_follower = self._find_follower(v, target_lane_cars)
-            
-            neighbors = {
-                'target_leader': target_leader,
-                'target_follower': target_follower
-            }
-            
-            v.update(dt, leader, self.road, neighbors)
-
-    def _find_leader(self, agent, lane_cars):
-        if not lane_cars: return None
-        # Since lane_cars is not fully sorted by position (v.lane might change mid-frame in other systems, but here we rebuild logic)
-        # Actually we sorted self.vehicles, but lane_cars is subset, still sorted by position.
-        
-        # Find first car with pos > agent.pos
-        # Because it's a loop, if no car > agent.pos, leader is the first car in list (wrapped)
-        
-        for car in lane_cars:
-            if car.position > agent.position:
-                return car
-        
-        # Wrap around
-        if lane_cars:
-            return lane_cars[0] # Smallest position (just wrapped)
-        return None
-
-    def _find_follower(self, agent, lane_cars):
-        if not lane_cars: return None
-        # Find last car with pos < agent.pos
-        
-        follower = None
-        for car in lane_cars:
-            if car.position < agent.position:
-                follower = car
+            leader = self._find_leader(v, v.lane)
+
+            # Find neighbors in the adjacent lanes for LCD (Lane Change Decision),
+            # unless the scheduler leaves this vehicle out of this step
+            if scheduler is None or scheduler.due(v, leader, dt, self.road.length):
+                neighbors = self._find_neighbors(v)
             else:
-                break # Since sorted, we passed potential followers
-                
-        if follower is None and lane_cars:
-            # Wrap around: largest position car is behind me (across start line)
-            return lane_cars[-1]
-            
-        return follower
+                neighbors = None
+            prof.lookups_done()
+
+            lane, position = v.lane, v.position
+            lane_change = step(v, dt, leader, self.road, neighbors)
+            if lane_change and ballistic:
+                # Vehicles updated later in the step see the lane change, so
+                # two of them never merge into the same gap
+                self.lane_index.move(v, lane, position)
+            prof.vehicle_done(lane_change)
+        prof.vehicles_done()
+        if ballistic:
+            self._wrap_positions()
+
+        # Re-sort the lanes for the new positions and apply lane changes
+        self.lane_index.repair(self.road.length)
+        prof.end_phase('lanes')
+
+        if self.monitor is not None:
+            self.monitor.observe(self, dt)
+        if self.recorder is not None:
+            self.recorder.record(self)
+
+    def _wrap_positions(self):
+        # The ballistic integrators leave the wrap around the ring to the end
+        # of the step (see Vehicle.update_ballistic)
+        length = self.road.length
+        for v in self.vehicles:
+            if v.position > length:
+                v.position -= length
+
+    def _find_leader(self, agent, lane):
+        # Neighbors are looked up against the positions at the start of the
+        # step, which is what the index keys hold during the update loop
+        return self.lane_index.leader(agent.position, lane)
+
+    def _find_follower(self, agent, lane):
+        return self.lane_index.follower(agent.position, lane)
+
+    def _find_neighbors(self, agent):
+        # Leader and follower in the lane to the left (lane + 1) and to the
+        # right (lane - 1), for the lanes that exist
+        neighbors = {}
+        index = self.lane_index
+        left = agent.lane + 1
+        if left < self.road.num_lanes:
+            neighbors['left_leader'] = index.leader(agent.position, left)
+            neighbors['left_follower'] = index.follower(agent.position, left)
+        right = agent.lane - 1
+        if right >= 0:
+            neighbors['right_leader'] = index.leader(agent.position, right)
+            neighbors['right_follower'] = index.follower(agent.position, right)
+        return neighbors
 
     def _spawn_vehicle(self):
-        pos = random.uniform(0, self.road.length)
-        lane = random.randint(0, 1)
-        speed = self.base_desired_speed + random.uniform(-2, 2)
-        v = Vehicle(self.next_vehicle_id, pos, lane, speed)
-        self.next_vehicle_id += 1
+        pos = self.rng.uniform(0, self.road.length)
+        lane = self.rng.randint(0, self.road.num_lanes - 1)
+        speed = self.base_desired_speed + self.rng.uniform(-2, 2)
+        vehicle_type = pick_vehicle_type(self.rng, self.fleet)
+        if self.integrator != 'euler' and not self._has_room(pos, lane, vehicle_type.length):
+            return # try another spot next step
+        v = self._new_vehicle(pos, lane, speed * vehicle_type.speed_factor, vehicle_type)
         self.vehicles.append(v)
+        self.lane_index.insert(v)
+
+    def _new_vehicle(self, position, lane, desired_speed, vehicle_type):
+        # Next id, reusing a pooled vehicle when there is one
+        if self.vehicle_pool:
+            v = self.vehicle_pool.pop().reset(self.next_vehicle_id, position, lane, desired_speed, vehicle_type)
+        else:
+            v = Vehicle(self.next_vehicle_id, position, lane, desired_speed, vehicle_type)
+        self.next_vehicle_id += 1
+        return v
+
+    def _despawn_vehicle(self):
+        v = self.vehicles.pop()
+        self.lane_index.remove(v)
+        self.vehicle_pool.append(v)
+
+    def _despawn_vehicles(self, count):
+        # The last count vehicles at once. Past a few, rebuilding the index
+        # is cheaper than taking them out of it one by one.
+        if count <= 0:
+            return
+        removed = self.vehicles[-count:]
+        del self.vehicles[-count:]
+        if count > 16:
+            self.lane_index.rebuild(self.vehicles)
+        else:
+            for v in removed:
+                self.lane_index.remove(v)
+        self.vehicle_pool.extend(removed)
+
+    def _has_room(self, position, lane, length):
+        # At least SPAWN_GAP of free road ahead of and behind a vehicle of
+        # this length at position in lane
+        leader = self.lane_index.leader(position, lane)
+        if leader is not None:
+            dist = leader.position - position
+            if dist < 0: dist += self.road.length
+            if dist - length < SPAWN_GAP:
+                return False
+        follower = self.lane_index.follower(position, lane)
+        if follower is not None:
+            dist = position - follower.position
+            if dist < 0: dist += self.road.length
+            if dist - follower.length < SPAWN_GAP:
+                return False
+        return True
@@ -0,0 +1,280 @@
+import argparse
+import csv
+import itertools
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import headless
+import ensemble
+
+# Parameter sweeps for fundamental diagrams (flow/density/speed).
+# Every (grid point, replica) pair is an independent headless run executed in
+# a process pool. Replica r uses seed base_seed + r at every grid point, so
+# grid points are compared under common random numbers. With --engine
+# ensemble all the replicas of a grid point run as one task, batched in a
+# single ensemble.EnsembleSimulationController (same results as vectorized).
+#   python sweep.py --vehicles 20,40,80,120 --speed 100,120 --zone 200:600:120 \
+#       --zone-limit 0=40,80 --replicas 4 --duration 600 --warmup 120 --output fd.csv
+
+METRIC_COLUMNS = ('final_vehicles', 'mean_speed_kmh', 'density_veh_km', 'flow_veh_h',
+                  'stopped_fraction', 'wall_time')
+
+
+def build_tasks(grid, replicas, base_seed):
+    # grid: dict name -> list of values. Returns one task dict per run.
+    names = sorted(grid)
+    tasks = []
+    for values in itertools.product(*(grid[name] for name in names)):
+        for replica in range(replicas):
+            tasks.append({
+                'index': len(tasks),
+                'params': dict(zip(names, values)),
+                'replica': replica,
+                'seed': base_seed + replica,
+            })
+    return tasks
+
+
+def _task_row(task):
+    row = {'index': task['index'], 'replica': task['replica'], 'seed': task['seed']}
+    row.update(task['params'])
+    return row
+
+
+def _scenario(params, config):
+    # (vehicles, speed, zones) of a grid point
+    zones = [list(zone) for zone in config['zones']]
+    for name, value in params.items():
+        if name.startswith('zone'):
+            zones[int(name[4:])][2] = value
+    return params.get('vehicles', config['vehicles']), params.get('speed', config['speed']), zones
+
+
+def _fill_row(row, metrics):
+    row['final_vehicles'] = metrics['vehicles']
+    for key in METRIC_COLUMNS[1:]:
+        row[key] = metrics[key]
+    row['error'] = ''
+
+
+def run_task(task, config):
+    # Runs in a worker process. Errors are reported in the row instead of
+    # being raised, so one bad run does not abort the sweep.
+    row = _task_row(task)
+    try:
+        vehicles, speed, zones = _scenario(task['params'], config)
+        sim = headless.build_controller(
+            config['engine'], config['road_length'], vehicles, speed, zones, task['seed'],
+            config['num_lanes'], config['integrator'])
+        if config['equilibrium']:
+            sim.populate(perturbation=config['perturbation'])
+        metrics = headless.run(sim, config['duration'], config['dt'], config['warmup'],
+                               config['sample_interval'])
+        _fill_row(row, metrics)
+    except Exception as exc:
+        row['error'] = f"{type(exc).__name__}: {exc}"
+    return row
+
+
+def run_batch(tasks, config):
+    # Every replica of one grid point in a single ensemble run. An error
+    # fails the whole batch.
+    rows = [_task_row(task) for task in tasks]
+    try:
+        vehicles, speed, zones = _scenario(tasks[0]['params'], config)
+        sim = ensemble.build_ensemble(
+            len(tasks), config['road_length'], vehicles, speed, zones,
+            [task['seed'] for task in tasks], config['num_lanes'], config['integrator'])
+        if config['equilibrium']:
+            sim.populate(perturbation=config['perturbation'])
+        results = ensemble.run(sim, config['duration'], config['dt'], config['warmup'],
+                               config['sample_interval'])
+        for row, metrics in zip(rows, results):
+            _fill_row(row, metrics)
+    except Exception as exc:
+        for row in rows:
+            row['error'] = f"{type(exc).__name__}: {exc}"
+    return rows
+
+
+def run_group(group, config):
+    if config['engine'] == 'ensemble':
+        return run_batch(group, config)
+    return [run_task(task, config) for task in group]
+
+
+def group_tasks(tasks, engine):
+    # Units of work for the pool: the replicas of a grid point together for
+    # the ensemble engine, one run each otherwise
+    if engine != 'ensemble':
+        return [[task] for task in tasks]
+    groups = {}
+    for task in tasks:
+        groups.setdefault(tuple(sorted(task['params'].items())), []).append(task)
+    return list(groups.values())
+
+
+def _run_pool(groups, config, workers, rows):
+    # Fills rows with the results; returns the groups lost to a broken pool
+    broken = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run_group, group, config): group for group in groups}
+        for future in as_completed(futures):
+            group = futures[future]
+            try:
+                for row in future.result():
+                    rows[row['index']] = row
+            except BrokenProcessPool:
+                broken.append(group)
+    return broken
+
+
+def _run_isolated(groups, config, workers, rows):
+    # Each group in a single-worker pool of its own, up to workers at once,
+    # so a crash takes down only the group that caused it
+    lost = []
+    for start in range(0, len(groups), workers):
+        batch = groups[start:start + workers]
+        pools = [ProcessPoolExecutor(max_workers=1) for _ in batch]
+        try:
+            futures = [(pool.submit(run_group, group, config), group) for pool, group in zip(pools, batch)]
+            for future, group in futures:
+                try:
+                    for row in future.result():
+                        rows[row['index']] = row
+                except BrokenProcessPool:
+                    lost.append(group)
+        finally:
+            for pool in pools:
+                pool.shutdown()
+    return lost
+
+
+def run_sweep(tasks, config, workers=None, retries=1):
+    # A worker that dies (segfault, OOM kill) breaks the whole pool and every
+    # task still queued in it, most of them innocent. Keep the finished rows
+    # and resubmit the lost groups to a fresh pool of the same size; only
+    # groups lost a second time run alone, up to retries times each, before
+    # they are reported as crashed.
+    workers = workers or os.cpu_count()
+    rows = {}
+    lost = _run_pool(group_tasks(tasks, config['engine']), config, workers, rows)
+    if lost:
+        lost = _run_pool(lost, config, workers, rows)
+    for _ in range(retries):
+        if not lost:
+            break
+        lost = _run_isolated(lost, config, workers, rows)
+    for group in lost:
+        for task in group:
+            row = _task_row(task)
+            row['error'] = 'worker process crashed'
+            rows[task['index']] = row
+    return [rows[i] for i in sorted(rows)]
+
+
+def summarize(rows, param_names):
+    # Mean of every metric over the successful replicas of each grid point
+    groups = {}
+    for row in rows:
+        if row['error']:
+            continue
+        key = tuple(row[name] for name in param_names)
+        groups.setdefault(key, []).append(row)
+    summary = []
+    for key in sorted(groups):
+        group = groups[key]
+        entry = dict(zip(param_names, key))
+        entry['replicas'] = len(group)
+        for column in METRIC_COLUMNS:
+            entry[column] = sum(r[column] for r in group) / len(group)
+        summary.append(entry)
+    return summary
+
+
+def write_table(rows, path, param_names):
+    columns = ['index'] + list(param_names) + ['replica', 'seed'] + list(METRIC_COLUMNS) + ['error']
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def parse_values(text):
+    return [float(x) for x in text.split(',')]
+
+
+def parse_zone_limit(text):
+    zone, values = text.split('=')
+    return int(zone), parse_values(values)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Parameter sweep over a process pool.")
+    parser.add_argument('--vehicles', type=parse_values, help="comma separated vehicle counts")
+    parser.add_argument('--speed', type=parse_values, help="comma separated desired speeds (km/h)")
+    parser.add_argument('--zone', type=headless.parse_zone, action='append', default=[],
+                        metavar='START:END:KMH', help="speed limit zone, repeatable")
+    parser.add_argument('--zone-limit', type=parse_zone_limit, action='append', default=[],
+                        metavar='ZONE=KMH,KMH', help="sweep the limit of a --zone (0-based)")
+    parser.add_argument('--replicas', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--retries', type=int, default=1,
+                        help="times a task lost twice to a crashed worker is run again in a "
+                             "process of its own before it is reported as crashed")
+    parser.add_argument('--engine', choices=sorted(headless.ENGINES) + ['ensemble'], default='object')
+    parser.add_argument('--duration', type=float, default=600.0)
+    parser.add_argument('--dt', type=float, default=1 / 60)
+    parser.add_argument('--warmup', type=float, default=120.0)
+    parser.add_argument('--sample-interval', type=float, default=1.0)
+    parser.add_argument('--road-length', type=float, default=headless.DEFAULT_ROAD_LENGTH)
+    parser.add_argument('--lanes', type=int, default=2)
+    parser.add_argument('--integrator', choices=sorted(headless.INTEGRATORS), default='euler')
+    parser.add_argument('--equilibrium', action='store_true',
+                        help="start every run with its vehicles at the IDM equilibrium")
+    parser.add_argument('--perturbation', type=float, default=0.0, metavar='FRACTION',
+                        help="with --equilibrium, random change of the starting speeds")
+    parser.add_argument('--output', default='sweep.csv')
+    args = parser.parse_args(argv)
+
+    grid = {}
+    if args.vehicles:
+        grid['vehicles'] = [int(v) for v in args.vehicles]
+    if args.speed:
+        grid['speed'] = args.speed
+    for zone, values in args.zone_limit:
+        if zone >= len(args.zone):
+            parser.error(f"--zone-limit refers to zone {zone}, only {len(args.zone)} defined")
+        grid[f'zone{zone}'] = values
+
+    config = {
+        'engine': args.engine,
+        'road_length': args.road_length,
+        'num_lanes': args.lanes,
+        'integrator': args.integrator,
+        'equilibrium': args.equilibrium,
+        'perturbation': args.perturbation,
+        'vehicles': 40,
+        'speed': 120,
+        'zones': args.zone,
+        'duration': args.duration,
+        'dt': args.dt,
+        'warmup': args.warmup,
+        'sample_interval': args.sample_interval,
+    }
+    param_names = sorted(grid)
+    tasks = build_tasks(grid, args.replicas, args.seed)
+    rows = run_sweep(tasks, config, args.workers, args.retries)
+    write_table(rows, args.output, param_names)
+
+    failed = sum(1 for row in rows if row['error'])
+    for entry in summarize(rows, param_names):
+        print(", ".join(f"{k}={v:.2f}" if isinstance(v, float) else f"{k}={v}" for k, v in entry.items()))
+    print(f"{len(rows)} runs, {failed} failed -> {args.output}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,39 @@
+import checkpoint
+import headless
+
+# Branching from a checkpoint: options given with --checkpoint-in change the
+# saved scenario instead of being ignored.
+
+
+def resume(tmp_path, *options):
+    # State after a warm run saved to a checkpoint and a resumed one with
+    # options, both through headless.main
+    warm = str(tmp_path / 'warm.ckpt')
+    branch = str(tmp_path / 'branch.ckpt')
+    assert headless.main(['--duration', '60', '--vehicles', '30', '--seed', '1',
+                          '--checkpoint-out', warm]) == 0
+    assert headless.main(['--checkpoint-in', warm, '--duration', '60', '--seed', '2',
+                          '--checkpoint-out', branch, *options]) == 0
+    return checkpoint.load(branch)
+
+
+def test_zone_replaces_saved_zones(tmp_path):
+    limit = 40 / 3.6
+    sim = resume(tmp_path, '--zone', f'0:{headless.DEFAULT_ROAD_LENGTH}:40')
+    assert [(z['start'], z['end'], z['limit']) for z in sim.road.speed_limit_zones] == [
+        (0.0, headless.DEFAULT_ROAD_LENGTH, limit)]
+    assert len(sim.vehicles) == 30
+    assert max(v.velocity for v in sim.vehicles) <= limit + 0.1
+
+
+def test_unchanged_without_options(tmp_path):
+    sim = resume(tmp_path)
+    assert sim.road.speed_limit_zones == []
+    assert max(v.velocity for v in sim.vehicles) > 60 / 3.6
+
+
+def test_vehicles_and_speed_override(tmp_path):
+    sim = resume(tmp_path, '--vehicles', '20', '--speed', '80')
+    assert sim.target_vehicle_count == 20
+    assert len(sim.vehicles) == 20
+    assert sim.base_desired_speed == 80 / 3.6
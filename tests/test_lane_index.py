@@ -0,0 +1,155 @@
+import random
+from types import SimpleNamespace
+import pytest
+from lane_index import LaneIndex
+
+# Random operation sequences on a LaneIndex, checked after every operation
+# against a brute force model: a plain list of (lane, key, vehicle) entries,
+# sorted or scanned from scratch for each question.
+
+ROAD_LENGTH = 1000.0
+NUM_LANES = 3
+SEEDS = range(20)
+
+
+def car(rng, id, lane=None, position=None):
+    return SimpleNamespace(id=id, lane=rng.randrange(NUM_LANES) if lane is None else lane,
+                           position=rng.uniform(0, ROAD_LENGTH) if position is None else position)
+
+
+class Model:
+    def __init__(self):
+        self.entries = [] # [lane, key, vehicle]
+
+    def add(self, v):
+        self.entries.append([v.lane, v.position, v])
+
+    def drop(self, v):
+        self.entries = [e for e in self.entries if e[2] is not v]
+
+    def lane(self, lane):
+        # (key, vehicle) of a lane in position order
+        return sorted(((key, v) for l, key, v in self.entries if l == lane), key=lambda e: e[0])
+
+    def leader(self, position, lane, wrap):
+        cars = self.lane(lane)
+        ahead = [v for key, v in cars if key > position]
+        if ahead:
+            return ahead[0]
+        return cars[0][1] if cars and wrap else None
+
+    def follower(self, position, lane, wrap):
+        cars = self.lane(lane)
+        behind = [v for key, v in cars if key < position]
+        if behind:
+            return behind[-1]
+        return cars[-1][1] if cars and wrap else None
+
+
+def check(index, model, rng):
+    for lane in range(NUM_LANES):
+        expected = model.lane(lane)
+        assert [v.id for v in index.lanes[lane]] == [v.id for _, v in expected]
+        assert index.keys[lane] == [key for key, _ in expected]
+    queries = [rng.uniform(-10, ROAD_LENGTH + 10) for _ in range(10)]
+    # Exactly at indexed keys, before the first and past the last: the wrap
+    queries += [key for _, key, _ in rng.sample(model.entries, min(3, len(model.entries)))]
+    queries += [0.0, ROAD_LENGTH]
+    for position in queries:
+        for lane in range(NUM_LANES):
+            for wrap in (True, False):
+                assert index.leader(position, lane, wrap) is model.leader(position, lane, wrap)
+                assert index.follower(position, lane, wrap) is model.follower(position, lane, wrap)
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_insert_remove(seed):
+    rng = random.Random(seed)
+    index = LaneIndex(NUM_LANES)
+    model = Model()
+    alive = []
+    for id in range(200):
+        if alive and rng.random() < 0.4:
+            v = alive.pop(rng.randrange(len(alive)))
+            index.remove(v)
+            model.drop(v)
+        else:
+            v = car(rng, id)
+            alive.append(v)
+            index.insert(v)
+            model.add(v)
+        check(index, model, rng)
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_rebuild(seed):
+    rng = random.Random(seed)
+    vehicles = [car(rng, id) for id in range(rng.randrange(60))]
+    index = LaneIndex(NUM_LANES)
+    index.rebuild(vehicles)
+    model = Model()
+    for v in vehicles:
+        model.add(v)
+    check(index, model, rng)
+    assert index.ordered() == sorted(vehicles, key=lambda v: v.position)
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_move(seed):
+    # Lane changes during a step: the vehicle is filed under its new lane
+    # with the key it had, and queries see it there at once
+    rng = random.Random(seed)
+    vehicles = [car(rng, id) for id in range(50)]
+    index = LaneIndex(NUM_LANES)
+    index.rebuild(vehicles)
+    model = Model()
+    for v in vehicles:
+        model.add(v)
+    for _ in range(40):
+        v = rng.choice(vehicles)
+        entry = next(e for e in model.entries if e[2] is v)
+        lane, key = entry[0], entry[1]
+        v.lane = rng.choice([l for l in range(NUM_LANES) if l != lane])
+        v.position = key + rng.uniform(0, 30) # moved on; the key stays
+        index.move(v, lane, key)
+        entry[0] = v.lane
+        check(index, model, rng)
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_repair(seed):
+    # One step on the ring: everybody moves forward less than half the road,
+    # some across the start line, some to another lane
+    rng = random.Random(seed)
+    vehicles = [car(rng, id) for id in range(80)]
+    index = LaneIndex(NUM_LANES)
+    index.rebuild(vehicles)
+    for _ in range(5):
+        for v in vehicles:
+            v.position = (v.position + rng.uniform(0, 0.3 * ROAD_LENGTH)) % ROAD_LENGTH
+            if rng.random() < 0.2:
+                v.lane = rng.randrange(NUM_LANES)
+        index.repair(ROAD_LENGTH)
+        model = Model()
+        for v in vehicles:
+            model.add(v)
+        check(index, model, rng)
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_take_beyond(seed):
+    # Open road: vehicles that drove past the end leave the index
+    rng = random.Random(seed)
+    vehicles = [car(rng, id, position=rng.uniform(0, 1.2 * ROAD_LENGTH)) for id in range(60)]
+    index = LaneIndex(NUM_LANES)
+    index.rebuild(vehicles)
+    gone = index.take_beyond(ROAD_LENGTH)
+    assert sorted(v.id for v in gone) == sorted(v.id for v in vehicles if v.position > ROAD_LENGTH)
+    model = Model()
+    for v in vehicles:
+        if v.position <= ROAD_LENGTH:
+            model.add(v)
+    check(index, model, rng)
+    for lane in range(NUM_LANES):
+        start, end = sorted(rng.uniform(0, ROAD_LENGTH) for _ in range(2))
+        assert index.between(lane, start, end) == [v for key, v in model.lane(lane) if start <= key <= end]
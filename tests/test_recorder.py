@@ -0,0 +1,38 @@
+import numpy as np
+from recorder import TrajectoryRecorder, TrajectoryReader
+from simulation import SimulationController
+
+# A recording keeps the speed limit zones next to the trajectories: a replay
+# finds, for any time, the zones the vehicles were driving through.
+
+
+def test_zones_follow_the_run(tmp_path):
+    path = tmp_path / 'run.traj'
+    sim = SimulationController(road_length=1000, seed=1)
+    sim.set_target_vehicle_count(10)
+    sim.recorder = TrajectoryRecorder(path, sim.road, sim.base_desired_speed, chunk_rows=64)
+    counts = []
+
+    def run(steps):
+        for _ in range(steps):
+            sim.update(0.1)
+            counts.append(len(sim.vehicles))
+
+    run(20) # no zones yet
+    sim.road.add_speed_limit_zone(100, 300, 20.0)
+    run(20)
+    changed = sim.current_time + 0.1
+    sim.set_zone_limit(0, 10.0)
+    run(20)
+    sim.recorder.close()
+
+    reader = TrajectoryReader(path)
+    assert len(reader) == 60
+    assert reader.zones_at(reader.start_time) == []
+    assert reader.zones_at(reader.times[20]) == [(100.0, 300.0, 20.0)]
+    assert reader.zones_at(changed - 1e-6) == [(100.0, 300.0, 20.0)]
+    assert reader.zones_at(changed) == [(100.0, 300.0, 10.0)]
+    assert reader.zones_at(reader.end_time) == [(100.0, 300.0, 10.0)]
+    # The zone chunks sit between the step chunks without disturbing them
+    assert np.all(np.diff(reader.times) > 0)
+    assert [len(reader.frame(step)['ids']) for step in range(len(reader))] == counts
@@ -0,0 +1,76 @@
+import asyncio
+import pytest
+from server import SimulationServer, SimulationClient
+from simulation import SimulationController
+
+# Remote commands: a bad one is answered with an error frame and changes
+# nothing; the connection and the stream go on.
+
+TIMEOUT = 10.0 # seconds to wait for the frames and errors expected
+
+BAD_COMMANDS = [
+    ('set_fleet', [[1, 2]]),
+    ('set_fleet', [{'plane': 1.0}]),
+    ('set_fleet', [{'car': float('nan')}]),
+    ('set_fleet', [{'car': -1}]),
+    ('set_zone_limit', ['0', 10.0]),
+    ('set_zone_limit', [0, 'abc']),
+    ('set_zone_limit', [0, float('nan')]),
+    ('set_zone_limit', [0, -5.0]),
+    ('set_zone_limit', [7, 10.0]),
+    ('set_zone_limit', [0]),
+    ('set_base_desired_speed', ['fast']),
+    ('set_speed_limit_zones', [[[1, 2, 3], [1, 2]]]),
+    ('set_target_vehicle_count', ['many']),
+    ('no_such_command', []),
+]
+
+
+async def exchange(commands, expected_errors, frames=10):
+    sim = SimulationController(seed=1)
+    sim.set_target_vehicle_count(10)
+    sim.road.add_speed_limit_zone(100, 300, 20.0)
+    server = await SimulationServer(sim).start(port=0)
+    try:
+        client = await SimulationClient.connect(port=server.port)
+        for command, args in commands:
+            client.send(command, *args)
+        received = 0
+
+        async def read():
+            nonlocal received
+            async for _ in client.frames():
+                received += 1
+                if received >= frames and len(client.errors) >= expected_errors:
+                    return
+
+        try:
+            await asyncio.wait_for(read(), TIMEOUT)
+        except asyncio.TimeoutError:
+            pass # the assertions on what arrived tell what went wrong
+        await client.close()
+    finally:
+        await server.close()
+    return sim, client.errors, received
+
+
+@pytest.mark.parametrize('command, args', BAD_COMMANDS)
+def test_bad_command_is_an_error_frame(command, args):
+    sim, errors, received = asyncio.run(exchange([(command, args)], 1))
+    assert len(errors) == 1
+    assert received >= 10
+    assert sim.road.speed_limit_zones == [{'start': 100, 'end': 300, 'limit': 20.0}]
+    assert sim.fleet is None
+    assert sim.base_desired_speed == 30
+
+
+def test_good_commands_after_bad_ones():
+    sim, errors, _ = asyncio.run(exchange([
+        ('set_fleet', [[1, 2]]),
+        ('set_zone_limit', [0, 'abc']),
+        ('set_zone_limit', [0, 10.0]),
+        ('set_fleet', [{'car': 1, 'truck': 1}]),
+    ], 2))
+    assert len(errors) == 2
+    assert sim.road.speed_limit_zones[0]['limit'] == 10.0
+    assert [t.name for _, t in sim.fleet] == ['car', 'truck']
@@ -0,0 +1,67 @@
+import math
+import random
+import numpy as np
+import pytest
+from model import Road
+
+# Road.set_zone_limit patches the compiled limit table in place; it must give
+# the same limits as compiling the changed zones from scratch, and a rejected
+# change must leave everything as it was.
+
+LENGTH = 2000.0
+
+
+def random_road(rng, count):
+    # Short, long, overlapping and wrapping zones
+    road = Road(LENGTH)
+    for _ in range(count):
+        start = rng.uniform(-100, LENGTH + 100)
+        road.add_speed_limit_zone(start, start + rng.uniform(-300, 600), rng.uniform(5, 35))
+    return road
+
+
+def limits(road, positions):
+    return road.get_speed_limits_at(positions), [road.get_speed_limit_at(x) for x in positions]
+
+
+def probe_positions(rng, road):
+    edges = [x % LENGTH for zone in road.speed_limit_zones for x in (zone['start'], zone['end'])]
+    return np.array([rng.uniform(0, LENGTH) for _ in range(300)] + edges + [0.0, LENGTH])
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_patch_matches_rebuild(seed):
+    rng = random.Random(seed)
+    road = random_road(rng, rng.randint(1, 30))
+    positions = probe_positions(rng, road)
+    road.get_speed_limit_at(0.0) # compile, so changes patch the table
+    for _ in range(30):
+        road.set_zone_limit(rng.randrange(len(road.speed_limit_zones)), rng.uniform(5, 35))
+        rebuilt = Road(LENGTH)
+        for zone in road.speed_limit_zones:
+            rebuilt.add_speed_limit_zone(zone['start'], zone['end'], zone['limit'])
+        batched, single = limits(road, positions)
+        expected_batched, expected_single = limits(rebuilt, positions)
+        assert np.array_equal(batched, expected_batched)
+        assert single == expected_single
+
+
+@pytest.mark.parametrize('limit', ['abc', None, math.nan, math.inf, -1.0])
+def test_rejected_limit_changes_nothing(limit):
+    rng = random.Random(0)
+    road = random_road(rng, 10)
+    positions = probe_positions(rng, road)
+    road.get_speed_limit_at(0.0)
+    zones = [dict(zone) for zone in road.speed_limit_zones]
+    tables = [np.array(table, copy=True) for table in road._limit_table]
+    before = limits(road, positions)
+    with pytest.raises(ValueError):
+        road.set_zone_limit(3, limit)
+    with pytest.raises(IndexError):
+        road.set_zone_limit(10, 20.0)
+    assert road.speed_limit_zones == zones
+    assert all(np.array_equal(a, b) for a, b in zip(road._limit_table, tables))
+    # Still usable: a later zone forces a full recompile of the same zones
+    road.add_speed_limit_zone(100, 200, 30.0)
+    assert np.array_equal(limits(road, positions)[0], np.minimum(
+        before[0], np.where((positions >= 100) & (positions <= 200), 30.0, np.inf)))
@@ -0,0 +1,644 @@
+import random
+import numpy as np
+from model import (Road, Vehicle, INTEGRATORS, MAX_SUBSTEPS, SUBSTEP_GAP_FRACTION, SPAWN_GAP,
+                   VEHICLE_TYPES, fleet_mix, pick_vehicle_type, vehicle_type, equilibrium_layout)
+from scheduler import LaneChangeScheduler, DEFAULT_INTERVAL
+import detectors
+
+# Structure-of-arrays version of SimulationController.
+# Every per-vehicle attribute lives in its own contiguous NumPy array, kept in
+# the same order the object engine keeps self.vehicles (sorted by position at
+# the start of each step), so a step can be computed with batched operations.
+
+FIELDS = (
+    ('ids', np.int64),
+    ('positions', np.float64),
+    ('velocities', np.float64),
+    ('accelerations', np.float64),
+    ('lanes', np.int64),
+    ('desired_speeds', np.float64),
+    ('cooldowns', np.float64),
+    ('lengths', np.float64),
+    ('widths', np.float64),
+    ('max_accelerations', np.float64),
+    ('comfortable_decelerations', np.float64),
+    ('min_gaps', np.float64),
+    ('time_headways', np.float64),
+    ('status', np.int8),
+    ('type_index', np.int8),
+)
+
+# Vehicle types by type_index: the named model.VEHICLE_TYPES in order, then
+# CUSTOM_TYPE for vehicles whose type is none of them (their parameters are
+# still in the columns above)
+TYPES = tuple(VEHICLE_TYPES.values())
+TYPE_CODES = {t: code for code, t in enumerate(TYPES)}
+CUSTOM_TYPE = len(TYPES)
+SPEED_FACTORS = np.array([t.speed_factor for t in TYPES] + [1.0])
+
+# Congestion status, same thresholds as Vehicle._update_color
+STATUS_FREE = 0
+STATUS_SLOW = 1
+STATUS_STOPPED = 2
+STATUS_COLORS = np.array([(0, 255, 0), (255, 165, 0), (255, 0, 0)], dtype=np.uint8)
+
+# Lane change parameters, same values as Vehicle._try_lane_change
+SAFE_GAP_FRONT = 10
+SAFE_GAP_BACK = 10
+LANE_CHANGE_THRESHOLD = 0.5
+LANE_CHANGE_COOLDOWN = 2.0
+
+
+def type_indices(lengths, widths, max_accelerations, comfortable_decelerations, min_gaps, time_headways):
+    # type_index of rows known only by their parameters (checkpoints):
+    # the first named type they match, like model.vehicle_type
+    index = np.full(len(lengths), CUSTOM_TYPE, dtype=np.int8)
+    columns = (lengths, widths, max_accelerations, comfortable_decelerations, min_gaps, time_headways)
+    for code in reversed(range(len(TYPES))):
+        match = np.ones(len(lengths), dtype=bool)
+        for column, value in zip(columns, TYPES[code].parameters()):
+            match &= column == value
+        index[match] = code
+    return index
+
+
+def idm_acceleration(v, v0, s, delta_v, a, b, s0, T):
+    # Batched Vehicle._calculate_idm_accel. s is the bumper gap (inf when
+    # there is no leader).
+    s = np.where(s <= 0.1, 0.1, s)
+    s_star = s0 + (v * T) + (v * delta_v) / (2 * np.sqrt(a * b))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        term1 = np.where(v0 > 0, (v / v0) ** 4, 0.0)
+    term2 = (s_star / s) ** 2
+    return a * (1 - term1 - term2)
+
+
+def leader_pressure(position, v, lead_position, lead_velocity, length, a, b, s0, T, road_len):
+    # Batched Vehicle.leader_pressure
+    s = lead_position - position
+    s = np.where(s < 0, s + road_len, s) - length
+    s = np.where(s <= 0.1, 0.1, s)
+    s_star = s0 + (v * T) + (v * (v - lead_velocity)) / (2 * np.sqrt(a * b))
+    return a * (s_star / s) ** 2
+
+
+class VectorizedSimulationController:
+    def __init__(self, road_length=2000, seed=None, num_lanes=2, integrator='euler'):
+        self.road = Road(road_length, num_lanes=num_lanes)
+        self.rng = random.Random(seed)
+        self.current_time = 0
+        self.next_vehicle_id = 0
+        self.target_vehicle_count = 0
+        self.base_desired_speed = 30 # m/s
+        # Name of the vehicle integrator, one of model.INTEGRATORS
+        self.set_integrator(integrator)
+        # Optional recorder.TrajectoryRecorder, fed at the end of each update
+        self.recorder = None
+        # LaneChangeScheduler, or None to evaluate every vehicle every step
+        self.lane_scheduler = None
+        # detectors.TrafficMonitor, fed at the end of each update
+        self.monitor = None
+        # Vehicle type table from model.fleet_mix, or None for cars only
+        self.fleet = None
+        for name, dtype in FIELDS:
+            setattr(self, name, np.empty(0, dtype=dtype))
+
+    @classmethod
+    def from_controller(cls, sim):
+        # Copy the state of an object-based SimulationController
+        vec = cls(sim.road.length, num_lanes=sim.road.num_lanes, integrator=sim.integrator)
+        vec.rng.setstate(sim.rng.getstate())
+        for zone in sim.road.speed_limit_zones:
+            vec.road.add_speed_limit_zone(zone['start'], zone['end'], zone['limit'])
+        vec.current_time = sim.current_time
+        vec.next_vehicle_id = sim.next_vehicle_id
+        vec.target_vehicle_count = sim.target_vehicle_count
+        vec.base_desired_speed = sim.base_desired_speed
+        vec.fleet = sim.fleet
+        if sim.lane_scheduler is not None:
+            vec.enable_lane_change_scheduling(sim.lane_scheduler.interval).step = sim.lane_scheduler.step
+        vec.load_vehicles(sim.vehicles)
+        return vec
+
+    def load_vehicles(self, vehicles):
+        self.ids = np.array([v.id for v in vehicles], dtype=np.int64)
+        self.positions = np.array([v.position for v in vehicles], dtype=np.float64)
+        self.velocities = np.array([v.velocity for v in vehicles], dtype=np.float64)
+        self.accelerations = np.array([v.acceleration for v in vehicles], dtype=np.float64)
+        self.lanes = np.array([v.lane for v in vehicles], dtype=np.int64)
+        self.desired_speeds = np.array([v.desired_speed for v in vehicles], dtype=np.float64)
+        self.cooldowns = np.array([v.cooldown for v in vehicles], dtype=np.float64)
+        self.lengths = np.array([v.length for v in vehicles], dtype=np.float64)
+        self.widths = np.array([v.width for v in vehicles], dtype=np.float64)
+        self.max_accelerations = np.array([v.max_acceleration for v in vehicles], dtype=np.float64)
+        self.comfortable_decelerations = np.array([v.comfortable_deceleration for v in vehicles], dtype=np.float64)
+        self.min_gaps = np.array([v.min_gap for v in vehicles], dtype=np.float64)
+        self.time_headways = np.array([v.time_headway for v in vehicles], dtype=np.float64)
+        self.status = np.zeros(len(vehicles), dtype=np.int8)
+        self.type_index = np.array([TYPE_CODES.get(v.type, CUSTOM_TYPE) for v in vehicles], dtype=np.int8)
+
+    def to_vehicles(self):
+        vehicles = []
+        for i in range(len(self.positions)):
+            v = Vehicle(int(self.ids[i]), float(self.positions[i]), int(self.lanes[i]),
+                        float(self.desired_speeds[i]), self._vehicle_type(i))
+            v.velocity = float(self.velocities[i])
+            v.acceleration = float(self.accelerations[i])
+            v.cooldown = float(self.cooldowns[i])
+            v.color = tuple(int(c) for c in STATUS_COLORS[self.status[i]])
+            vehicles.append(v)
+        return vehicles
+
+    def _vehicle_type(self, i):
+        # Shared model.VehicleType of row i
+        code = self.type_index[i]
+        if code != CUSTOM_TYPE:
+            return TYPES[code]
+        return vehicle_type(float(self.lengths[i]), float(self.widths[i]),
+                            float(self.max_accelerations[i]), float(self.comfortable_decelerations[i]),
+                            float(self.min_gaps[i]), float(self.time_headways[i]))
+
+    @property
+    def vehicle_count(self):
+        return len(self.positions)
+
+    def colors(self):
+        return STATUS_COLORS[self.status]
+
+    def set_target_vehicle_count(self, count, immediate=False):
+        # SimulationController.set_target_vehicle_count
+        self.target_vehicle_count = int(count)
+        if immediate and self.vehicle_count > self.target_vehicle_count:
+            self._despawn_last(self.vehicle_count - self.target_vehicle_count)
+
+    def populate(self, count=None, perturbation=0.0):
+        # SimulationController.populate: same layout and ids for a seed
+        count = self.target_vehicle_count if count is None else int(count)
+        layout = equilibrium_layout(self.rng, count, self.road, self.base_desired_speed,
+                                    self.fleet, perturbation)
+        self._despawn_last(self.vehicle_count)
+        self._append_columns(self._layout_columns(layout, self.next_vehicle_id, 0))
+        self.next_vehicle_id += count
+        self.target_vehicle_count = count
+
+    def _layout_columns(self, layout, first_id, first_lane):
+        # {field: array} for the vehicles of a model.equilibrium_layout
+        positions, lanes, desired_speeds, velocities, types = zip(*layout) if layout else ((),) * 5
+        n = len(layout)
+        return {
+            'ids': np.arange(first_id, first_id + n), 'positions': positions, 'velocities': velocities,
+            'accelerations': np.zeros(n), 'lanes': np.array(lanes, dtype=np.int64) + first_lane,
+            'desired_speeds': desired_speeds, 'cooldowns': np.zeros(n),
+            'lengths': [t.length for t in types], 'widths': [t.width for t in types],
+            'max_accelerations': [t.max_acceleration for t in types],
+            'comfortable_decelerations': [t.comfortable_deceleration for t in types],
+            'min_gaps': [t.min_gap for t in types], 'time_headways': [t.time_headway for t in types],
+            'status': np.full(n, STATUS_FREE),
+            'type_index': [TYPE_CODES.get(t, CUSTOM_TYPE) for t in types],
+        }
+
+    def enable_lane_change_scheduling(self, interval=DEFAULT_INTERVAL):
+        if self.lane_scheduler is None:
+            self.lane_scheduler = LaneChangeScheduler(interval)
+        return self.lane_scheduler
+
+    def disable_lane_change_scheduling(self):
+        self.lane_scheduler = None
+
+    def enable_monitoring(self, positions=(), interval=detectors.DEFAULT_INTERVAL,
+                          bin_length=detectors.DEFAULT_BIN_LENGTH, capacity=detectors.DEFAULT_CAPACITY):
+        # Loop detectors at positions (or (position, lane) pairs) and a
+        # time-space heatmap, aggregated every interval seconds from now on
+        self.monitor = detectors.TrafficMonitor(self.road.length, self.road.num_lanes, positions, interval,
+                                                bin_length, capacity, start_time=self.current_time)
+        return self.monitor
+
+    def disable_monitoring(self):
+        self.monitor = None
+
+    def set_fleet(self, shares):
+        self.fleet = None if shares is None else fleet_mix(shares)
+
+    def set_integrator(self, name):
+        if name not in INTEGRATORS:
+            raise ValueError(f"unknown integrator {name!r}")
+        self.integrator = name
+
+    def set_base_desired_speed(self, speed):
+        # Shift by the change of the base, like the object engine
+        change = float(speed) - self.base_desired_speed
+        self.base_desired_speed = float(speed)
+        if change:
+            self.desired_speeds = self.desired_speeds + change * SPEED_FACTORS[self.type_index]
+
+    def set_zone_limit(self, index, limit):
+        self.road.set_zone_limit(index, limit)
+
+    def update(self, dt):
+        self.current_time += dt
+        self._spawn_despawn()
+
+        # Keep arrays sorted by position (stable, like list.sort)
+        self._reorder(np.argsort(self.positions, kind='stable'))
+        if self.monitor is not None:
+            self.monitor.begin_step(self)
+        if self.vehicle_count > 0:
+            self._step(dt)
+
+        if self.monitor is not None:
+            self.monitor.observe(self, dt)
+        if self.recorder is not None:
+            self.recorder.record(self)
+
+    def _spawn_despawn(self):
+        # One vehicle in or out per step towards the target count
+        if self.vehicle_count < self.target_vehicle_count:
+            self._spawn_vehicle()
+        elif self.vehicle_count > self.target_vehicle_count:
+            self._despawn_last()
+
+    def _reorder(self, order):
+        for name, _ in FIELDS:
+            setattr(self, name, getattr(self, name)[order])
+
+    def _spawn_vehicle(self):
+        row = self._draw_vehicle(self.rng, self.next_vehicle_id, 0, self.road.num_lanes)
+        if row is not None:
+            self.next_vehicle_id += 1
+            self._append_rows([row])
+
+    def _draw_vehicle(self, rng, id, first_lane, num_lanes):
+        # Row for a new vehicle drawn from rng, on one of the num_lanes lanes
+        # from first_lane, or None when there is no room for it
+        pos = rng.uniform(0, self.road.length)
+        lane = first_lane + rng.randint(0, num_lanes - 1)
+        speed = self.base_desired_speed + rng.uniform(-2, 2)
+        t = pick_vehicle_type(rng, self.fleet)
+        if self.integrator != 'euler' and not self._has_room(pos, lane, t.length):
+            return None # try another spot next step
+        return self._vehicle_row(id, pos, lane, speed * t.speed_factor, t)
+
+    def _vehicle_row(self, id, position, lane, speed, t):
+        # Row of a new vehicle of type t, starting at half its desired speed
+        return {
+            'ids': id, 'positions': position, 'velocities': speed * 0.5,
+            'accelerations': 0.0, 'lanes': lane,
+            'desired_speeds': speed, 'cooldowns': 0.0,
+            'lengths': t.length, 'widths': t.width,
+            'max_accelerations': t.max_acceleration,
+            'comfortable_decelerations': t.comfortable_deceleration,
+            'min_gaps': t.min_gap, 'time_headways': t.time_headway,
+            'status': STATUS_FREE,
+            'type_index': TYPE_CODES.get(t, CUSTOM_TYPE),
+        }
+
+    def _append_rows(self, rows):
+        self._append_columns({name: [row[name] for row in rows] for name, _ in FIELDS})
+
+    def _append_columns(self, columns):
+        for name, dtype in FIELDS:
+            setattr(self, name, np.append(getattr(self, name), np.asarray(columns[name], dtype=dtype)))
+
+    def _has_room(self, position, lane, length):
+        # SimulationController._has_room
+        road_len = self.road.length
+        in_lane = self.lanes == lane
+        positions = self.positions[in_lane]
+        if len(positions) == 0:
+            return True
+        lengths = self.lengths[in_lane]
+        ahead = positions > position
+        leader = np.argmin(np.where(ahead, positions, np.inf)) if ahead.any() else np.argmin(positions)
+        dist = positions[leader] - position
+        if dist < 0: dist += road_len
+        if dist - length < SPAWN_GAP:
+            return False
+        behind = positions < position
+        follower = np.argmax(np.where(behind, positions, -np.inf)) if behind.any() else np.argmax(positions)
+        dist = position - positions[follower]
+        if dist < 0: dist += road_len
+        return dist - lengths[follower] >= SPAWN_GAP
+
+    def _despawn_last(self, count=1):
+        if count <= 0:
+            return
+        for name, _ in FIELDS:
+            setattr(self, name, getattr(self, name)[:-count])
+
+    def _build_lane_index(self):
+        # Sort key groups vehicles by lane, then position. Arrays are already
+        # sorted by position, so a stable sort keeps that order inside lanes.
+        self._span = 2.0 * self.road.length + 1.0
+        key = self.lanes * self._span + self.positions
+        self._lane_order = np.argsort(key, kind='stable')
+        self._sorted_keys = key[self._lane_order]
+        bounds = np.arange(self.road.num_lanes + 1) * self._span
+        edges = np.searchsorted(self._sorted_keys, bounds, side='left')
+        self._lane_start = edges[:-1]
+        self._lane_end = edges[1:]
+
+    def _search(self, lanes, side):
+        # Insertion points of each vehicle's position into the lanes given.
+        # Queried in lane order: sorted queries let searchsorted narrow each
+        # search from the previous one, several times faster.
+        order = self._lane_order
+        idx = np.empty(len(order), dtype=np.int64)
+        idx[order] = np.searchsorted(self._sorted_keys, (lanes * self._span + self.positions)[order], side=side)
+        return idx
+
+    def _find_leaders(self, lanes):
+        # First vehicle with position > p in the lane, wrapping to the first
+        # of the lane. -1 when the lane is empty. Like LaneIndex, queries use
+        # the positions at the start of the step.
+        idx = self._search(lanes, 'right')
+        start = self._lane_start[lanes]
+        end = self._lane_end[lanes]
+        idx = np.where(idx >= end, start, idx)
+        return np.where(start == end, -1, self._lane_order[np.minimum(idx, len(self._lane_order) - 1)])
+
+    def _find_followers(self, lanes):
+        # Last vehicle with position < p in the lane, wrapping to the last of
+        # the lane. -1 when the lane is empty.
+        idx = self._search(lanes, 'left') - 1
+        start = self._lane_start[lanes]
+        end = self._lane_end[lanes]
+        idx = np.where(idx < start, end - 1, idx)
+        return np.where(start == end, -1, self._lane_order[np.maximum(idx, 0)])
+
+    def _adjacent(self, offset):
+        # Lane next to each vehicle's (offset +1 left, -1 right) and whether
+        # it exists
+        target = self.lanes + offset
+        return target, (target >= 0) & (target < self.road.num_lanes)
+
+    def _sequential_neighbors(self, new_lanes):
+        # Neighbors under the ballistic integrators, where the object engine
+        # moves a lane changer in its LaneIndex right away: vehicle i sees the
+        # vehicles ranked before it in their lanes after the update
+        # (new_lanes) and the rest in their lanes at the start of the step.
+        # Returns leaders and sides like the static lookup in _step.
+        n = self.vehicle_count
+        rank = np.arange(n)
+        # Vehicles keyed by lane then rank: after the update and at the start
+        done = np.sort(new_lanes * n + rank)
+        start = np.sort(self.lanes * n + rank)
+
+        def pick(keys, at, lanes, missing):
+            # Rank of keys[at] when it is in lanes, else missing
+            inside = (at >= 0) & (at < n)
+            key = keys[np.clip(at, 0, n - 1)]
+            return np.where(inside & (key // n == lanes), key % n, missing)
+
+        def leaders_in(lanes):
+            # First pending vehicle after i, else wrapping to the first
+            # updated one of the lane, the vehicle itself when it is alone in
+            # its own lane (like LaneIndex.leader)
+            ahead = pick(start, np.searchsorted(start, lanes * n + rank, side='right'), lanes, n)
+            first_done = pick(done, np.searchsorted(done, lanes * n, side='left'), lanes, n)
+            wrapped = np.where(first_done < rank, first_done, np.where(lanes == self.lanes, rank, -1))
+            return np.where(ahead < n, ahead, wrapped)
+
+        def followers_in(lanes):
+            # Last updated vehicle before i, else wrapping to the last pending
+            # one of the lane
+            behind = pick(done, np.searchsorted(done, lanes * n + rank, side='left') - 1, lanes, -1)
+            last_start = pick(start, np.searchsorted(start, (lanes + 1) * n, side='left') - 1, lanes, -1)
+            wrapped = np.where(last_start > rank, last_start, -1)
+            return np.where(behind >= 0, behind, wrapped)
+
+        sides = []
+        for offset in (1, -1):
+            target, exists = self._adjacent(offset)
+            query = np.where(exists, target, self.lanes)
+            sides.append((target, exists,
+                          np.where(exists, leaders_in(query), -1),
+                          np.where(exists, followers_in(query), -1)))
+        return leaders_in(self.lanes), sides
+
+    def _step(self, dt):
+        n = self.vehicle_count
+        rank = np.arange(n)
+        road_len = self.road.length
+        ballistic = self.integrator != 'euler'
+
+        cooldowns = np.where(self.cooldowns > 0, self.cooldowns - dt, self.cooldowns)
+        if self.lane_scheduler is not None:
+            self.lane_scheduler.begin_step(dt)
+        if ballistic:
+            # Positions come out of the integration; start from a guess
+            new_positions = self.positions.copy()
+            limits = self.road.get_speed_limits_at(self.positions)
+        else:
+            # 1. Update position. It only depends on the vehicle's own state.
+            new_positions = self.positions + self.velocities * dt
+            new_positions = np.where(new_positions > road_len, new_positions - road_len, new_positions)
+            limits = self.road.get_speed_limits_at(new_positions)
+        effective = np.minimum(self.desired_speeds, limits)
+
+        if ballistic:
+            leaders, sides = self._sequential_neighbors(self.lanes)
+        else:
+            self._build_lane_index()
+            leaders = self._find_leaders(self.lanes)
+            # Adjacent lanes, left (lane + 1) then right (lane - 1): target
+            # lane, whether it exists, leader and follower there
+            sides = []
+            for offset in (1, -1):
+                target, exists = self._adjacent(offset)
+                query = np.where(exists, target, self.lanes)
+                sides.append((target, exists,
+                              np.where(exists, self._find_leaders(query), -1),
+                              np.where(exists, self._find_followers(query), -1)))
+
+        # The object engine updates vehicles one by one in position order, so
+        # a vehicle sees the new state of neighbors ranked before it: leaders
+        # only through the ring wrap, and under the ballistic integrators the
+        # followers in the adjacent lanes too, whose new positions are no
+        # longer known upfront, and the lane changes made before it. Evaluate
+        # everybody against the guessed state, then re-evaluate the vehicles
+        # whose neighbors or neighbors' state changed, until nothing does.
+        # Dependencies only point to lower ranks, so this ends in the same
+        # state as the sequential update.
+        new_velocities = self.velocities.copy()
+        result = self._evaluate(rank, dt, new_positions, new_velocities, cooldowns, effective,
+                                leaders, sides, ballistic)
+        new_lanes, new_cooldowns, accelerations, velocities, positions, due = result
+        changed = (velocities != new_velocities) | (positions != new_positions)
+        new_velocities, new_positions = velocities, positions
+
+        for _ in range(n):
+            depends = np.zeros(n, dtype=bool)
+            inputs = [leaders] + [side_leaders for _, _, side_leaders, _ in sides]
+            if ballistic:
+                inputs += [side_followers for _, _, _, side_followers in sides]
+                leaders, sides = self._sequential_neighbors(new_lanes)
+                moved = ([leaders] + [side_leaders for _, _, side_leaders, _ in sides] +
+                         [side_followers for _, _, _, side_followers in sides])
+                for old, new in zip(inputs, moved):
+                    depends |= old != new
+                inputs = moved
+            for nbr in inputs:
+                depends |= (nbr >= 0) & (nbr < rank) & changed[np.maximum(nbr, 0)]
+            dependent = rank[depends]
+            if len(dependent) == 0:
+                break
+            sub = self._evaluate(dependent, dt, new_positions, new_velocities, cooldowns, effective,
+                                 leaders, sides, ballistic)
+            changed = np.zeros(n, dtype=bool)
+            changed[dependent] = (sub[3] != new_velocities[dependent]) | (sub[4] != new_positions[dependent])
+            (new_lanes[dependent], new_cooldowns[dependent], accelerations[dependent],
+             new_velocities[dependent], new_positions[dependent], due[dependent]) = sub
+
+        if self.lane_scheduler is not None:
+            parked = int((cooldowns > 0).sum())
+            evaluated = int(due.sum())
+            self.lane_scheduler.record(evaluated, parked, n - parked - evaluated)
+
+        if ballistic:
+            new_positions = np.where(new_positions > road_len, new_positions - road_len, new_positions)
+        self.positions = new_positions
+        self.velocities = new_velocities
+        self.accelerations = accelerations
+        self.lanes = new_lanes
+        self.cooldowns = new_cooldowns
+
+        # Color Update
+        status = np.full(n, STATUS_FREE, dtype=np.int8)
+        status[new_velocities < effective * 0.6] = STATUS_SLOW
+        status[new_velocities < 2] = STATUS_STOPPED
+        self.status = status
+
+    def _evaluate(self, idx, dt, new_positions, new_velocities, cooldowns, effective,
+                  leaders, sides, ballistic):
+        road_len = self.road.length
+        v = self.velocities[idx]
+        # Euler moved every vehicle first; ballistic decides from the start
+        pos = self.positions[idx] if ballistic else new_positions[idx]
+        length = self.lengths[idx]
+        v0 = effective[idx]
+        a = self.max_accelerations[idx]
+        b = self.comfortable_decelerations[idx]
+        s0 = self.min_gaps[idx]
+        T = self.time_headways[idx]
+
+        def seen(nbr):
+            # Position and velocity of each neighbor as seen by vehicle idx
+            j = np.maximum(nbr, 0)
+            moved = j < idx if ballistic else j <= idx
+            p = np.where(moved, new_positions[j], self.positions[j])
+            vel = np.where(j < idx, new_velocities[j], self.velocities[j])
+            return p, vel
+
+        def idm_towards(nbr):
+            p, vel = seen(nbr)
+            s = p - pos
+            s = np.where(s < 0, s + road_len, s) - length
+            s = np.where(nbr >= 0, s, np.inf)
+            delta_v = np.where(nbr >= 0, v - vel, 0.0)
+            return idm_acceleration(v, v0, s, delta_v, a, b, s0, T)
+
+        # Which vehicles evaluate a lane change (all without a scheduler)
+        due = np.ones(len(idx), dtype=bool)
+        if self.lane_scheduler is not None:
+            own = leaders[idx]
+            p, vel = seen(own)
+            pressure = leader_pressure(self.positions[idx], v, p, vel, length, a, b, s0, T, road_len)
+            pressure = np.where(own < 0, 0.0, np.where(own == idx, np.inf, pressure))
+            due = self.lane_scheduler.due_many(self.ids[idx], cooldowns[idx], pressure)
+
+        # 2. Lane change: for each side, safety then incentive. Keep the best
+        # candidate, the left one on ties, like Vehicle._try_lane_change.
+        half = road_len / 2
+        acc_stay = idm_towards(leaders[idx])
+        lanes = self.lanes[idx].copy()
+        lead = leaders[idx]
+        best_acc = acc_stay + LANE_CHANGE_THRESHOLD
+        change = np.zeros(len(idx), dtype=bool)
+        for target, exists, side_leaders, side_followers in sides:
+            t_lead = side_leaders[idx]
+            t_foll = side_followers[idx]
+
+            p_front, _ = seen(t_lead)
+            dist = p_front - pos
+            passed = ballistic & (t_lead >= 0) & (dist < 0) & (dist > -half)
+            dist = np.where(dist < 0, dist + road_len, dist)
+            gap_front = np.where(t_lead >= 0, dist - self.lengths[np.maximum(t_lead, 0)], np.inf)
+            gap_front = np.where(passed, -np.inf, gap_front)
+
+            p_back, _ = seen(t_foll)
+            dist = pos - p_back
+            passed = ballistic & (t_foll >= 0) & (dist < 0) & (dist > -half)
+            dist = np.where(dist < 0, dist + road_len, dist)
+            gap_back = np.where(t_foll >= 0, dist - length, np.inf)
+            gap_back = np.where(passed, -np.inf, gap_back)
+
+            acc_move = idm_towards(t_lead)
+            better = (due & (cooldowns[idx] <= 0) & exists[idx] &
+                      (gap_front >= SAFE_GAP_FRONT) & (gap_back >= SAFE_GAP_BACK) &
+                      (acc_move > best_acc))
+            lanes = np.where(better, target[idx], lanes)
+            lead = np.where(better, t_lead, lead)
+            best_acc = np.where(better, acc_move, best_acc)
+            change |= better
+
+        new_cooldowns = np.where(change, LANE_CHANGE_COOLDOWN, cooldowns[idx])
+
+        if ballistic:
+            max_substeps = MAX_SUBSTEPS if self.integrator == 'adaptive' else 1
+            acceleration, velocity, travelled = self._integrate_ballistic(
+                idx, dt, np.where(lead == idx, -1, lead), pos, v, v0, seen, max_substeps)
+            # Wrapped at the end of the step, like the object engine does
+            return lanes, new_cooldowns, acceleration, velocity, pos + travelled, due
+
+        # 3. IDM acceleration against the current-lane leader
+        acceleration = acc_stay
+
+        # 4. Update velocity
+        velocity = v + acceleration * dt
+        velocity = np.where(velocity < 0, 0.0, velocity)
+        return lanes, new_cooldowns, acceleration, velocity, pos, due
+
+    def _integrate_ballistic(self, idx, dt, lead, pos, v, v0, seen, max_substeps):
+        # Batched Vehicle.update_ballistic after the lane change: returns the
+        # acceleration, the new velocity and the distance travelled
+        road_len = self.road.length
+        length = self.lengths[idx]
+        a_max = self.max_accelerations[idx]
+        b = self.comfortable_decelerations[idx]
+        s0 = self.min_gaps[idx]
+        T = self.time_headways[idx]
+
+        has_lead = lead >= 0
+        p, vel = seen(lead)
+        gap = p - pos
+        gap = np.where(gap < 0, gap + road_len, gap) - length
+        gap = np.where(has_lead, gap, np.inf)
+        lead_v = np.where(has_lead, vel, 0.0)
+
+        steps = np.ones(len(idx), dtype=np.int64)
+        if max_substeps > 1:
+            closing = (v - lead_v) * dt
+            with np.errstate(divide='ignore', invalid='ignore'):
+                split = np.minimum(max_substeps, 1 + np.floor(closing / (SUBSTEP_GAP_FRACTION * gap)))
+            split = np.where(gap > 0, split, max_substeps)
+            steps = np.where(has_lead & (v > lead_v), split, 1).astype(np.int64)
+
+        h = dt / steps
+        travelled = np.zeros(len(idx))
+        acceleration = np.zeros(len(idx))
+        for k in range(int(steps.max())):
+            active = k < steps
+            acc = idm_acceleration(v, v0, gap + lead_v * (k * h) - travelled, v - lead_v,
+                                   a_max, b, s0, T)
+            stop = v + acc * h < 0
+            with np.errstate(divide='ignore', invalid='ignore'):
+                stopped_at = travelled - v * v / (2 * acc)
+            moved = np.where(stop, stopped_at, travelled + (v * h + 0.5 * acc * h * h))
+            travelled = np.where(active, moved, travelled)
+            v = np.where(active, np.where(stop, 0.0, v + acc * h), v)
+            acceleration = np.where(active, acc, acceleration)
+
+        over = travelled > gap
+        travelled = np.where(over, np.maximum(gap, 0.0), travelled)
+        v = np.where(over, np.minimum(v, lead_v), v)
+        return acceleration, v, travelled
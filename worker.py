@@ -0,0 +1,351 @@
+import math
+import multiprocessing as mp
+import queue
+import time
+from multiprocessing import shared_memory
+import numpy as np
+from headless import build_controller, DEFAULT_ROAD_LENGTH
+from model import VEHICLE_TYPES
+from recorder import TrajectoryRecorder
+
+# Physics in a separate process at a fixed timestep.
+#
+# The worker steps its own controller against the wall clock and publishes
+# every new state into shared memory; the UI reads the two most recent states
+# in place and interpolates between them, so drawing never waits for physics
+# and a slow frame never stretches the integration step. UI changes travel
+# the other way as commands on a queue.
+#
+# Shared memory layout: a control word (index of the latest published slot)
+# and SLOTS slots, each a header plus one column per entry in COLUMNS with
+# room for `capacity` vehicles. Vehicles are published sorted by id so the
+# reader can match them between states. The writer always fills the slot
+# after the latest one, so with three slots the two the reader is using are
+# never written while it holds them; each slot carries a sequence number
+# (odd while being written) to detect a reader that fell two states behind.
+
+PHYSICS_DT = 1 / 60
+# Most steps run back to back before the worker gives up on catching up
+MAX_CATCHUP_STEPS = 10
+PROFILE_INTERVAL = 0.5 # seconds between profiler reports
+SLOTS = 3
+
+HEADER_DTYPE = np.dtype([('seq', '<i8'), ('count', '<i8'), ('step', '<i8'),
+                         ('sim_time', '<f8'), ('wall_time', '<f8')])
+COLUMNS = (
+    ('ids', np.dtype('<i8'), ()),
+    ('positions', np.dtype('<f8'), ()),
+    ('velocities', np.dtype('<f4'), ()),
+    ('lanes', np.dtype('u1'), ()),
+    ('colors', np.dtype('u1'), (3,)),
+)
+
+
+def vehicle_state(sim):
+    # ids, positions, velocities, lanes, colors of either engine
+    if hasattr(sim, 'vehicles'):
+        vehicles = sim.vehicles
+        n = len(vehicles)
+        colors = np.array([v.color for v in vehicles], dtype=np.uint8).reshape(n, 3)
+        return (np.fromiter((v.id for v in vehicles), np.int64, n),
+                np.fromiter((v.position for v in vehicles), np.float64, n),
+                np.fromiter((v.velocity for v in vehicles), np.float64, n),
+                np.fromiter((v.lane for v in vehicles), np.int64, n),
+                colors)
+    return sim.ids, sim.positions, sim.velocities, sim.lanes, sim.colors()
+
+
+class SharedState:
+    def __init__(self, capacity, name=None):
+        # name=None creates a new block; otherwise attach to an existing one
+        self.capacity = capacity
+        slot_size = HEADER_DTYPE.itemsize + sum(
+            capacity * dtype.itemsize * int(np.prod(shape)) for _, dtype, shape in COLUMNS)
+        size = 8 + SLOTS * slot_size
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.owner = name is None
+        self.name = self.shm.name
+
+        buf = self.shm.buf
+        self.control = np.ndarray(1, np.int64, buf, 0)
+        offset = 8
+        self.header = np.ndarray(SLOTS, HEADER_DTYPE, buf, offset)
+        offset += SLOTS * HEADER_DTYPE.itemsize
+        self.slots = []
+        for _ in range(SLOTS):
+            columns = {}
+            for column, dtype, shape in COLUMNS:
+                columns[column] = np.ndarray((capacity,) + shape, dtype, buf, offset)
+                offset += capacity * dtype.itemsize * int(np.prod(shape))
+            self.slots.append(columns)
+        if self.owner:
+            self.control[0] = -1
+            self.header[:] = 0
+
+    def publish(self, sim, step, wall_time):
+        latest = int(self.control[0])
+        slot = (latest + 1) % SLOTS
+        ids, positions, velocities, lanes, colors = vehicle_state(sim)
+        order = np.argsort(ids, kind='stable')[:self.capacity]
+        n = len(order)
+        header = self.header[slot]
+        header['seq'] += 1 # odd: being written
+        columns = self.slots[slot]
+        columns['ids'][:n] = ids[order]
+        columns['positions'][:n] = positions[order]
+        columns['velocities'][:n] = velocities[order]
+        columns['lanes'][:n] = lanes[order]
+        columns['colors'][:n] = colors[order]
+        header['count'] = n
+        header['step'] = step
+        header['sim_time'] = sim.current_time
+        header['wall_time'] = wall_time
+        header['seq'] += 1
+        self.control[0] = slot
+
+    def _frame(self, slot):
+        n = int(self.header['count'][slot])
+        frame = {column: values[:n] for column, values in self.slots[slot].items()}
+        frame['time'] = float(self.header['sim_time'][slot])
+        return frame
+
+    def read(self):
+        # (previous, current, alpha, token) or None before the first state.
+        # Frames are dicts of views into shared memory: use them, then check
+        # unchanged(token) and read again if the writer got to them first.
+        # alpha in [0, 1] is how far the display is from previous to current,
+        # one publish interval behind the physics.
+        latest = int(self.control[0])
+        if latest < 0:
+            return None
+        prev = (latest - 1) % SLOTS
+        seqs = self.header['seq']
+        token = (latest, int(seqs[latest]), prev, int(seqs[prev]))
+        current = self._frame(latest)
+        if token[3] == 0 or token[3] % 2:
+            return current, current, 1.0, token
+        t1 = float(self.header['wall_time'][latest])
+        t0 = float(self.header['wall_time'][prev])
+        alpha = (time.monotonic() - t1) / (t1 - t0) if t1 > t0 else 1.0
+        return self._frame(prev), current, min(max(alpha, 0.0), 1.0), token
+
+    def latest_time(self):
+        # Simulated time of the latest state (0 before the first)
+        latest = int(self.control[0])
+        return float(self.header['sim_time'][latest]) if latest >= 0 else 0.0
+
+    def unchanged(self, token):
+        latest, seq_latest, prev, seq_prev = token
+        seqs = self.header['seq']
+        return seq_latest % 2 == 0 and seqs[latest] == seq_latest and seqs[prev] == seq_prev
+
+    def close(self):
+        # Drop the views before closing, numpy holds the buffer otherwise
+        self.control = self.header = self.slots = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+# Arguments of commands are checked before anything changes: they may come
+# from remote clients, and a bad one must be an error for that client, not
+# a half applied change or an exception from deep inside a setter.
+
+def _zone(zone):
+    # (start, end, limit) of a [start, end, limit] sent as a command
+    try:
+        start, end, limit = (float(x) for x in zone)
+    except (TypeError, ValueError):
+        raise ValueError(f"bad zone {zone!r}: expected [start, end, limit]") from None
+    if not all(math.isfinite(x) for x in (start, end, limit)) or limit < 0:
+        raise ValueError(f"bad zone {zone!r}")
+    return start, end, limit
+
+
+def _amount(value, what):
+    # A finite number >= 0 (speeds, limits, shares)
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"bad {what} {value!r}") from None
+    if not math.isfinite(number) or number < 0:
+        raise ValueError(f"bad {what} {value!r}")
+    return number
+
+
+def _zone_index(index):
+    if isinstance(index, bool) or not isinstance(index, int):
+        raise ValueError(f"bad zone index {index!r}")
+    return index
+
+
+def _fleet(shares):
+    # {type name: share} as floats, or None for cars only
+    if shares is None:
+        return None
+    if not isinstance(shares, dict):
+        raise ValueError(f"bad fleet {shares!r}: expected {{type name: share}}")
+    for name in shares:
+        if name not in VEHICLE_TYPES:
+            raise ValueError(f"unknown vehicle type {name!r}")
+    return {name: _amount(share, f"share for {name!r}") for name, share in shares.items()}
+
+
+def apply_command(sim, command, args):
+    # Setter calls arriving as (name, args): from the UI through the queue,
+    # or from remote clients of server.py
+    if command == 'set_target_vehicle_count':
+        sim.set_target_vehicle_count(*args)
+    elif command == 'populate':
+        sim.populate(*args)
+    elif command == 'set_base_desired_speed':
+        speed, = args
+        sim.set_base_desired_speed(_amount(speed, 'speed'))
+    elif command == 'set_speed_limit_zones':
+        # Every zone is checked before the old ones go: a bad one changes nothing
+        zones = [_zone(zone) for zone in args[0]]
+        sim.road.clear_zones()
+        for start, end, limit in zones:
+            sim.road.add_speed_limit_zone(start, end, limit)
+    elif command == 'set_zone_limit':
+        index, limit = args
+        sim.set_zone_limit(_zone_index(index), _amount(limit, 'speed limit'))
+    elif command == 'set_fleet':
+        shares, = args
+        sim.set_fleet(_fleet(shares))
+    elif command == 'enable_profiling':
+        if hasattr(sim, 'enable_profiling'):
+            sim.enable_profiling()
+    elif command == 'disable_profiling':
+        if hasattr(sim, 'disable_profiling'):
+            sim.disable_profiling()
+    else:
+        raise ValueError(f"unknown command {command!r}")
+
+
+def run_worker(config, state_name, capacity, commands, results):
+    # Process entry point: step at config['dt'] in real time until 'stop'
+    sim = build_controller(config['engine'], config['road_length'], 0, 120, (), config['seed'],
+                           config['num_lanes'], config['integrator'])
+    state = SharedState(capacity, state_name)
+    recorder = None
+    if config.get('record_path'):
+        recorder = sim.recorder = TrajectoryRecorder(config['record_path'], sim.road, sim.base_desired_speed)
+    dt = config['dt']
+    step = 0
+    next_step = time.monotonic()
+    next_report = next_step
+    try:
+        while True:
+            try:
+                command, args = commands.get(timeout=max(0.0, next_step - time.monotonic()))
+            except queue.Empty:
+                command = None
+            if command == 'stop':
+                break
+            if command is not None:
+                apply_command(sim, command, args)
+                continue # drain every pending command before stepping
+
+            now = time.monotonic()
+            steps = 0
+            while next_step <= now and steps < MAX_CATCHUP_STEPS:
+                sim.update(dt)
+                step += 1
+                steps += 1
+                next_step += dt
+            if next_step < now:
+                next_step = now # too far behind: drop the backlog, keep dt fixed
+            if steps:
+                state.publish(sim, step, time.monotonic())
+
+            profiler = getattr(sim, 'profiler', None)
+            if profiler is not None and now >= next_report:
+                results.put(profiler.stats())
+                next_report = now + PROFILE_INTERVAL
+    finally:
+        if recorder is not None:
+            recorder.close()
+        state.close()
+
+
+class SimulationWorker:
+    # Handle used by the UI: owns the process, the shared state and the
+    # command queue. Setters mirror SimulationController's.
+    def __init__(self, engine='object', road_length=DEFAULT_ROAD_LENGTH, num_lanes=2, dt=PHYSICS_DT,
+                 seed=None, capacity=1 << 12, record_path=None, integrator='euler'):
+        self.dt = dt
+        self.capacity = capacity
+        self.state = SharedState(capacity)
+        ctx = mp.get_context('spawn') # the parent has pygame and a window open
+        self.commands = ctx.Queue()
+        self.results = ctx.Queue()
+        config = {'engine': engine, 'road_length': road_length, 'num_lanes': num_lanes, 'dt': dt,
+                  'seed': seed, 'record_path': record_path, 'integrator': integrator}
+        self.process = ctx.Process(target=run_worker, name='simulation-worker', daemon=True,
+                                   args=(config, self.state.name, capacity, self.commands, self.results))
+        self.profiling = False
+        self._stats = None
+
+    def start(self):
+        self.process.start()
+        return self
+
+    def send(self, command, *args):
+        self.commands.put((command, args))
+
+    def set_target_vehicle_count(self, count, immediate=False):
+        # Vehicles past the shared buffer would not be drawn
+        self.send('set_target_vehicle_count', min(int(count), self.capacity), immediate)
+
+    def populate(self, count=None, perturbation=0.0):
+        # Uses the worker's target count by default
+        if count is not None:
+            count = min(int(count), self.capacity)
+        self.send('populate', count, perturbation)
+
+    def set_base_desired_speed(self, speed):
+        self.send('set_base_desired_speed', speed)
+
+    def set_speed_limit_zones(self, zones):
+        self.send('set_speed_limit_zones', [(z['start'], z['end'], z['limit']) for z in zones])
+
+    def set_zone_limit(self, index, limit):
+        self.send('set_zone_limit', index, limit)
+
+    def set_fleet(self, shares):
+        self.send('set_fleet', shares)
+
+    def enable_profiling(self):
+        self.profiling = True
+        self.send('enable_profiling')
+
+    def disable_profiling(self):
+        self.profiling = False
+        self._stats = None
+        self.send('disable_profiling')
+
+    def stats(self):
+        # Latest profiler report from the worker, or None
+        while True:
+            try:
+                self._stats = self.results.get_nowait()
+            except queue.Empty:
+                return self._stats if self.profiling else None
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def stop(self, timeout=5.0):
+        if self.process.is_alive():
+            self.send('stop')
+            self.process.join(timeout)
+            if self.process.is_alive():
+                self.process.terminate()
+                self.process.join()
+        self.commands.close()
+        self.results.close()
+        self.state.close()